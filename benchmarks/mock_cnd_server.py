@@ -0,0 +1,153 @@
+import json
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+class MOCK_CND_SERVER:
+
+    def __init__(
+        self,
+        workbooks:dict,
+        latency:float=0.0,
+        error_rate:float=0.0,
+        page_size:int=None,
+        host:str='127.0.0.1',
+        port:int=0,
+        seed:int=None
+    )->None:
+        '''
+        Local mock of the CND GetListOperativosComerciales and Download endpoints.
+        Any day or week is listed with the workbook of its CND week.
+        Parameters:
+        - workbooks (dict): Saturday of the CND week to the path of its workbook
+        - latency (float): Seconds added to every response
+        - error_rate (float): Share of the requests answered with 503
+        - page_size (int): Records per listing page. None lists everything in page 0
+        - host (str): Interface to listen on
+        - port (int): Port, 0 picks a free one
+        - seed (int): Seed of the injected errors
+        '''
+        self.workbooks={datetime(d.year, d.month, d.day): path for d, path in workbooks.items()}
+        self.latency=latency
+        self.error_rate=error_rate
+        self.page_size=page_size
+        self.requests={'listing': 0, 'download': 0, 'errors': 0}
+        self._ids={week_start: i+1 for i, week_start in enumerate(sorted(self.workbooks))}
+        self._rng=random.Random(seed)
+        self._lock=threading.Lock()
+        self._server=ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads=True
+        self._thread=None
+
+    @property
+    def base_url(self) -> str:
+      return f'http://{self._server.server_address[0]}:{self._server.server_address[1]}/Informe/GetListOperativosComerciales'
+
+    @property
+    def download_url(self) -> str:
+      return f'http://{self._server.server_address[0]}:{self._server.server_address[1]}/Informe/Download'
+
+    def start(self) -> 'MOCK_CND_SERVER':
+      self._thread=threading.Thread(target=self._server.serve_forever, daemon=True)
+      self._thread.start()
+      return self
+
+    def stop(self) -> None:
+      self._server.shutdown()
+      self._server.server_close()
+
+    def __enter__(self) -> 'MOCK_CND_SERVER':
+      return self.start()
+
+    def __exit__(self, *exc) -> None:
+      self.stop()
+
+    def _week_start(self, params:dict) -> datetime:
+      '''
+      This function finds the CND week of the listing parameters, as sent by dated_payload.
+      '''
+      anio=int(params.get('anio', ['0'])[0])
+      semana=int(params.get('semana', ['0'])[0])
+      if semana != 0:
+        return datetime.fromisocalendar(anio, semana, 6)
+      day=datetime(anio, int(params['mes'][0]), int(params['dia'][0]))
+      return day-timedelta(days=(day.weekday()-5) % 7)
+
+    def _records(self, params:dict) -> list:
+      week_start=self._week_start(params)
+      if week_start not in self.workbooks:
+        return []
+      path=self.workbooks[week_start]
+      epoch_ms=int(os.path.getmtime(path)*1000)
+      records=[{
+        'id': self._ids[week_start],
+        'adjunto': {'path': f'Informes\\Predespacho\\{os.path.basename(path)}'},
+        'fechaPublica': f'/Date({epoch_ms})/'
+      }]
+      page=int(params.get('page', ['0'])[0])
+      if self.page_size is None:
+        return records if page == 0 else []
+      return records[page*self.page_size:(page+1)*self.page_size]
+
+    def _handler(self):
+      mock=self
+
+      class _Handler(BaseHTTPRequestHandler):
+        protocol_version='HTTP/1.1'
+
+        def _send(self, status:int, body:bytes, headers:dict=None) -> None:
+          self.send_response(status)
+          for k, v in (headers or {}).items():
+            self.send_header(k, v)
+          self.send_header('Content-Length', str(len(body)))
+          self.end_headers()
+          self.wfile.write(body)
+
+        def do_GET(self) -> None:
+          url=urlparse(self.path)
+          params=parse_qs(url.query)
+          if mock.latency > 0:
+            time.sleep(mock.latency)
+
+          with mock._lock:
+            failed=mock._rng.random() < mock.error_rate
+            if failed:
+              mock.requests['errors']+=1
+          if failed:
+            return self._send(503, b'Service Unavailable', {'Retry-After': '0'})
+
+          if url.path.endswith('/GetListOperativosComerciales'):
+            with mock._lock:
+              mock.requests['listing']+=1
+            return self._send(200, json.dumps(mock._records(params)).encode(), {'Content-Type': 'application/json'})
+
+          match=re.search(string=url.path, pattern=r'/Download/([0-9]+)$')
+          paths={mock._ids[w]: p for w, p in mock.workbooks.items()}
+          if match is None or int(match[1]) not in paths:
+            return self._send(404, b'Not Found')
+          with mock._lock:
+            mock.requests['download']+=1
+          with open(paths[int(match[1])], 'rb') as f:
+            content=f.read()
+
+          ## Range requests, as used by the resumable downloads
+          range_header=re.fullmatch(r'bytes=([0-9]+)-', self.headers.get('Range', ''))
+          if range_header is not None:
+            offset=int(range_header[1])
+            if offset >= len(content):
+              return self._send(416, b'', {'Content-Range': f'bytes */{len(content)}'})
+            return self._send(206, content[offset:], {
+              'Content-Type': 'application/octet-stream',
+              'Content-Range': f'bytes {offset}-{len(content)-1}/{len(content)}'
+            })
+          return self._send(200, content, {'Content-Type': 'application/octet-stream'})
+
+        def log_message(self, *args) -> None:
+          pass
+
+      return _Handler
@@ -0,0 +1,208 @@
+'''
+Offline benchmarks of the predispatch pipeline, against synthetic workbooks and a local mock
+of CND. Reports the throughput of CND_PARSER.parse_predispatch, CND_DOWNLOADER.cnd_file_download
+and an end to end cnd_predispatch backfill, plus the startup time of the energy-sources CLI,
+so commits can be compared.
+
+Usage, from the repository root:
+    python -m benchmarks.run_benchmarks --days 14 --output bench_<commit>.json
+    python -m benchmarks.run_benchmarks --days 14 --baseline bench_<other commit>.json
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from benchmarks.mock_cnd_server import MOCK_CND_SERVER
+from benchmarks.synthetic_workbooks import make_corpus
+from src.clients.cnd_downloader import CND_DOWNLOADER, staged_file_name
+from src.clients.cnd_parser import CND_PARSER
+from src.clients.http_session import build_session
+from src.cli import startup_benchmark
+
+PAYLOAD = {'categoria': '6', 'tipo': '76', 'key': 'public_key', 'page': '0', 'publico': '1'}
+
+def _commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def _week_starts(first_day:datetime, days:int) -> list:
+    ## Saturdays of the CND weeks covering the days
+    first_week=first_day-timedelta(days=(first_day.weekday()-5) % 7)
+    last_day=first_day+timedelta(days=days-1)
+    return [first_week+timedelta(weeks=w) for w in range((last_day-first_week).days//7+1)]
+
+def bench_parse(corpus:dict, work_path:str, engine:str=None) -> dict:
+    '''
+    Parses the seven days of every workbook of the corpus, per format.
+    '''
+    results={}
+    for fmt, files in corpus.items():
+        rows=0
+        input_bytes=0
+        start=time.perf_counter()
+        for i, (week_start, path) in enumerate(files):
+            parser=CND_PARSER(
+                file_metadata=(i, os.path.basename(path), '/Date(0)/'),
+                file_path=path,
+                staging_path=f'{work_path}/parse_{fmt}',
+                engine=engine
+            )
+            parser.parse_predispatch_days(
+                requested_dates=[week_start+timedelta(days=d) for d in range(7)],
+                header=3,
+                output_prefix='bench'
+            )
+            rows+=sum(o['rows'] for o in parser.output_stats)
+            input_bytes+=os.path.getsize(path)
+        seconds=time.perf_counter()-start
+        results[fmt]={
+            'seconds': seconds,
+            'files': len(files),
+            'files_per_second': len(files)/seconds,
+            'days_per_second': 7*len(files)/seconds,
+            'rows_per_second': rows/seconds,
+            'input_mb_per_second': input_bytes/1024**2/seconds
+        }
+    return results
+
+def bench_download(mock:MOCK_CND_SERVER, dates:list, work_path:str) -> dict:
+    '''
+    Lists and downloads the files of every day through the mock, one day after the other.
+    '''
+    session=build_session()
+    downloaded_bytes=0
+    start=time.perf_counter()
+    for d in dates:
+        staging_path=f'{work_path}/download/{d.strftime("%Y-%m-%d")}'
+        downloader=CND_DOWNLOADER(
+            requested_date=d,
+            base_url=mock.base_url,
+            payload=PAYLOAD,
+            staging_path=staging_path,
+            session=session,
+            download_url=mock.download_url
+        )
+        for file_id, file_name, _ in downloader.cnd_file_download():
+            downloaded_bytes+=os.path.getsize(f'{staging_path}/{staged_file_name(file_id, file_name)}')
+    seconds=time.perf_counter()-start
+    session.close()
+    return {
+        'seconds': seconds,
+        'files': len(dates),
+        'files_per_second': len(dates)/seconds,
+        'mb_per_second': downloaded_bytes/1024**2/seconds
+    }
+
+def bench_end_to_end(mock:MOCK_CND_SERVER, dates:list, work_path:str, **flow_kwargs) -> dict:
+    '''
+    Runs a local only cnd_predispatch backfill of the days through the mock.
+    '''
+    from src.pipeline.flows.cnd_predispatch_flow import cnd_predispatch
+
+    start=time.perf_counter()
+    cnd_predispatch(
+        base_url=mock.base_url,
+        download_url=mock.download_url,
+        payload=PAYLOAD,
+        staging_path=f'{work_path}/end_to_end',
+        requested_date=max(dates)+timedelta(days=1),
+        days_backfill=len(dates),
+        **flow_kwargs
+    )
+    seconds=time.perf_counter()-start
+    return {'seconds': seconds, 'days': len(dates), 'days_per_second': len(dates)/seconds}
+
+def compare(report:dict, baseline:dict) -> None:
+    '''
+    Prints the throughputs of the report next to the ones of a baseline report.
+    '''
+    def _flatten(results:dict, prefix:str='') -> dict:
+        flat={}
+        for k, v in results.items():
+            if isinstance(v, dict):
+                flat.update(_flatten(v, f'{prefix}{k}.'))
+            elif k.endswith('_per_second'):
+                flat[f'{prefix}{k}']=v
+        return flat
+
+    current=_flatten(report['results'])
+    previous=_flatten(baseline['results'])
+    print(f'Comparison against {baseline.get("commit")} ({baseline.get("timestamp")})')
+    for name, value in current.items():
+        if name in previous and previous[name]:
+            print(f'  {name:45s} {previous[name]:12.2f} -> {value:12.2f}  x{value/previous[name]:.2f}')
+
+def main(argv:list=None) -> dict:
+    parser=argparse.ArgumentParser(description='Offline benchmarks of the predispatch pipeline')
+    parser.add_argument('--days', type=int, default=7, help='Days of the download and end to end backfill')
+    parser.add_argument('--units', type=int, default=150, help='Rows per day sheet of the synthetic workbooks')
+    parser.add_argument('--formats', nargs='+', default=['xlsx', 'xls', 'zip'], help='Workbook formats of the parse benchmark')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds added by the mock to every response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of mock responses answered with 503')
+    parser.add_argument('--engine', default=None, help='Excel engine of the parser, i.e. calamine')
+    parser.add_argument('--max-workers', type=int, default=1, help='Days processed concurrently end to end')
+    parser.add_argument('--parse-workers', type=int, default=1, help='Parse processes end to end')
+    parser.add_argument('--pipelined', action='store_true', help='Runs the end to end backfill pipelined')
+    parser.add_argument('--staging-mode', default='disk', choices=['disk', 'memory'], help='Staging of the end to end backfill, memory writes a local dataset')
+    parser.add_argument('--skip', nargs='*', default=[], choices=['parse', 'download', 'end_to_end', 'startup'], help='Benchmarks to skip')
+    parser.add_argument('--output', default=None, help='JSON report path')
+    parser.add_argument('--baseline', default=None, help='JSON report of another commit to compare with')
+    args=parser.parse_args(argv)
+
+    first_day=datetime(2025, 3, 1)
+    dates=[first_day+timedelta(days=d) for d in range(args.days)]
+    report={
+        'commit': _commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'params': vars(args),
+        'results': {}
+    }
+
+    if 'startup' not in args.skip:
+        report['results']['startup']=startup_benchmark()
+
+    with tempfile.TemporaryDirectory() as work_path:
+        corpus=make_corpus(f'{work_path}/corpus', _week_starts(first_day, args.days), formats=tuple(args.formats), units=args.units)
+        if 'parse' not in args.skip:
+            report['results']['parse']=bench_parse(corpus, work_path, engine=args.engine)
+
+        ## The mock serves the xlsx workbooks, or the first format available
+        served=corpus.get('xlsx') or next(iter(corpus.values()))
+        with MOCK_CND_SERVER({w: p for w, p in served}, latency=args.latency, error_rate=args.error_rate, seed=0) as mock:
+            if 'download' not in args.skip:
+                report['results']['download']=bench_download(mock, dates, work_path)
+            if 'end_to_end' not in args.skip:
+                report['results']['end_to_end']=bench_end_to_end(
+                    mock,
+                    dates,
+                    work_path,
+                    requests_per_second=1000,
+                    max_workers=args.max_workers,
+                    parse_workers=args.parse_workers,
+                    excel_engine=args.engine,
+                    pipelined=args.pipelined,
+                    staging_mode=args.staging_mode,
+                    ## Memory staging needs a destination for the parsed files
+                    dataset_path=f'{work_path}/dataset' if args.staging_mode == 'memory' else None
+                )
+            report['mock_requests']=dict(mock.requests)
+
+    print(json.dumps(report['results'], indent=2))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            compare(report, json.load(f))
+    return report
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,110 @@
+import os
+import random
+import zipfile
+from datetime import datetime, timedelta
+import openpyxl
+
+## CND weeks run from Saturday ("Día 1") to Friday ("Día 7")
+DAY_NAMES = ['SABADO', 'DOMINGO', 'LUNES', 'MARTES', 'MIERCOLES', 'JUEVES', 'VIERNES']
+
+def _sheet_rows(day:datetime, semana:int, units:int, rng:random.Random) -> list:
+    '''
+    Rows of a "Día N" sheet with the layout of the CND predispatch: title, date and
+    description rows, the header in the 4th row (header=3) and one row per unit.
+    '''
+    rows=[
+        [DAY_NAMES[(day.weekday()-5) % 7], None, 50, 'Unidad Marginando'],
+        [day],
+        [day.strftime('%d-%m-%Y'), f'Predespacho Semana {semana}'],
+        ['Plantas', 'Precio (B/.)']+[f'{h}-{h+1}' for h in range(24)]+['Total', None, 'Pot. $'],
+    ]
+    for unit in range(units):
+        hourly=[round(rng.random()*100, 3) for _ in range(24)]
+        rows.append([f'UNIT {unit}', round(rng.random()*300, 3)]+hourly+[round(sum(hourly), 3), None, 1])
+    return rows
+
+def make_predispatch_workbook(path:str, week_start:datetime, units:int=150, seed:int=None) -> str:
+    '''
+    Writes a synthetic weekly predispatch workbook with the seven "Día N" sheets.
+    The format follows the extension, .xlsx with openpyxl or .xls with xlwt.
+    Parameters:
+    - path (str): Output path, .xlsx or .xls
+    - week_start (datetime): Saturday of the CND week
+    - units (int): Rows per sheet
+    - seed (int): Seed of the random values, the same seed writes the same values
+    Returns:
+    - str: Path of the workbook
+    '''
+    rng=random.Random(seed)
+    semana=week_start.isocalendar()[1]
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    if path.endswith('.xls'):
+        ## xlwt is the only writer of the legacy format, it is not a dependency of the pipeline
+        import xlwt
+        date_style=xlwt.easyxf(num_format_str='YYYY-MM-DD')
+        wb=xlwt.Workbook()
+        for n in range(1, 8):
+            ws=wb.add_sheet(f'Día {n}')
+            for r, row in enumerate(_sheet_rows(week_start+timedelta(days=n-1), semana, units, rng)):
+                for c, value in enumerate(row):
+                    if isinstance(value, datetime):
+                        ws.write(r, c, value, date_style)
+                    elif value is not None:
+                        ws.write(r, c, value)
+        wb.save(path)
+        return path
+
+    wb=openpyxl.Workbook(write_only=True)
+    for n in range(1, 8):
+        ws=wb.create_sheet(f'Día {n}')
+        for row in _sheet_rows(week_start+timedelta(days=n-1), semana, units, rng):
+            ws.append(row)
+    wb.save(path)
+    return path
+
+def make_zip(path:str, members:list) -> str:
+    '''
+    Zips workbooks the way CND shares them, one or several workbooks per archive.
+    '''
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for member in members:
+            zf.write(member, arcname=os.path.basename(member))
+    return path
+
+def make_corpus(
+    output_path:str,
+    week_starts:list,
+    formats:tuple=('xlsx', 'xls', 'zip'),
+    units:int=150,
+    seed:int=0
+) -> dict:
+    '''
+    Writes one workbook per week and format. Formats that cannot be written here,
+    i.e. .xls without xlwt, are skipped with a message.
+    Parameters:
+    - output_path (str): Folder of the corpus
+    - week_starts (list): Saturdays of the weeks
+    - formats (tuple): 'xlsx', 'xls' and/or 'zip' (an .xlsx inside a zip)
+    - units (int): Rows per sheet
+    - seed (int): Base seed, every week gets its own
+    Returns:
+    - dict: Format to the list of (week_start, path)
+    '''
+    corpus={}
+    for fmt in formats:
+        files=[]
+        for i, week_start in enumerate(week_starts):
+            name=f'predespacho_{week_start.strftime("%Y%m%d")}'
+            try:
+                if fmt == 'zip':
+                    member=make_predispatch_workbook(f'{output_path}/zip_members/{name}.xlsx', week_start, units, seed+i)
+                    files.append((week_start, make_zip(f'{output_path}/{name}.zip', [member])))
+                else:
+                    files.append((week_start, make_predispatch_workbook(f'{output_path}/{name}.{fmt}', week_start, units, seed+i)))
+            except ImportError as e:
+                print(f'[Error] Skipping {fmt} workbooks: {e}')
+                break
+        if files != []:
+            corpus[fmt]=files
+    return corpus
@@ -1,4 +1,4 @@
-from src.prefect.flows.cnd_predispatch_flow import cnd_predispatch
+from src.pipeline.flows.cnd_predispatch_flow import cnd_predispatch
 import shutil
 import os
 from datetime import datetime
@@ -29,7 +29,7 @@ if __name__ == '__main__':
         gcp_project_id='terst-project'
         bucket_name='test_bucket'
         blob_folder_name='blob_folder'
-        gcs_regexp_file='.parquet.gz'
+        gcs_regexp_file='.parquet'
         cred_path ='credentials_path'
         
 
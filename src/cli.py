@@ -0,0 +1,256 @@
+'''
+Command line of the pipeline, installed as energy-sources.
+
+Only the standard library is imported at module level, so --help and argument errors return
+before pandas, pyarrow or the cloud SDKs are loaded. The flow is imported when its command runs,
+and the flow imports the cloud SDKs only when an upload is configured.
+
+Usage:
+    energy-sources predispatch --from 2025-03-01 --to 2025-03-05 --local-only
+    energy-sources predispatch --config predispatch.toml --from 2025-03-01
+    energy-sources predispatch --from 2025-03-01 --set parse_workers=4 --print-config
+    energy-sources startup-benchmark --runs 10
+
+Parameters of cnd_predispatch are taken, from lowest to highest priority, from the defaults of
+the flow, the config file, ENERGY_SOURCES_<PARAMETER> environment variables, i.e.
+ENERGY_SOURCES_BUCKET_NAME, and the command line.
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+BASE_URL = 'https://sitioprivado.cnd.com.pa/Informe/GetListOperativosComerciales'
+
+## Weekly predispatch listing, the report of main public.py
+PAYLOAD = {'categoria': '6', 'tipo': '76', 'key': 'public_key', 'page': '0', 'publico': '1'}
+
+ENV_PREFIX = 'ENERGY_SOURCES_'
+
+## Environment variables of the CLI itself, not parameters of the flow
+ENV_SETTINGS = ('CONFIG',)
+
+## Parameters cleared by --local-only, so no cloud SDK is imported
+CLOUD_PARAMETERS = ('cred_path', 'gcp_project_id', 'bucket_name', 'bq_dataset', 'bq_table')
+
+## Modules reported by the startup benchmark when a command loads them
+HEAVY_MODULES = ('pandas', 'numpy', 'pyarrow', 'duckdb', 'requests', 'google.cloud.storage', 'google.cloud.bigquery', 'pyspark')
+
+def _value(text:str):
+    ## Numbers, booleans, null, lists and objects as JSON, anything else as text
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+def _date(text:str) -> datetime:
+    try:
+        return datetime.strptime(text, '%Y-%m-%d')
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid date {text}, use YYYY-MM-DD')
+
+def _assignment(text:str) -> tuple:
+    if '=' not in text:
+        raise argparse.ArgumentTypeError(f'Invalid assignment {text}, use PARAMETER=VALUE')
+    name, value=text.split('=', 1)
+    return name.strip(), _value(value)
+
+def load_config(config_path:str) -> dict:
+    '''
+    Reads the parameters of a config file, JSON or TOML by its extension. The parameters can be
+    at the top level or in a predispatch section.
+    Parameters:
+    - config_path (str): Path of the config file
+    Returns:
+    - dict: Parameters of cnd_predispatch
+    '''
+    if config_path.endswith('.toml'):
+        try:
+            import tomllib
+        except ImportError:
+            raise Exception(f'TOML config {config_path} needs Python 3.11, use a JSON config instead')
+        with open(config_path, 'rb') as f:
+            config=tomllib.load(f)
+    else:
+        with open(config_path) as f:
+            config=json.load(f)
+    if not isinstance(config, dict):
+        raise Exception(f'Config {config_path} must be an object of parameters')
+    return dict(config.get('predispatch', config))
+
+def env_config(environ:dict=None) -> dict:
+    '''
+    Reads the parameters set as ENERGY_SOURCES_<PARAMETER> environment variables, with JSON values
+    parsed, i.e. ENERGY_SOURCES_PARSE_WORKERS=4 or ENERGY_SOURCES_REPORTS='["predispatch"]'.
+    '''
+    environ=os.environ if environ is None else environ
+    return {
+        k[len(ENV_PREFIX):].lower(): _value(v)
+        for k, v in environ.items()
+        if k.startswith(ENV_PREFIX) and k[len(ENV_PREFIX):] not in ENV_SETTINGS
+    }
+
+def resolve_parameters(args:argparse.Namespace, environ:dict=None) -> dict:
+    '''
+    This function merges the config file, the environment and the command line into the
+    parameters of cnd_predispatch.
+    Parameters:
+    - args: Parsed arguments of the predispatch command
+    - environ (dict): Environment variables. None uses os.environ
+    Returns:
+    - dict: Keyword arguments of cnd_predispatch
+    '''
+    environ=os.environ if environ is None else environ
+    params={'base_url': BASE_URL, 'payload': dict(PAYLOAD), 'staging_path': 'temp'}
+    config_path=args.config if args.config is not None else environ.get(f'{ENV_PREFIX}CONFIG')
+    if config_path is not None:
+        params.update(load_config(config_path))
+    params.update(env_config(environ))
+
+    for name in ('staging_path', 'state_path', 'dataset_path', 'cache_path', 'max_workers', 'parse_workers',
+                 'staging_mode', 'output_layout', 'excel_engine', 'metrics_path', 'reports'):
+        value=getattr(args, name)
+        if value is not None:
+            params[name]=value
+    for name in ('pipelined', 'week_bool'):
+        if getattr(args, name):
+            params[name]=True
+    params.update(dict(args.set))
+
+    ## Both ends are included, --from alone runs a single day
+    first_day=args.first_day if args.first_day is not None else args.last_day
+    last_day=args.last_day if args.last_day is not None else args.first_day
+    if first_day is not None:
+        if first_day > last_day:
+            raise Exception(f'--from {first_day:%Y-%m-%d} is after --to {last_day:%Y-%m-%d}')
+        params['requested_date']=last_day+timedelta(days=1)
+        params['days_shift']=0
+        params['days_backfill']=(last_day-first_day).days+1
+    for name, value in params.items():
+        ## TOML dates and JSON or environment text, the flow takes datetimes
+        if isinstance(value, date) and not isinstance(value, datetime):
+            params[name]=datetime(value.year, value.month, value.day)
+        elif name == 'requested_date' and isinstance(value, str):
+            params[name]=datetime.fromisoformat(value)
+
+    if args.local_only:
+        for name in CLOUD_PARAMETERS:
+            params[name]=None
+    return params
+
+def _check_parameters(params:dict, func) -> None:
+    ## Typos in the config or the environment fail before anything runs
+    import inspect
+    accepted=inspect.signature(func).parameters
+    unknown=sorted(k for k in params if k not in accepted)
+    if unknown != []:
+        raise Exception(f'Unknown parameters {unknown} of {func.__name__}')
+
+def _predispatch(args:argparse.Namespace) -> int:
+    params=resolve_parameters(args)
+    if args.print_config:
+        print(json.dumps(params, indent=2, default=str))
+        return 0
+
+    from src.pipeline.flows.cnd_predispatch_flow import cnd_predispatch
+    _check_parameters(params, cnd_predispatch)
+    result=cnd_predispatch(**params)
+    if result is not None:
+        print(json.dumps(result, indent=2, default=str))
+    return 0
+
+def _timed_runs(command:list, runs:int) -> dict:
+    ## Wall time of fresh interpreters, so nothing is cached in sys.modules
+    seconds=[]
+    for _ in range(runs):
+        start=time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        seconds.append(time.perf_counter()-start)
+    median=statistics.median(seconds)
+    return {'seconds': median, 'min_seconds': min(seconds), 'runs_per_second': 1/median}
+
+def _loaded_modules(code:str) -> list:
+    ## Heavy modules in sys.modules after running code in a fresh interpreter
+    check=f'{code}\nimport sys, json\nprint(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))'
+    output=subprocess.run([sys.executable, '-c', check], check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def startup_benchmark(runs:int=5) -> dict:
+    '''
+    Measures the startup time of the CLI in fresh interpreters: the bare interpreter, --help of the
+    CLI and of predispatch, a resolved predispatch run with --print-config, and the import of the
+    flow, with the heavy modules each of them loads.
+    Parameters:
+    - runs (int): Runs per command, the median is reported
+    Returns:
+    - dict: Timings and loaded modules per command
+    '''
+    cli=[sys.executable, '-m', 'src.cli']
+    print_config=['predispatch', '--from', '2025-03-01', '--to', '2025-03-07', '--local-only', '--print-config']
+    results={
+        'interpreter': _timed_runs([sys.executable, '-c', 'pass'], runs),
+        'help': _timed_runs(cli+['--help'], runs),
+        'predispatch_help': _timed_runs(cli+['predispatch', '--help'], runs),
+        'print_config': _timed_runs(cli+print_config, runs),
+        'flow_import': _timed_runs([sys.executable, '-c', 'import src.pipeline.flows.cnd_predispatch_flow'], runs)
+    }
+    results['print_config']['modules']=_loaded_modules(f'import src.cli\nsrc.cli.main({print_config!r})')
+    results['flow_import']['modules']=_loaded_modules('import src.pipeline.flows.cnd_predispatch_flow')
+    return results
+
+def _startup_benchmark(args:argparse.Namespace) -> int:
+    results=startup_benchmark(runs=args.runs)
+    print(json.dumps(results, indent=2))
+    if args.max_help_seconds is not None and results['help']['seconds'] > args.max_help_seconds:
+        print(f'[Error] --help took {results["help"]["seconds"]:.3f}s, over {args.max_help_seconds}s')
+        return 1
+    return 0
+
+def build_parser() -> argparse.ArgumentParser:
+    parser=argparse.ArgumentParser(prog='energy-sources', description='Ingestion of the CND reports of Panama')
+    commands=parser.add_subparsers(dest='command', required=True)
+
+    predispatch=commands.add_parser('predispatch', help='Downloads, parses and uploads the predispatch reports of a range of days',
+                                    description='Runs cnd_predispatch for the days from --from to --to, both included.')
+    predispatch.add_argument('--from', dest='first_day', type=_date, default=None, help='First day, YYYY-MM-DD')
+    predispatch.add_argument('--to', dest='last_day', type=_date, default=None, help='Last day, YYYY-MM-DD. Defaults to --from')
+    predispatch.add_argument('--config', default=None, help=f'JSON or TOML file of parameters. Defaults to ${ENV_PREFIX}CONFIG')
+    predispatch.add_argument('--local-only', action='store_true', help='Parses locally without uploading to GCS or BigQuery')
+    predispatch.add_argument('--reports', nargs='+', default=None, help='Registered reports of the run, i.e. predispatch')
+    predispatch.add_argument('--staging-path', default=None, help='Staging folder, wiped on every run without --state-path')
+    predispatch.add_argument('--state-path', default=None, help='SQLite file of the backfill state, re-runs resume from it')
+    predispatch.add_argument('--dataset-path', default=None, help='Root of the Hive-partitioned dataset of the parsed days')
+    predispatch.add_argument('--cache-path', default=None, help='Directory of the persistent download cache')
+    predispatch.add_argument('--max-workers', type=int, default=None, help='Days processed concurrently')
+    predispatch.add_argument('--parse-workers', type=int, default=None, help='Parse processes')
+    predispatch.add_argument('--pipelined', action='store_true', help='Overlaps the download, parse and upload stages')
+    predispatch.add_argument('--week', dest='week_bool', action='store_true', help='Uses the weekly workbooks')
+    predispatch.add_argument('--staging-mode', default=None, choices=['disk', 'memory'], help='Staging of the downloaded and parsed files')
+    predispatch.add_argument('--output-layout', default=None, choices=['wide', 'long', 'both'], help='Layout of the parsed files')
+    predispatch.add_argument('--excel-engine', default=None, help='Engine used to read the workbooks, i.e. calamine')
+    predispatch.add_argument('--metrics-path', default=None, help='JSON lines file of the run metrics')
+    predispatch.add_argument('--set', type=_assignment, action='append', default=[], metavar='PARAMETER=VALUE',
+                             help='Any other parameter of cnd_predispatch, with a JSON or text value. Repeatable')
+    predispatch.add_argument('--print-config', action='store_true', help='Prints the resolved parameters and exits')
+    predispatch.set_defaults(func=_predispatch)
+
+    benchmark=commands.add_parser('startup-benchmark', help='Measures the startup time of the CLI',
+                                  description='Times --help, a resolved run and the import of the flow in fresh interpreters.')
+    benchmark.add_argument('--runs', type=int, default=5, help='Runs per command, the median is reported')
+    benchmark.add_argument('--max-help-seconds', type=float, default=None, help='Exits with 1 when --help is slower')
+    benchmark.set_defaults(func=_startup_benchmark)
+    return parser
+
+def main(argv:list=None) -> int:
+    parser=build_parser()
+    args=parser.parse_args(argv)
+    if getattr(args, 'first_day', None) is not None and args.last_day is not None and args.first_day > args.last_day:
+        parser.error(f'--from {args.first_day:%Y-%m-%d} is after --to {args.last_day:%Y-%m-%d}')
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,36 @@
+from datetime import datetime, timedelta
+from src.clients.cnd_parser import cnd_sheet_number
+
+def plan_weekly_backfill(requested_dates:list) -> list:
+    '''
+    Groups the dates of a backfill by the weekly CND workbook that holds them, so every
+    workbook is downloaded once and all of its needed "Día N" sheets are parsed in one open.
+    CND weeks run from Saturday ("Día 1") to Friday ("Día 7"), the week is requested with the
+    date of its Saturday.
+    Parameters:
+    - requested_dates (list): Dates of the backfill
+    Returns:
+    - list: One dict per weekly workbook, sorted by week, containing:
+        - week_start (datetime): Saturday of the CND week, reference date for the download
+        - anio (int): ISO year of the Saturday, sent to CND for the week
+        - semana (int): ISO week number of the Saturday, sent to CND for the week
+        - days (list): Tuples of (requested_date, sheet_number) to extract from the workbook
+    '''
+    weeks = {}
+    for requested_date in sorted(set(requested_dates)):
+        sheet_number = cnd_sheet_number(requested_date)
+        week_start = requested_date - timedelta(days=sheet_number-1)
+        week_start = datetime(week_start.year, week_start.month, week_start.day)
+
+        if week_start not in weeks:
+            ## The ISO week of the Saturday, with its ISO year: Sat 2022-01-01 is week 52 of 2021
+            anio, semana, _ = week_start.isocalendar()
+            weeks[week_start] = {
+                'week_start': week_start,
+                'anio': anio,
+                'semana': semana,
+                'days': []
+            }
+        weeks[week_start]['days'].append((requested_date, sheet_number))
+
+    return [weeks[w] for w in sorted(weeks)]
@@ -0,0 +1,166 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+## Stages of a day, in the order they complete
+STAGES = ('listed', 'downloaded', 'parsed', 'uploaded')
+
+class BACKFILL_STATE:
+
+    def __init__(
+        self,
+        db_path:str
+    )->None:
+        '''
+        Persistent state of the backfill in a SQLite file. Records the status of every day at
+        every stage (listed, downloaded, parsed, uploaded) and the file ids and fechaPublica
+        versions it was processed from, so an interrupted backfill resumes with the remaining work.
+        It is shared by the threads of the flow.
+        Parameters:
+        - db_path (str): SQLite file of the state. It must live outside staging_path
+        '''
+        self.db_path=db_path
+        self._lock=threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._conn=sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS day_stages (
+                    day TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    error TEXT,
+                    detail TEXT,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (day, stage)
+                )''')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS day_files (
+                    day TEXT NOT NULL,
+                    file_id INTEGER NOT NULL,
+                    file_name TEXT,
+                    fecha_publica TEXT,
+                    PRIMARY KEY (day, file_id)
+                )''')
+
+    def _day(self, requested_date:datetime) -> str:
+      return requested_date.strftime('%Y-%m-%d') if hasattr(requested_date, 'strftime') else str(requested_date)
+
+    def close(self) -> None:
+      with self._lock:
+        self._conn.close()
+
+    def mark(self, requested_date:datetime, stage:str, status:str='done', error:str=None, detail:dict=None) -> None:
+      '''
+      This function records the status of a day at a stage. A stage that is not done
+      invalidates the later stages of the day, so they run again.
+      Parameters:
+      - requested_date (datetime): Day
+      - stage (str): 'listed', 'downloaded', 'parsed' or 'uploaded'
+      - status (str): 'done' or 'failed'
+      - error (str): Error of a failed stage
+      - detail (dict): Values of the stage, i.e. the number of files
+      '''
+      if stage not in STAGES:
+        raise Exception(f'Unknown stage {stage}, expected one of {STAGES}')
+      day=self._day(requested_date)
+      with self._lock:
+        self._conn.execute(
+          'INSERT OR REPLACE INTO day_stages (day, stage, status, error, detail, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+          (day, stage, status, error, json.dumps(detail, default=str) if detail is not None else None, time.time())
+        )
+        if status != 'done':
+          later=STAGES[STAGES.index(stage)+1:]
+          if later != ():
+            self._conn.execute(
+              f'DELETE FROM day_stages WHERE day = ? AND stage IN ({", ".join("?"*len(later))})',
+              (day, *later)
+            )
+
+    def stages(self, requested_date:datetime) -> dict:
+      '''
+      This function returns the recorded stages of a day.
+      Returns:
+      - dict: Stage to its status, error and updated_at
+      '''
+      with self._lock:
+        rows=self._conn.execute(
+          'SELECT stage, status, error, updated_at FROM day_stages WHERE day = ?',
+          (self._day(requested_date),)
+        ).fetchall()
+      return {stage: {'status': status, 'error': error, 'updated_at': updated_at} for stage, status, error, updated_at in rows}
+
+    def is_done(self, requested_date:datetime, stage:str) -> bool:
+      return self.stages(requested_date).get(stage, {}).get('status') == 'done'
+
+    def files(self, requested_date:datetime) -> list:
+      '''
+      This function returns the (file_id, file_name, fecha_publica) the day was listed with.
+      '''
+      with self._lock:
+        return self._conn.execute(
+          'SELECT file_id, file_name, fecha_publica FROM day_files WHERE day = ? ORDER BY file_id',
+          (self._day(requested_date),)
+        ).fetchall()
+
+    def sync_listing(self, requested_date:datetime, records:list) -> bool:
+      '''
+      This function records the files listed for a day and marks it as listed. When CND
+      published other files, or other versions of them, since the day was processed,
+      its stages are cleared so the day runs again from the start.
+      Parameters:
+      - requested_date (datetime): Day
+      - records (list): Records of the listing as returned by CND
+      Returns:
+      - bool: True if the recorded files of the day changed
+      '''
+      day=self._day(requested_date)
+      listed=sorted(
+        (r['id'], os.path.basename(r['adjunto']['path']).split('\\')[-1], str(r['fechaPublica']))
+        for r in records
+      )
+      with self._lock:
+        recorded=self._conn.execute(
+          'SELECT file_id, file_name, fecha_publica FROM day_files WHERE day = ? ORDER BY file_id',
+          (day,)
+        ).fetchall()
+        changed=[tuple(r) for r in recorded] != listed
+        if changed:
+          self._conn.execute('BEGIN')
+          try:
+            self._conn.execute('DELETE FROM day_stages WHERE day = ?', (day,))
+            self._conn.execute('DELETE FROM day_files WHERE day = ?', (day,))
+            self._conn.executemany(
+              'INSERT INTO day_files (day, file_id, file_name, fecha_publica) VALUES (?, ?, ?, ?)',
+              [(day, *f) for f in listed]
+            )
+            self._conn.execute('COMMIT')
+          except Exception:
+            self._conn.execute('ROLLBACK')
+            raise
+      if changed and recorded != []:
+        print(f'[Info] Files of {day} changed since the last run, processing it again')
+      self.mark(requested_date, 'listed', detail={'files': len(listed)})
+      return changed
+
+    def summary(self, requested_dates:list=None) -> dict:
+      '''
+      This function counts the days per stage and status.
+      Parameters:
+      - requested_dates (list): Days to count, None counts every recorded day
+      Returns:
+      - dict: Stage to {status: days}
+      '''
+      with self._lock:
+        rows=self._conn.execute('SELECT day, stage, status FROM day_stages').fetchall()
+      days=None if requested_dates is None else {self._day(d) for d in requested_dates}
+      totals={stage: {} for stage in STAGES}
+      for day, stage, status in rows:
+        if days is None or day in days:
+          totals[stage][status]=totals[stage].get(status, 0)+1
+      return totals
@@ -1,7 +1,22 @@
 import requests
 import os
+import hashlib
+import tempfile
+import zipfile
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from src.clients.cnd_listing import CND_LISTING, dated_payload
+from src.clients.download_cache import DOWNLOAD_CACHE
+from src.clients.http_session import build_session, rate_limited_get
+from src.clients.pipeline_metrics import PIPELINE_METRICS
+from src.clients.rate_limiter import RATE_LIMITER
 
+def staged_file_name(file_id:int, file_name:str) -> str:
+    '''
+    Returns the name of an attachment in staging, prefixed by its id so files listed with the
+    same name do not overwrite each other, i.e. 1234_predespacho.xlsx
+    '''
+    return f'{file_id}_{file_name}'
 
 class CND_DOWNLOADER:
 
@@ -12,6 +27,16 @@ class CND_DOWNLOADER:
         payload: dict,
         staging_path: str,
         week_bool:bool=False,
+        rate_limiter:RATE_LIMITER=None,
+        session:requests.Session=None,
+        timeout:float=60,
+        max_download_workers:int=4,
+        download_url:str='https://sitioprivado.cnd.com.pa/Informe/Download',
+        chunk_size:int=1024*1024,
+        resume_attempts:int=3,
+        cache:DOWNLOAD_CACHE=None,
+        listing:CND_LISTING=None,
+        metrics:PIPELINE_METRICS=None
     )->None:
         '''
         Parameters:
@@ -20,12 +45,38 @@ class CND_DOWNLOADER:
         - payload (dict): A dictionary containing query parameters for the request.
         - staging_path (str): The directory path where the downloaded files will be stored.
         - week_bool (bool): Boolean that defines if it is a weekly or daily file
+        - rate_limiter (RATE_LIMITER): Optional limiter shared by every request sent to CND
+        - session (requests.Session): Keep-alive session with retries. A new one is built if None
+        - timeout (float): Timeout in seconds for each request
+        - max_download_workers (int): Number of attachments downloaded in parallel
+        - download_url (str): Url from CND to download each attachment by its id
+        - chunk_size (int): Size in bytes of the chunks streamed to disk
+        - resume_attempts (int): Times an interrupted transfer is resumed through HTTP Range requests
+        - cache (DOWNLOAD_CACHE): Optional persistent cache, a hit skips the HTTP download
+        - listing (CND_LISTING): Shared listing layer. A new one without disk cache is built if None
+        - metrics (PIPELINE_METRICS): Optional recorder of the bytes and duration of every download
         '''
         self.requested_date=requested_date
         self.base_url=base_url
-        self.payload=payload
+        self.payload=dict(payload) ## Own copy, the date parameters are set per instance
         self.staging_path=staging_path
         self.week_bool=week_bool
+        self.rate_limiter=rate_limiter
+        self.session=session if session is not None else build_session(pool_size=max_download_workers, rate_limiter=rate_limiter)
+        self.timeout=timeout
+        self.max_download_workers=max_download_workers
+        self.download_url=download_url
+        self.chunk_size=chunk_size
+        self.resume_attempts=resume_attempts
+        self.cache=cache
+        self.metrics=metrics
+        self.listing=listing if listing is not None else CND_LISTING(
+            base_url=base_url,
+            session=self.session,
+            rate_limiter=rate_limiter,
+            timeout=timeout
+        )
+        self.checksums={} ## (file_id, file_name) -> size and sha256 of the downloaded files
 
     def _adjust_header_date(self) -> dict:
       '''
@@ -35,80 +86,318 @@ class CND_DOWNLOADER:
       Returns:
       - dict: A dictionary containing the updated query parameters.
       '''
+      return dated_payload(self.payload, self.requested_date, self.week_bool)
 
-      self.payload['anio']=str(self.requested_date.year)
-      if self.week_bool:
-        self.payload['semana']=str(self.requested_date.isocalendar()[1])
-        self.payload['dia']='0'
-        self.payload['mes']='0'
-      else:
-        self.payload['semana']='0'
-        self.payload['dia']=str(self.requested_date.day)
-        self.payload['mes']=str(self.requested_date.month)
-      return self.payload
+    def _get(self, url:str, params:dict, **kwargs) -> requests.Response:
+      '''
+      This function sends a GET request to CND through the shared session and the
+      rate limiter, if any.
+      Parameters:
+      - url (str): Url of the request
+      - params (dict): Query parameters of the request
+      - kwargs: Extra arguments for requests.Session.get
+      Returns:
+      - requests.Response: Response of the request
+      '''
+      return rate_limited_get(self.session, url, params, rate_limiter=self.rate_limiter, timeout=self.timeout, **kwargs)
 
-    def cnd_file_download(self) -> list:
+    def _file_metadata(self) -> list:
         '''
-        Downloads files from the CND site based on the provided parameters.
-
-        Parameters:
-        - self: From class initialization
+        Lists the attachments of the requested date.
 
         Returns:
-        - list: A list of tuples, where each tuple contains:
-            - file_id (int): The ID of the file.
-            - file_name (str): The name of the file (extracted from its path).
-            - epoch_public_date (str): The file's public release date in epoch format.
+        - list: Tuples of file_id, file_name and fecha_publica.
 
         Raises:
-        - Exception: If the metadata request or file download fails.
+        - Exception: If the metadata request fails or nothing is listed.
         '''
         self.payload=self._adjust_header_date()
 
         try:
-            # Send the GET request to the API to retrieve metadata
-            response = requests.get(self.base_url, params=self.payload)
+            # Retrieve every page of the metadata, from the listing cache when possible
+            records = self.listing.list_files(self.payload)
 
-            # Check for a successful response
-            if response.status_code != 200 or response.json()==[]:
-                raise Exception(f'Failed to retrieve metadata. HTTP Status Code: {response.status_code}, Message: {response.text}')
+            # Check for a non empty listing
+            if records == []:
+                raise Exception(f'Failed to retrieve metadata. No files listed for {self.requested_date}')
 
             # Extract file metadata from the JSON response
-            file_metadata = [
+            return [
                 (r['id'],
                  os.path.basename(r['adjunto']['path']).split('\\')[-1],
                  r['fechaPublica']
                  )
-                for r in response.json()
+                for r in records
             ]
         except requests.exceptions.RequestException as e:
             raise Exception(f'Request error occurred while retrieving metadata: {e}')
         except Exception as e:
             raise Exception(f'Error occurred while fetching metadata: {e}')
 
+    def cnd_file_download(self) -> list:
+        '''
+        Downloads files from the CND site based on the provided parameters.
+
+        Parameters:
+        - self: From class initialization
+
+        Returns:
+        - list: A list of tuples, where each tuple contains:
+            - file_id (int): The ID of the file.
+            - file_name (str): The name of the file (extracted from its path).
+            - epoch_public_date (str): The file's public release date in epoch format.
+
+        Raises:
+        - Exception: If the metadata request or file download fails.
+        '''
+        file_metadata = self._file_metadata()
+
         # If the metadata request succeeded, proceed to download the files
-        download_url = 'https://sitioprivado.cnd.com.pa/Informe/Download'
+        # Ensure the storage path exists
+        os.makedirs(self.staging_path, exist_ok=True)
+
+        # Download the attachments in parallel
+        with ThreadPoolExecutor(max_workers=max(1, self.max_download_workers)) as executor:
+            futures = [
+                executor.submit(self._download_file, file_id, file_name, fecha_publica)
+                for file_id, file_name, fecha_publica in file_metadata
+            ]
+            for future in futures:
+                future.result()
+
+        return file_metadata
+
+    def cnd_file_download_buffers(self, spool_max_bytes:int=64*1024**2) -> tuple:
+        '''
+        Downloads the files of the requested date into spooled buffers instead of staging_path.
+        A buffer stays in memory up to spool_max_bytes and spills to a temporary file above it.
+        The download cache is not used, nothing is written to staging_path.
 
-        # Download each file
-        for file_id, file_name, _ in file_metadata:
+        Parameters:
+        - spool_max_bytes (int): Size above which a buffer spills to a temporary file.
+
+        Returns:
+        - tuple: List of (file_id, file_name, fecha_publica) and dict of (file_id, file_name) to its buffer,
+          positioned at the start.
+        '''
+        file_metadata = self._file_metadata()
+        buffers = {(file_id, file_name): tempfile.SpooledTemporaryFile(max_size=spool_max_bytes) for file_id, file_name, _ in file_metadata}
+
+        with ThreadPoolExecutor(max_workers=max(1, self.max_download_workers)) as executor:
+            futures = [
+                executor.submit(self._download_buffer, file_id, file_name, buffers[(file_id, file_name)])
+                for file_id, file_name, _ in file_metadata
+            ]
             try:
-                file_payload = {'key': self.payload['key']}
-                file_response = requests.get(f'{download_url}/{file_id}', params=file_payload)
+                for future in futures:
+                    future.result()
+            except Exception:
+                for buffer in buffers.values():
+                    buffer.close()
+                raise
 
-                # Check if file download was successful
-                if file_response.status_code != 200:
-                    raise Exception(f'Error downloading file {file_name}. HTTP Status Code: {file_response.status_code}')
+        return file_metadata, buffers
 
-                # Ensure the storage path exists
-                os.makedirs(self.staging_path, exist_ok=True)
+    def _stream_to_part(self, file_id:int, file_name:str, part_path:str) -> int:
+        '''
+        Streams an attachment into its .part file in fixed-size chunks. If the .part
+        file already exists the transfer resumes from its size through an HTTP Range request.
 
-                # Save the file to disk
-                with open(f'{self.staging_path}/{file_name}', 'wb') as f:
-                    f.write(file_response.content)
+        Parameters:
+        - file_id (int): The ID of the file.
+        - file_name (str): The name of the file (extracted from its path).
+        - part_path (str): Temporary path of the file while it is downloaded.
 
-                print(f'Downloaded {file_name} to {self.staging_path}')
+        Returns:
+        - int: Expected size of the file in bytes, None if the server did not share it.
 
+        Raises:
+        - Exception: If the server answers with an unexpected status.
+        '''
+        with open(part_path, 'ab') as f:
+            return self._stream_to(file_id, file_name, f)
+
+    def _stream_to(self, file_id:int, file_name:str, target) -> int:
+        '''
+        Streams an attachment into a binary file or buffer in fixed-size chunks. The transfer
+        resumes from the bytes already in target through an HTTP Range request.
+
+        Parameters:
+        - file_id (int): The ID of the file.
+        - file_name (str): The name of the file (extracted from its path).
+        - target: Seekable binary file or buffer receiving the content.
+
+        Returns:
+        - int: Expected size of the file in bytes, None if the server did not share it.
+
+        Raises:
+        - Exception: If the server answers with an unexpected status.
+        '''
+        offset = target.seek(0, os.SEEK_END)
+        headers = {'Accept-Encoding': 'identity'}
+        if offset > 0:
+            headers['Range'] = f'bytes={offset}-'
+
+        file_payload = {'key': self.payload['key']}
+        with self._get(f'{self.download_url}/{file_id}', params=file_payload, headers=headers, stream=True) as file_response:
+
+            # The partial content is not valid for the server, start over
+            if file_response.status_code == 416:
+                target.seek(0)
+                target.truncate()
+                return self._stream_to(file_id, file_name, target)
+
+            # Check if file download was successful
+            if file_response.status_code not in (200, 206):
+                raise Exception(f'Error downloading file {file_name}. HTTP Status Code: {file_response.status_code}')
+
+            if file_response.status_code == 206:
+                content_range = file_response.headers.get('Content-Range', '')
+                total = content_range.split('/')[-1]
+                expected_size = int(total) if total.isdigit() else None
+            else:
+                ## Server ignored the Range header, the whole file is sent again
+                target.seek(0)
+                target.truncate()
+                content_length = file_response.headers.get('Content-Length')
+                expected_size = int(content_length) if content_length is not None and content_length.isdigit() else None
+
+            for chunk in file_response.iter_content(chunk_size=self.chunk_size):
+                if chunk:
+                    target.write(chunk)
+
+        return expected_size
+
+    def _verify_file(self, file_name:str, part_path, expected_size:int) -> dict:
+        '''
+        Checks size and integrity of a downloaded file before the parser touches it.
+
+        Parameters:
+        - file_name (str): The name of the file (extracted from its path).
+        - part_path: Temporary path of the downloaded file, or the buffer holding it.
+        - expected_size (int): Size announced by the server, None if unknown.
+
+        Returns:
+        - dict: Size in bytes and sha256 hex digest of the file.
+
+        Raises:
+        - Exception: If the size does not match or the zip archive is corrupted.
+        '''
+        if isinstance(part_path, str):
+            with open(part_path, 'rb') as f:
+                return self._verify_file(file_name, f, expected_size)
+
+        size = part_path.seek(0, os.SEEK_END)
+        if expected_size is not None and size != expected_size:
+            raise Exception(f'Size mismatch for {file_name}. Expected {expected_size} bytes, got {size}')
+
+        ## zip and xlsx files carry a CRC per member
+        if zipfile.is_zipfile(part_path):
+            with zipfile.ZipFile(part_path) as zip_ref:
+                bad_member = zip_ref.testzip()
+            if bad_member is not None:
+                raise Exception(f'Corrupted member {bad_member} in {file_name}')
+
+        sha256 = hashlib.sha256()
+        part_path.seek(0)
+        for chunk in iter(lambda: part_path.read(self.chunk_size), b''):
+            sha256.update(chunk)
+        part_path.seek(0)
+
+        return {'size': size, 'sha256': sha256.hexdigest()}
+
+    def _download_file(self, file_id:int, file_name:str, fecha_publica:str=None) -> None:
+        '''
+        Downloads a single attachment from CND into the staging path. The file is streamed
+        to a temporary .part file, verified and renamed on completion, so memory use stays
+        flat and an interrupted transfer is resumed instead of starting over.
+
+        Parameters:
+        - file_id (int): The ID of the file.
+        - file_name (str): The name of the file (extracted from its path).
+        - fecha_publica (str): The file's public release date, used as cache key with file_id.
+
+        Raises:
+        - Exception: If the file download fails.
+        '''
+        if self.metrics is None:
+            self._fetch_file(file_id, file_name, fecha_publica)
+            return
+
+        with self.metrics.timer('download', date=self.requested_date, file_id=file_id, file_name=file_name) as event:
+            event['cached'] = self._fetch_file(file_id, file_name, fecha_publica)
+            event['bytes'] = os.path.getsize(f'{self.staging_path}/{staged_file_name(file_id, file_name)}')
+
+    def _fetch_file(self, file_id:int, file_name:str, fecha_publica:str) -> bool:
+        '''
+        Restores the file from the cache or downloads it. Returns True on a cache hit.
+        '''
+        file_path = f'{self.staging_path}/{staged_file_name(file_id, file_name)}'
+        part_path = f'{file_path}.part'
+
+        if self.cache is not None and self.cache.get_file(file_id, fecha_publica, file_path):
+            print(f'Cache hit for {file_name}, skipping download')
+            return True
+
+        for attempt in range(self.resume_attempts + 1):
+            try:
+                expected_size = self._stream_to_part(file_id, file_name, part_path)
+                break
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                ## Keep the .part file, next attempt resumes from it
+                if attempt == self.resume_attempts:
+                    raise Exception(f'Error occurred while downloading {file_name}: {e}')
+                print(f'Transfer of {file_name} interrupted, resuming: {e}')
             except requests.exceptions.RequestException as e:
                 raise Exception(f'Error occurred while downloading {file_name}: {e}')
 
-        return file_metadata
+        try:
+            self.checksums[(file_id, file_name)] = self._verify_file(file_name, part_path, expected_size)
+        except Exception:
+            os.remove(part_path)
+            raise
+
+        os.replace(part_path, file_path)
+        print(f'Downloaded {file_name} to {self.staging_path}')
+
+        if self.cache is not None:
+            self.cache.put_file(file_id, fecha_publica, file_path, sha256=self.checksums[(file_id, file_name)]['sha256'])
+        return False
+
+    def _download_buffer(self, file_id:int, file_name:str, buffer) -> None:
+        '''
+        Downloads a single attachment from CND into a buffer, resuming interrupted transfers
+        from the bytes already received. The buffer is verified and left at its start.
+
+        Parameters:
+        - file_id (int): The ID of the file.
+        - file_name (str): The name of the file (extracted from its path).
+        - buffer: Seekable binary buffer receiving the content.
+
+        Raises:
+        - Exception: If the file download fails.
+        '''
+        if self.metrics is None:
+            self._fetch_buffer(file_id, file_name, buffer)
+            return
+
+        with self.metrics.timer('download', date=self.requested_date, file_id=file_id, file_name=file_name, in_memory=True) as event:
+            self._fetch_buffer(file_id, file_name, buffer)
+            event['cached'] = False
+            event['bytes'] = self.checksums[(file_id, file_name)]['size']
+
+    def _fetch_buffer(self, file_id:int, file_name:str, buffer) -> None:
+        for attempt in range(self.resume_attempts + 1):
+            try:
+                expected_size = self._stream_to(file_id, file_name, buffer)
+                break
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                ## Keep the received bytes, next attempt resumes from them
+                if attempt == self.resume_attempts:
+                    raise Exception(f'Error occurred while downloading {file_name}: {e}')
+                print(f'Transfer of {file_name} interrupted, resuming: {e}')
+            except requests.exceptions.RequestException as e:
+                raise Exception(f'Error occurred while downloading {file_name}: {e}')
+
+        self.checksums[(file_id, file_name)] = self._verify_file(file_name, buffer, expected_size)
+        print(f'Downloaded {file_name} to memory')
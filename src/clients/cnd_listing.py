@@ -0,0 +1,215 @@
+import json
+import os
+import threading
+import time
+import requests
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from src.clients.http_session import build_session, rate_limited_get
+from src.clients.pipeline_metrics import PIPELINE_METRICS
+from src.clients.rate_limiter import RATE_LIMITER
+
+CACHE_KEY_FIELDS = ('categoria', 'tipo', 'anio', 'mes', 'dia', 'semana')
+
+def dated_payload(payload:dict, requested_date:datetime, week_bool:bool=False) -> dict:
+    '''
+    Adds the date parameters of GetListOperativosComerciales to a copy of the payload.
+    Parameters:
+    - payload (dict): A dictionary containing query parameters for the request.
+    - requested_date (datetime): Reference date of the listing
+    - week_bool (bool): Boolean that defines if it is a weekly or daily file
+    Returns:
+    - dict: A dictionary containing the updated query parameters.
+    '''
+    payload=dict(payload)
+    payload['anio']=str(requested_date.year)
+    if week_bool:
+        ## Week and year of the same ISO calendar, as plan_weekly_backfill
+        payload['anio']=str(requested_date.isocalendar()[0])
+        payload['semana']=str(requested_date.isocalendar()[1])
+        payload['dia']='0'
+        payload['mes']='0'
+    else:
+        payload['semana']='0'
+        payload['dia']=str(requested_date.day)
+        payload['mes']=str(requested_date.month)
+    return payload
+
+
+class CND_LISTING:
+
+    def __init__(
+        self,
+        base_url:str,
+        session:requests.Session=None,
+        rate_limiter:RATE_LIMITER=None,
+        timeout:float=60,
+        cache_path:str=None,
+        ttl_seconds:float=3600,
+        stable_after_days:int=7,
+        page_size:int=None,
+        max_pages:int=50,
+        metrics:PIPELINE_METRICS=None
+    )->None:
+        '''
+        Listing layer for GetListOperativosComerciales. It follows the pagination to the end
+        and caches every listing per (categoria, tipo, anio, mes, dia, semana).
+        Parameters:
+        - base_url (str): Url of GetListOperativosComerciales
+        - session (requests.Session): Keep-alive session with retries. A new one is built if None
+        - rate_limiter (RATE_LIMITER): Optional limiter shared by every request sent to CND
+        - timeout (float): Timeout in seconds for each request
+        - cache_path (str): Directory for the listing cache. None keeps it only in memory
+        - ttl_seconds (float): Time to live of the listings of recent days
+        - stable_after_days (int): Listings of days older than this never expire
+        - page_size (int): Records per full page, if CND paginates the listing. None lists page 0 only
+        - max_pages (int): Safety limit of pages followed for one listing
+        - metrics (PIPELINE_METRICS): Optional recorder of the latency of every listing
+        '''
+        self.base_url=base_url
+        self.session=session if session is not None else build_session(rate_limiter=rate_limiter)
+        self.rate_limiter=rate_limiter
+        self.timeout=timeout
+        self.cache_path=cache_path
+        self.ttl_seconds=ttl_seconds
+        self.stable_after_days=stable_after_days
+        self.page_size=page_size
+        self.max_pages=max_pages
+        self.metrics=metrics
+        self._memory={}
+        self._lock=threading.Lock()
+
+        if cache_path is not None:
+            os.makedirs(cache_path, exist_ok=True)
+
+    def _cache_key(self, payload:dict) -> str:
+      return '_'.join(str(payload.get(k, '0')) for k in CACHE_KEY_FIELDS)
+
+    def _listed_until(self, payload:dict) -> datetime:
+      '''
+      This function returns the last day covered by a listing.
+      '''
+      if str(payload.get('semana', '0')) != '0':
+        ## CND weeks run from Saturday to Friday
+        try:
+          return datetime.fromisocalendar(int(payload['anio']), int(payload['semana']), 6)+timedelta(days=6)
+        except ValueError:
+          return datetime(int(payload['anio']), 12, 31)
+      return datetime(int(payload['anio']), int(payload['mes']), int(payload['dia']))
+
+    def _is_fresh(self, entry:dict, payload:dict) -> bool:
+      '''
+      This function checks the TTL of a cached listing. A listing fetched more than
+      stable_after_days after the end of its range never expires, CND does not publish
+      those days anymore. Listings fetched earlier expire after ttl_seconds.
+      '''
+      listed_until=self._listed_until(payload)+timedelta(days=1)
+      if datetime.fromtimestamp(entry['fetched_at'])-listed_until > timedelta(days=self.stable_after_days):
+        return True
+      return time.time()-entry['fetched_at'] < self.ttl_seconds
+
+    def _read_cache(self, key:str) -> dict:
+      with self._lock:
+        entry=self._memory.get(key)
+      if entry is None and self.cache_path is not None and os.path.exists(f'{self.cache_path}/{key}.json'):
+        with open(f'{self.cache_path}/{key}.json') as f:
+          entry=json.load(f)
+        with self._lock:
+          self._memory[key]=entry
+      return entry
+
+    def _write_cache(self, key:str, records:list) -> None:
+      entry={'fetched_at': time.time(), 'records': records}
+      with self._lock:
+        self._memory[key]=entry
+      if self.cache_path is not None:
+        tmp_path=f'{self.cache_path}/{key}.json.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+          json.dump(entry, f)
+        os.replace(tmp_path, f'{self.cache_path}/{key}.json')
+
+    def _fetch_page(self, payload:dict, page:int) -> list:
+      '''
+      This function fetches a single page of the listing.
+      '''
+      params=dict(payload)
+      params['page']=str(page)
+      try:
+        response=rate_limited_get(self.session, self.base_url, params, rate_limiter=self.rate_limiter, timeout=self.timeout)
+      except requests.exceptions.RequestException as e:
+        raise Exception(f'Request error occurred while retrieving metadata: {e}')
+
+      if response.status_code != 200:
+        raise Exception(f'Failed to retrieve metadata. HTTP Status Code: {response.status_code}, Message: {response.text}')
+      return response.json()
+
+    def _fetch_all_pages(self, payload:dict) -> list:
+      '''
+      This function follows the pagination of a listing. Without page_size the listing is page 0
+      alone, as CND lists the files of a day in one page. With page_size a page is requested only
+      after a full one, so a listing that fits in page 0 costs a single request.
+      '''
+      records=self._fetch_page(payload, 0)
+      if self.page_size is None or len(records) < self.page_size:
+        return records
+
+      seen_ids={r['id'] for r in records}
+      for page in range(1, self.max_pages):
+        result=self._fetch_page(payload, page)
+        new_records=[r for r in result if r['id'] not in seen_ids]
+        ## An empty page, or the server ignoring the page parameter, ends the listing
+        if new_records == []:
+          return records
+        seen_ids.update(r['id'] for r in new_records)
+        records.extend(new_records)
+        if len(result) < self.page_size:
+          return records
+
+      print(f'[Error] Listing {self._cache_key(payload)} reached {self.max_pages} pages, it may be incomplete')
+      return records
+
+    def list_files(self, payload:dict) -> list:
+      '''
+      This function returns every record of a listing, from the cache when it is fresh.
+      Parameters:
+      - payload (dict): Query parameters of the request, including the date parameters
+      Returns:
+      - list: Records of the listing as returned by CND
+      '''
+      start=time.perf_counter()
+      key=self._cache_key(payload)
+      entry=self._read_cache(key)
+      if entry is not None and self._is_fresh(entry, payload):
+        if self.metrics is not None:
+          self.metrics.record('listing', key=key, seconds=time.perf_counter()-start, records=len(entry['records']), cached=True)
+        return entry['records']
+
+      records=self._fetch_all_pages(payload)
+      ## Empty listings are not cached, the files of the day may not be published yet
+      if records != []:
+        self._write_cache(key, records)
+      if self.metrics is not None:
+        self.metrics.record('listing', key=key, seconds=time.perf_counter()-start, records=len(records), cached=False)
+      return records
+
+    def prefetch(self, payload:dict, requested_dates:list, week_bool:bool=False, max_workers:int=4) -> dict:
+      '''
+      This function lists a whole backfill range concurrently, so later lookups are served from cache.
+      Parameters:
+      - payload (dict): Query parameters of the request, without the date parameters
+      - requested_dates (list): Dates of the backfill
+      - week_bool (bool): Boolean that defines if it is a weekly or daily file
+      - max_workers (int): Number of listings fetched concurrently
+      Returns:
+      - dict: Records of the listing per requested date, None for the listings that failed.
+        They are not days without files
+      '''
+      def _list(requested_date:datetime) -> list:
+        try:
+          return self.list_files(dated_payload(payload, requested_date, week_bool))
+        except Exception as e:
+          print(f'[Error] Failed to prefetch listing for {requested_date}: {e}')
+          return None
+
+      with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        return dict(zip(requested_dates, executor.map(_list, requested_dates)))
@@ -1,8 +1,38 @@
+import io
 import os
+import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
 import re
+import shutil
+import tempfile
+import time
 import zipfile
+from src.clients.parquet_writer import HOURLY_COLUMN_PATTERN, PARQUET_WRITER
+from src.clients.revision_index import REVISION_INDEX
+from src.clients.schema_registry import COLUMN_TRANSLATION, SCHEMA_REGISTRY, get_registry
+
+## Version of the parsed outputs, parsed outputs cached with another version are not reused
+OUTPUT_VERSION = 'v2'
+
+## Columns kept on every row of the long layout, besides the unit column
+LONG_ID_COLUMNS = ['fecha', 'file_id', 'file_name', 'epoch_public_date', 'change_type', 'revision']
+
+def cnd_sheet_number(requested_date:datetime) -> int:
+    '''
+    Fixes the weekday number based on CND's logic, CND weeks run from Saturday to Friday
+    Friday =7, Saturday=1, Sunday=2, Monday=3, Tuesday=4, Wednesday=5, Thursday=6
+    Parameters:
+    - requested_date (datetime): The date for which the weekday needs to be determined.
+    Returns:
+    - int: The weekday number based on CND's logic.
+    '''
+    weekday=requested_date.weekday()
+    if weekday <= 4:
+      weekday+=3
+    else:
+      weekday-=4
+    return weekday
 
 class CND_PARSER:
 
@@ -10,20 +40,53 @@ class CND_PARSER:
       self,
       file_metadata:list,
       file_path:str,
-      staging_path: str
+      staging_path: str,
+      engine:str=None,
+      member_pattern:str=r'\.xls[xmb]?$',
+      spool_max_bytes:int=64*1024**2,
+      writer:PARQUET_WRITER=None,
+      output_layout:str='wide',
+      schema_registry:SCHEMA_REGISTRY=None,
+      in_memory:bool=False,
+      revision_index:REVISION_INDEX=None
     )->None:
         '''
         Parameters:
-        - file_path (str): Path of the file for parsing
+        - file_path (str): Path of the file for parsing, or a seekable binary buffer with its content
         - file_metadata (dict): Metadata of the downloaded files from CND.
             - file_id (int): The ID of the file.
             - file_name (str): The name of the file (extracted from its path).
             - epoch_public_date (str): The file's public release date in epoch format.
         - staging_path (str): staging path where the downloaded files are located.
+        - engine (str): Engine used by pandas to read the workbook, i.e. 'calamine'. None lets pandas choose
+        - member_pattern (str): Regexp for the workbook members of zip files
+        - spool_max_bytes (int): Zip members bigger than this are spooled to a temporary file instead of memory
+        - writer (PARQUET_WRITER): Writer of the parsed files. Defaults to zstd with the predispatch schema
+        - output_layout (str): 'wide' keeps the hourly columns, 'long' writes one row per unit,
+          fecha and hour interval, 'both' writes both from the same parse
+        - schema_registry (SCHEMA_REGISTRY): Layouts of the sheets. Defaults to the in memory registry of the process
+        - in_memory (bool): Keeps the outputs in output_buffers, output path to its Parquet bytes,
+          instead of writing them to disk
+        - revision_index (REVISION_INDEX): Versions of the days already ingested. With it only the rows
+          inserted, updated or deleted since the previous version of a day are written, as
+          <prefix>_delta_<file> outputs with change_type and revision columns
         '''
         self.file_path=file_path
         self.file_metadata=file_metadata
         self.staging_path=staging_path
+        self.engine=engine
+        self.member_pattern=member_pattern
+        self.spool_max_bytes=spool_max_bytes
+        self.writer=writer if writer is not None else PARQUET_WRITER()
+        if output_layout not in ('wide', 'long', 'both'):
+          raise Exception(f'Unknown output layout {output_layout}, use wide, long or both')
+        self.output_layout=output_layout
+        self.in_memory=in_memory
+        self.revision_index=revision_index
+        self.output_buffers={} ## output path -> bytes of every output kept in memory
+        self.schema_registry=schema_registry if schema_registry is not None else get_registry()
+        self.parse_seconds=None
+        self.output_stats=[] ## path, rows, columns and bytes of every written output
 
     def _sheetname(self,requested_date:datetime) ->str:
       '''
@@ -34,12 +97,7 @@ class CND_PARSER:
       Returns:
       - int: The weekday number based on CND's logic.
       '''
-      weekday=requested_date.weekday()
-      if weekday <= 4:
-        weekday+=3
-      else:
-        weekday-=4
-      return weekday
+      return cnd_sheet_number(requested_date)
 
     def _adding_metadata(self, df:pd.DataFrame)-> pd.DataFrame:
       '''
@@ -56,106 +114,297 @@ class CND_PARSER:
       df['epoch_public_date']=epoch
       return df
 
-    def _unzipping(self,output_staging_path:str)->None:
-      zip_ref = zipfile.ZipFile(self.file_path, 'r')
-      zip_ref.extractall(f'{output_staging_path}')
-      zip_ref.close()
+    def _workbook_members(self)->list:
+      '''
+      This function reads the workbook members of a zip file straight from the archive,
+      without extracting them to disk. Members are sorted by name so the order is deterministic.
+      Returns:
+      - list: Tuples of member name and a buffer with its content
+      '''
+      members=[]
+      with zipfile.ZipFile(self.file_path, 'r') as zip_ref:
+        for member in sorted(zip_ref.infolist(), key=lambda m: m.filename):
+          if member.is_dir() or member.filename.startswith('__MACOSX/') \
+            or not re.search(string=member.filename, pattern=self.member_pattern, flags=re.IGNORECASE):
+            continue
+
+          ## Small members stay in memory, big ones spill to a temporary file
+          buffer=tempfile.SpooledTemporaryFile(max_size=self.spool_max_bytes)
+          with zip_ref.open(member) as f:
+            shutil.copyfileobj(f, buffer)
+          buffer.seek(0)
+          members.append((member.filename, buffer))
+      return members
 
     def _rename_columns(self, df:pd.DataFrame, hours_cols_bool:bool = False) -> pd.DataFrame:
       '''
       This function removes special characters, white spaces to '', - to _ and $ to USD
       ''' 
       keys = df.columns.to_list()
-      cols = [
-          x.translate(str.maketrans({
-              "-": "_", 
-              " ": "", 
-              "(": "", 
-              ")": "", 
-              "[": "", 
-              "]": "", 
-              "$": "_USD"})).strip().lower()
-          for x in keys
-      ]
+      cols = [x.translate(COLUMN_TRANSLATION).strip().lower() for x in keys]
 
       if hours_cols_bool: ## This is to change 1_2 column to h1_2 or 0 to h0, pretty common in CNDs files
         cols=[f'h{x}' if x[0].isdigit() else x for x in cols]
-      
+
       cleaned_columns = {k:v for (k,v) in zip(keys,cols)}
       
       return df.rename(columns=cleaned_columns)
 
+    def _to_long(self, df:pd.DataFrame) -> pd.DataFrame:
+      '''
+      This function reshapes the hourly columns to one row per unit, fecha and hour interval,
+      with the timestamp of the start of the interval. The hourly block is stacked in a single
+      vectorized operation, the id columns are tiled once per hour.
+      Parameters:
+      - df: Parsed dataframe with renamed columns
+      Returns:
+      - df: Long dataframe with hour_interval, value and interval_start columns
+      '''
+      hour_cols=[c for c in df.columns if re.search(string=c, pattern=HOURLY_COLUMN_PATTERN)]
+      id_cols=[df.columns[0]]+[c for c in LONG_ID_COLUMNS if c in df.columns]
+      n_rows, n_hours=len(df), len(hour_cols)
+
+      hour_starts=np.array([int(re.search(string=c, pattern='[0-9]+')[0]) for c in hour_cols])
+      values=df[hour_cols].apply(pd.to_numeric, errors='coerce').to_numpy(dtype='float32')
+      fecha=pd.to_datetime(df['fecha'], errors='coerce').to_numpy()
+
+      long_df=pd.DataFrame({c: np.tile(df[c].to_numpy(), n_hours) for c in id_cols})
+      long_df['hour_interval']=pd.Categorical.from_codes(np.repeat(np.arange(n_hours), n_rows), categories=hour_cols)
+      long_df['value']=values.ravel(order='F') ## Column by column, matching the tiled id columns
+      long_df['interval_start']=np.tile(fecha, n_hours)+np.repeat(hour_starts, n_rows).astype('timedelta64[h]')
+      return long_df
+
+    def _read_sheet(self, excel_file:pd.ExcelFile, sheet_name:str, header:int, location:str=None) -> tuple:
+      '''
+      This function finds the layout of the sheet in the schema registry from its top rows, then
+      reads only the used columns of the layout below its header, named after the layout. Known
+      layouts pass their cached dtypes to the reader, new ones are inferred like pd.read_excel does.
+      The date fecha is taken from the first column below the title row.
+      Parameters:
+      - excel_file: Opened workbook
+      - sheet_name: Name of the sheet
+      - header: Expected header row, None detects it
+      - location: File, or archive and member, for messages
+      Returns:
+      - tuple: Parsed dataframe, with cleaned column names, and parsed date
+      '''
+      top = excel_file.parse(sheet_name=sheet_name, header=None, nrows=self.schema_registry.scan_rows)
+      parsed_date = top.iat[1, 0]
+      rows = top.astype(object).where(top.notna(), None).values.tolist()
+      fingerprint, layout = self.schema_registry.resolve(rows, header=header, location=f'{location} {sheet_name}')
+
+      read_kwargs = dict(
+        sheet_name=sheet_name,
+        header=None,
+        skiprows=layout['header_row']+1,
+        usecols=layout['usecols'],
+        names=layout['columns']
+      )
+      dtypes = self.schema_registry.dtype_hints(fingerprint)
+      df = None
+      if dtypes:
+        try:
+          df = excel_file.parse(dtype=dtypes, **read_kwargs)
+        except (ValueError, TypeError) as e:
+          ## The cached dtypes do not fit this sheet, i.e. text in a numeric column
+          print(f'[Info] Dtypes of layout {fingerprint} do not fit {location} {sheet_name}: {e}')
+      if df is None:
+        df = excel_file.parse(**read_kwargs)
+        if not dtypes:
+          self.schema_registry.record_dtypes(fingerprint, df)
+      return df, parsed_date
+
+    def _day_sheet(self, sheet_names:list, requested_date:datetime) -> str:
+      '''
+      This function finds the sheet of a day, using the function _sheetname that let us get
+      the name with CND's logic.
+      Returns:
+      - str: Name of the sheet, None if the workbook does not have it
+      '''
+      sheet_day=str(self._sheetname(requested_date))
+      print(f'Getting {sheet_day}')
+      sheet=[s for s in sheet_names if re.search(string=s, pattern=sheet_day)]
+      return sheet[0] if sheet else None
+
+    def _parse_day(
+      self,
+      excel_file:pd.ExcelFile,
+      sheet_name:str,
+      header:int,
+      output_dir:str,
+      output_prefix:str,
+      output_name:str,
+      location:str
+    )-> list:
+      '''
+      This function parses the sheet of a single day from an opened workbook and saves it in output_dir.
+      Wide and long layouts are produced from the same parse.
+      Parameters:
+      - excel_file: Opened workbook
+      - sheet_name: Sheet of the day
+      - header: Expected header row of the sheet, it is detected when the layout differs. None always detects it
+      - output_dir: Directory where the parsed files are saved
+      - output_prefix: Prefix of the output file
+      - output_name: Name of the output file after the prefix, also the source of the day in the revision index
+      - location: File, or archive and member, for error messages
+      Returns:
+      - list: Paths of the written outputs
+      '''
+      ## Parsing date fecha and data in a single read of the target sheet
+      try:
+        df, parsed_date = self._read_sheet(excel_file, sheet_name, header, location)
+      except Exception as e:
+        raise Exception(f'Error occurred while reading {location}: {e}')
+
+      df['fecha'] = parsed_date ## Adding parsed date
+      df=self._adding_metadata(df)
+
+      revision=None
+      if self.revision_index is not None:
+        ## Compared on the declared schema, so the hashes do not depend on how the sheet was read
+        df, revision=self.revision_index.diff(self.writer.coerce_schema(df), df.columns[0], source=output_name)
+        if len(df) == 0:
+          print(f'[Info] {location} unchanged since the previous version of {revision["day"]}')
+          self.revision_index.commit(revision, [])
+          return []
+        output_prefix=f'{output_prefix}_delta'
+
+      ## Column names come cleaned from the layout of the schema registry
+      #df.to_csv(f'{self.staging_path}/{output_prefix}_{filename.lower()}.csv.gz',
+      #          index=False,
+      #          compression='gzip')
+      if not self.in_memory:
+        os.makedirs(output_dir, exist_ok=True)
+      output_paths=[]
+      outputs=[]
+      if self.output_layout in ('wide', 'both'):
+        outputs.append((f'{output_dir}/{output_prefix}_{output_name}{self.writer.extension}', df))
+      if self.output_layout in ('long', 'both'):
+        outputs.append((f'{output_dir}/{output_prefix}_long_{output_name}{self.writer.extension}', self._to_long(df)))
+      for output_path, output_df in outputs:
+        if self.in_memory:
+          ## Parquet goes straight to a buffer, ready for the upload
+          buffer=io.BytesIO()
+          self.writer.write(output_df, buffer)
+          self.output_buffers[output_path]=buffer.getvalue()
+          output_bytes=len(self.output_buffers[output_path])
+        else:
+          self.writer.write(output_df, output_path)
+          output_bytes=os.path.getsize(output_path)
+        output_paths.append(output_path)
+        self.output_stats.append({
+          'path': output_path,
+          'rows': len(output_df),
+          'columns': len(output_df.columns),
+          'bytes': output_bytes
+        })
+      if revision is not None:
+        self.revision_index.commit(revision, output_paths)
+        print(f'[Info] Revision {revision["revision"]} of {revision["day"]}: {revision["counts"]}')
+      return output_paths
 
     def parse_predispatch(
       self,
       requested_date:datetime,
       header:int,
       output_prefix:str
-    )-> None:
+    )-> list:
       '''
       This function parses the predispatch file. It unzip file if necessary and parse
       based on sheetname. In addition, uses the function __sheetname that let us get
       the name with CND's logic. The parsed file is saved in the staging path.
       Parameters:
       - requested_date: Date of the file
-      - header: Header of the dataframe
+      - header: Expected header row of the sheet, it is detected when the layout differs. None always detects it
       - output_prefix: Prefix of the output file
       Returns:
-      - None
+      - list: Paths of the written outputs
       '''
+      return self.parse_predispatch_days(
+        requested_dates=[requested_date],
+        header=header,
+        output_prefix=output_prefix
+      )
 
-      ## Unzipping file if necessary
-      if self.file_path.endswith('.zip'):
-        staging_path_unzip=f'{self.staging_path}/UNZIP'
+    def parse_predispatch_days(
+      self,
+      requested_dates:list,
+      header:int,
+      output_prefix:str,
+      output_dirs:dict=None
+    )-> list:
+      '''
+      This function parses the sheets of several days from a single open of the workbook.
+      Weekly files carry the seven "Día N" sheets, so a whole week is extracted at once.
+      Parameters:
+      - requested_dates: Dates of the sheets to parse
+      - header: Expected header row of the sheet, it is detected when the layout differs. None always detects it
+      - output_prefix: Prefix of the output file
+      - output_dirs: Directory per requested date for the outputs. Defaults to the staging path
+      Returns:
+      - list: Paths of the written outputs
+      '''
+      output_dirs = output_dirs or {}
+      filename=self.file_metadata[1].split('.')[0]
+      start = time.perf_counter()
+      ## Buffers are named after the file of the listing
+      file_name = self.file_path if isinstance(self.file_path, str) else self.file_metadata[1]
+      if not isinstance(self.file_path, str):
+        self.file_path.seek(0)
 
+      ## Zip members are read straight from the archive, without extracting them
+      if file_name.lower().endswith('.zip'):
         try:
-          self._unzipping(staging_path_unzip)
+          sources=self._workbook_members()
         except Exception as e:
-          raise Exception(f'Error occurred while unzipping {self.file_path}: {e}')
-
-        flist=os.listdir(staging_path_unzip)
-        if flist==[]:
-          raise Exception(f'Error occurred while unzipping {self.file_path}: {e}')
-        else:
-          flist = [f'{staging_path_unzip}/{f}' for f in flist]
-          self.file_path=flist[0]
-
-      # Load the Excel file
-      try:
-        excel_file = pd.ExcelFile(self.file_path)
-      except Exception as e:
-        raise Exception(f'Error occurred while loading {self.file_path}: {e}')
+          raise Exception(f'Error occurred while unzipping {file_name}: {e}')
+        if sources==[]:
+          raise Exception(f'Error occurred while unzipping {file_name}: no workbook found')
+      else:
+        sources=[(None, self.file_path)]
 
-      # Get the sheet names
-      sheet_names = excel_file.sheet_names
-      print(f'Available sheets {sheet_names}')
-      sheet_day=str(self._sheetname(requested_date))
-      print(f'Getting {sheet_day}')
-      sheet=[s for s in sheet_names if re.search(string=s, pattern=sheet_day)]
+      output_paths = []
+      parsed_dates = set()
+      for member_name, source in sources:
+        ## Every workbook of a multi-file archive gets its own output
+        suffix = '' if len(sources)==1 else '_'+os.path.splitext(os.path.basename(member_name))[0]
+        location = file_name if member_name is None else f'{file_name}:{member_name}'
 
-      ## Parsing Date fecha
-      df = pd.read_excel(self.file_path,sheet_name=sheet[0])
-      cols=df.columns.to_list()
-      parsed_date=df[cols[0]][0]
+        # Load the Excel file, it is opened only once
+        try:
+          excel_file = pd.ExcelFile(source, engine=self.engine)
+        except Exception as e:
+          raise Exception(f'Error occurred while loading {location}: {e}')
 
+        with excel_file:
+          # Get the sheet names
+          sheet_names = excel_file.sheet_names
+          print(f'Available sheets {sheet_names}')
+          for requested_date in requested_dates:
+            sheet_name = self._day_sheet(sheet_names, requested_date)
+            if sheet_name is None:
+              print(f'No sheet for {requested_date} in {location}, skipping')
+              continue
 
-      try:
-        df=pd.read_excel(self.file_path,
-                         header=header,
-                         sheet_name=sheet[0])
-      except Exception as e:
-        raise Exception(f'Error occurred while reading {self.file_path}: {e}')
+            output_dir = output_dirs.get(requested_date, self.staging_path)
+            output_paths += self._parse_day(
+              excel_file=excel_file,
+              sheet_name=sheet_name,
+              header=header,
+              output_dir=output_dir,
+              output_prefix=output_prefix,
+              output_name=(filename+suffix).lower(),
+              location=location
+            )
+            parsed_dates.add(requested_date)
 
-      df['fecha'] = parsed_date ## Adding parsed date
-      df=self._adding_metadata(df)
-      filename=self.file_metadata[1].split('.')[0]
+        if member_name is not None:
+          source.close()
 
-      ## Removing special characters on columns and setting them in lower case
-      df = self._rename_columns(df=df,hours_cols_bool=True)
-      #df.to_csv(f'{self.staging_path}/{output_prefix}_{filename.lower()}.csv.gz',
-      #          index=False,
-      #          compression='gzip')
-      df.to_parquet(f'{self.staging_path}/{output_prefix}_{filename.lower()}.parquet.gz',
-                index=False,
-                compression='gzip')
+      missing_dates = [d for d in requested_dates if d not in parsed_dates]
+      if missing_dates != []:
+        raise Exception(f'Sheet for days {missing_dates} not found in {file_name}')
 
+      self.parse_seconds = time.perf_counter()-start
+      print(f'[Info] Parsed {len(requested_dates)} day(s) from {file_name} in {self.parse_seconds:.2f}s')
+      return output_paths
@@ -0,0 +1,272 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+try:
+    import fcntl
+except ImportError: ## Windows, the index is then only merged between the threads of a process
+    fcntl=None
+
+class DOWNLOAD_CACHE:
+
+    def __init__(
+        self,
+        cache_path:str,
+        max_bytes:int=5*1024**3
+    )->None:
+        '''
+        Persistent content-addressed cache for CND attachments and their parsed outputs.
+        Entries are keyed by the file id and fechaPublica of the listing, blobs are stored
+        by sha256 and evicted least recently used first once max_bytes is exceeded.
+        Cache hits only update the last access in memory, the index is written by the puts and
+        by flush, merged under a file lock with the entries other processes saved meanwhile.
+        Parameters:
+        - cache_path (str): Directory where the cache lives. It survives staging cleanups
+        - max_bytes (int): Maximum size in bytes of the stored blobs
+        '''
+        self.cache_path=cache_path
+        self.max_bytes=max_bytes
+        self.index_path=f'{cache_path}/index.json'
+        self._lock=threading.Lock()
+        self._touched=False ## Last accesses not saved yet
+        self._added=set() ## (section, key) put since the index was saved
+        self._removed=set() ## (section, key) evicted since the index was saved
+
+        os.makedirs(f'{cache_path}/objects', exist_ok=True)
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self._index=json.load(f)
+        else:
+            self._index={'files': {}, 'parsed': {}}
+
+    def _key(self, file_id:int, fecha_publica:str) -> str:
+      '''
+      This function builds the cache key from the listing metadata. Only the epoch of
+      fechaPublica is kept, i.e. '/Date(1741234567000)/' -> '1741234567000'
+      '''
+      epoch=re.search(string=str(fecha_publica), pattern='([0-9]+)')
+      return f'{file_id}_{epoch[0] if epoch else fecha_publica}'
+
+    def _object_path(self, sha256:str) -> str:
+      return f'{self.cache_path}/objects/{sha256[:2]}/{sha256}'
+
+    def _sha256(self, path:str) -> str:
+      sha256=hashlib.sha256()
+      with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+          sha256.update(chunk)
+      return sha256.hexdigest()
+
+    def _merge_index(self) -> None:
+      '''
+      This function merges the index on disk into the one in memory: entries put by other
+      processes are added, entries they evicted are dropped, and the latest access is kept.
+      Must be called holding the lock and the file lock.
+      '''
+      if not os.path.exists(self.index_path):
+        return
+      with open(self.index_path) as f:
+        saved=json.load(f)
+      for section in ('files', 'parsed'):
+        entries=self._index[section]
+        for key in [k for k in entries if k not in saved[section] and (section, k) not in self._added]:
+          del entries[key]
+        for key, entry in saved[section].items():
+          if key in entries:
+            entries[key]['last_access']=max(entries[key]['last_access'], entry['last_access'])
+          elif (section, key) not in self._removed:
+            entries[key]=entry
+
+    def _save_index(self) -> None:
+      '''
+      This function merges the index with the one on disk, evicts what does not fit and
+      writes it atomically, under a file lock shared by the processes using the cache.
+      Must be called holding the lock.
+      '''
+      with open(f'{self.cache_path}/index.lock', 'a') as lock_file:
+        if fcntl is not None:
+          fcntl.flock(lock_file, fcntl.LOCK_EX) ## Released when the file is closed
+        self._merge_index()
+        self._evict()
+        tmp_path=f'{self.index_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+          json.dump(self._index, f)
+        os.replace(tmp_path, self.index_path)
+      self._touched=False
+      self._added.clear()
+      self._removed.clear()
+
+    def flush(self) -> None:
+      '''
+      This function saves the last accesses of the cache hits, if any.
+      '''
+      with self._lock:
+        if self._touched:
+          self._save_index()
+
+    def _store(self, src_path:str, sha256:str=None) -> dict:
+      '''
+      This function copies a file into the object store, if it is not there yet.
+      '''
+      sha256=sha256 or self._sha256(src_path)
+      object_path=self._object_path(sha256)
+      if not os.path.exists(object_path):
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        tmp_path=f'{object_path}.{threading.get_ident()}.tmp'
+        try:
+          os.link(src_path, tmp_path) ## Same filesystem, no copy needed
+        except OSError:
+          shutil.copyfile(src_path, tmp_path)
+        os.replace(tmp_path, object_path)
+      return {'sha256': sha256, 'size': os.path.getsize(object_path)}
+
+    def _restore(self, blob:dict, dest_path:str) -> bool:
+      '''
+      This function verifies a stored object and places it on dest_path.
+      Returns False and drops the object if it is missing or corrupted.
+      '''
+      object_path=self._object_path(blob['sha256'])
+      if not os.path.exists(object_path) \
+        or os.path.getsize(object_path) != blob['size'] \
+        or self._sha256(object_path) != blob['sha256']:
+        if os.path.exists(object_path):
+          os.remove(object_path)
+        return False
+
+      os.makedirs(os.path.dirname(dest_path) or '.', exist_ok=True)
+      if os.path.exists(dest_path):
+        os.remove(dest_path)
+      try:
+        os.link(object_path, dest_path) ## Same filesystem, no copy needed
+      except OSError:
+        shutil.copyfile(object_path, dest_path)
+      return True
+
+    def _evict(self) -> None:
+      '''
+      This function drops least recently used entries until the stored blobs fit
+      in max_bytes. Must be called holding the lock.
+      '''
+      entries=[
+        (entry['last_access'], section, key, entry['blobs'])
+        for section in ('files', 'parsed')
+        for key, entry in self._index[section].items()
+      ]
+      sizes={b['sha256']: b['size'] for *_, blobs in entries for b in blobs}
+      total=sum(sizes.values())
+      if total <= self.max_bytes:
+        return
+
+      refs={}
+      for *_, blobs in entries:
+        for b in blobs:
+          refs[b['sha256']]=refs.get(b['sha256'], 0)+1
+
+      for _, section, key, blobs in sorted(entries, key=lambda e: e[0]):
+        if total <= self.max_bytes:
+          break
+        del self._index[section][key]
+        self._removed.add((section, key))
+        self._added.discard((section, key))
+        for b in blobs:
+          refs[b['sha256']]-=1
+          if refs[b['sha256']] == 0:
+            total-=b['size']
+            if os.path.exists(self._object_path(b['sha256'])):
+              os.remove(self._object_path(b['sha256']))
+        print(f'[Info] Evicted {key} from download cache')
+
+    def get_file(self, file_id:int, fecha_publica:str, dest_path:str) -> bool:
+      '''
+      This function places the cached attachment on dest_path.
+      Parameters:
+      - file_id (int): The ID of the file
+      - fecha_publica (str): The file's public release date as shared by the listing
+      - dest_path (str): Path where the file is needed
+      Returns:
+      - bool: True on a verified cache hit
+      '''
+      key=self._key(file_id, fecha_publica)
+      with self._lock:
+        entry=self._index['files'].get(key)
+      if entry is None or not self._restore(entry['blobs'][0], dest_path):
+        return False
+
+      with self._lock:
+        if key in self._index['files']:
+          self._index['files'][key]['last_access']=time.time()
+          self._touched=True
+      return True
+
+    def put_file(self, file_id:int, fecha_publica:str, src_path:str, sha256:str=None) -> None:
+      '''
+      This function stores a downloaded attachment.
+      Parameters:
+      - file_id (int): The ID of the file
+      - fecha_publica (str): The file's public release date as shared by the listing
+      - src_path (str): Path of the downloaded file
+      - sha256 (str): Hex digest of the file, if it is already known
+      '''
+      blob=self._store(src_path, sha256)
+      blob['name']=os.path.basename(src_path)
+      key=self._key(file_id, fecha_publica)
+      with self._lock:
+        self._index['files'][key]={'blobs': [blob], 'last_access': time.time()}
+        self._added.add(('files', key))
+        self._removed.discard(('files', key))
+        self._save_index()
+
+    def get_parsed(self, file_id:int, fecha_publica:str, variant:str, dest_dir:str) -> list:
+      '''
+      This function places the cached parsed outputs of a file on dest_dir.
+      Parameters:
+      - file_id (int): The ID of the file
+      - fecha_publica (str): The file's public release date as shared by the listing
+      - variant (str): Identifies how the file was parsed, i.e. output prefix and requested date
+      - dest_dir (str): Directory where the outputs are needed
+      Returns:
+      - list: Paths of the restored outputs, None on a cache miss
+      '''
+      key=f'{self._key(file_id, fecha_publica)}/{variant}'
+      with self._lock:
+        entry=self._index['parsed'].get(key)
+      if entry is None:
+        return None
+
+      paths=[]
+      for blob in entry['blobs']:
+        path=f'{dest_dir}/{blob["name"]}'
+        if not self._restore(blob, path):
+          return None
+        paths.append(path)
+
+      with self._lock:
+        if key in self._index['parsed']:
+          self._index['parsed'][key]['last_access']=time.time()
+          self._touched=True
+      return paths
+
+    def put_parsed(self, file_id:int, fecha_publica:str, variant:str, paths:list) -> None:
+      '''
+      This function stores the parsed outputs of a file.
+      Parameters:
+      - file_id (int): The ID of the file
+      - fecha_publica (str): The file's public release date as shared by the listing
+      - variant (str): Identifies how the file was parsed, i.e. output prefix and requested date
+      - paths (list): Paths of the parsed outputs
+      '''
+      blobs=[]
+      for path in paths:
+        blob=self._store(path)
+        blob['name']=os.path.basename(path)
+        blobs.append(blob)
+
+      key=f'{self._key(file_id, fecha_publica)}/{variant}'
+      with self._lock:
+        self._index['parsed'][key]={'blobs': blobs, 'last_access': time.time()}
+        self._added.add(('parsed', key))
+        self._removed.discard(('parsed', key))
+        self._save_index()
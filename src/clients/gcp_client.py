@@ -1,78 +1,348 @@
+from google.api_core.exceptions import PreconditionFailed
+from google.auth.credentials import AnonymousCredentials
 from google.cloud import storage, bigquery
 from google.oauth2 import service_account
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+import base64
+import google_crc32c
+import hashlib
+import io
+import json
 import os
 import re
+import threading
+import time
 
 class GCP_UPLOADER:
     def __init__(
         self, 
         gcp_project_id: str, 
         staging_path: str, 
-        cred_path:str = None
+        cred_path:str = None,
+        api_endpoint: str = None,
+        max_workers: int = 8,
+        chunk_size: int = 8*1024*1024,
+        resumable_threshold: int = 8*1024*1024,
+        manifest_path: str = None,
+        bq_client: bigquery.Client = None,
+        bq_api_endpoint: str = None
     ) -> None:
         '''
         Initialize GCP_UPLOADER with project ID and local staging path.
+        The storage client and its connection pool are created once and reused by every upload,
+        so a single uploader is meant to be shared by the whole flow run.
         Parameters:
         - gcp_project_id (str): GCP Project 
         - staging_path (str): Path with the files to upload
+        - cred_path (str): Path of the service account credentials
+        - api_endpoint (str): Storage endpoint, i.e. a local fake-gcs-server 'http://localhost:4443'.
+          Anonymous credentials are used with it. STORAGE_EMULATOR_HOST is honored as well
+        - max_workers (int): Number of files uploaded concurrently
+        - chunk_size (int): Chunk size of the resumable uploads, a multiple of 256 KB
+        - resumable_threshold (int): Files bigger than this are sent in resumable chunks
+        - manifest_path (str): JSON manifest of the uploaded files and their checksums, used by
+          incremental uploads to skip unchanged files without asking GCS. None asks GCS every time
+        - bq_client (bigquery.Client): BigQuery client to use, i.e. a stub in tests. Created on first use if None
+        - bq_api_endpoint (str): BigQuery endpoint of a local emulator, used with anonymous credentials
         '''
         self.gcp_project_id = gcp_project_id
         self.staging_path = staging_path
+        self.cred_path = cred_path
+        self.api_endpoint = api_endpoint
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.resumable_threshold = resumable_threshold
+        self.manifest_path = manifest_path
+        self.bq_api_endpoint = bq_api_endpoint
+        self._storage_client = None
+        self._bq_client = bq_client
+        self._lock = threading.Lock()
+        self._manifest_lock = threading.Lock()
+        self._manifest = {}
+        if manifest_path is not None and os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self._manifest = json.load(f)
         if cred_path is not None:
             os.environ['GOOGLE_APPLICATION_CREDENTIALS']= cred_path
 
+    @property
+    def storage_client(self) -> storage.Client:
+        '''
+        Storage client shared by every upload, created on first use.
+        '''
+        with self._lock:
+            if self._storage_client is None:
+                if self.api_endpoint is not None:
+                    client = storage.Client(
+                        project=self.gcp_project_id,
+                        credentials=AnonymousCredentials(),
+                        client_options={'api_endpoint': self.api_endpoint}
+                    )
+                else:
+                    client = storage.Client(project=self.gcp_project_id)
+                # One pooled connection per upload worker
+                adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+                client._http.mount('https://', adapter)
+                client._http.mount('http://', adapter)
+                self._storage_client = client
+            return self._storage_client
+
+    @property
+    def bq_client(self) -> bigquery.Client:
+        '''
+        BigQuery client shared by every load and merge, created on first use.
+        '''
+        with self._lock:
+            if self._bq_client is None:
+                if self.bq_api_endpoint is not None:
+                    self._bq_client = bigquery.Client(
+                        project=self.gcp_project_id,
+                        credentials=AnonymousCredentials(),
+                        client_options={'api_endpoint': self.bq_api_endpoint}
+                    )
+                else:
+                    self._bq_client = bigquery.Client(project=self.gcp_project_id)
+            return self._bq_client
+
+    def close(self) -> None:
+        '''
+        Closes the storage client and its connection pool.
+        '''
+        with self._lock:
+            if self._storage_client is not None:
+                self._storage_client.close()
+                self._storage_client = None
+
+    def _checksums(self, local_path: str, data: bytes = None) -> dict:
+        '''
+        Returns the size, mtime and the base64 CRC32C and MD5 of a local file, or of in-memory data,
+        as GCS reports them.
+        '''
+        crc32c = google_crc32c.Checksum()
+        md5 = hashlib.md5()
+        if data is not None:
+            crc32c.update(data)
+            md5.update(data)
+            size, mtime_ns = len(data), None
+        else:
+            with open(local_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024*1024), b''):
+                    crc32c.update(chunk)
+                    md5.update(chunk)
+            stat = os.stat(local_path)
+            size, mtime_ns = stat.st_size, stat.st_mtime_ns
+        return {
+            'size': size,
+            'mtime_ns': mtime_ns,
+            'crc32c': base64.b64encode(crc32c.digest()).decode(),
+            'md5': base64.b64encode(md5.digest()).decode()
+        }
+
+    def _save_manifest(self) -> None:
+        '''
+        Writes the manifest atomically. Must be called holding the manifest lock.
+        '''
+        if self.manifest_path is None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.manifest_path)), exist_ok=True)
+        tmp_path = f'{self.manifest_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _remote_objects(self, bucket: storage.Bucket, blob_folder_name: str) -> dict:
+        '''
+        Lists the objects under the destination folder once, instead of one request per file.
+        '''
+        prefix = blob_folder_name.rstrip('/')+'/'
+        return {
+            blob.name: {'crc32c': blob.crc32c, 'md5': blob.md5_hash, 'generation': blob.generation}
+            for blob in self.storage_client.list_blobs(bucket, prefix=prefix)
+        }
+
+    def _upload_file(
+        self,
+        bucket: storage.Bucket,
+        local_path: str,
+        blob_name: str,
+        incremental: bool = False,
+        remote_objects: dict = None,
+        data: bytes = None
+    ) -> dict:
+        '''
+        Uploads a single file, or the in-memory data named local_path. Errors are returned, not raised,
+        so one file does not abort the rest.
+        Incremental uploads skip the files whose checksum matches the manifest or the remote object,
+        and upload the rest only if the remote generation is still the one compared against. remote_objects
+        None means the listing failed: the files not in the manifest are then uploaded unconditionally.
+        '''
+        start = time.perf_counter()
+        result = {'local_path': local_path, 'blob_name': blob_name, 'bytes': len(data) if data is not None else os.path.getsize(local_path), 'error': None}
+        try:
+            if_generation_match = None
+            if incremental:
+                checksums = self._checksums(local_path, data)
+                manifest_key = f'{bucket.name}/{blob_name}'
+                with self._manifest_lock:
+                    uploaded = self._manifest.get(manifest_key)
+                remote = (remote_objects or {}).get(blob_name)
+
+                if uploaded is not None and uploaded['crc32c'] == checksums['crc32c'] and uploaded['md5'] == checksums['md5']:
+                    result['status'] = 'skipped'
+                elif remote is not None and remote['crc32c'] == checksums['crc32c'] and remote['md5'] in (None, checksums['md5']):
+                    result['status'] = 'skipped'
+                    with self._manifest_lock:
+                        self._manifest[manifest_key] = dict(checksums, generation=remote['generation'])
+                elif remote is not None:
+                    if_generation_match = remote['generation']
+                elif uploaded is not None:
+                    ## Generation written by the last upload, a newer one means another run changed it
+                    if_generation_match = uploaded['generation']
+                elif remote_objects is not None:
+                    ## Not in the listing: 0 only creates the object, so a concurrent run cannot be overwritten
+                    if_generation_match = 0
+                ## Without the listing the generation is unknown, the file is uploaded without precondition
+
+            if result.get('status') != 'skipped':
+                # Big files are sent in resumable chunks, small ones in a single request
+                chunk_size = self.chunk_size if result['bytes'] > self.resumable_threshold else None
+                blob = bucket.blob(blob_name, chunk_size=chunk_size)
+                if data is not None:
+                    blob.upload_from_file(io.BytesIO(data), size=len(data), if_generation_match=if_generation_match)
+                else:
+                    blob.upload_from_filename(local_path, if_generation_match=if_generation_match)
+                result['status'] = 'uploaded'
+                if incremental:
+                    with self._manifest_lock:
+                        self._manifest[manifest_key] = dict(checksums, generation=blob.generation)
+        except PreconditionFailed as e:
+            result['status'] = 'failed'
+            result['error'] = f'Object changed by another run, not overwritten: {e}'
+        except Exception as e:
+            result['status'] = 'failed'
+            result['error'] = str(e)
+        result['seconds'] = time.perf_counter()-start
+        result['mb_per_second'] = result['bytes']/1024**2/result['seconds'] if result['status'] == 'uploaded' and result['seconds'] > 0 else None
+        return result
+
     def gcs_upload(
         self,
         bucket_name: str,
         blob_folder_name: str,
-        regexp_file: str = None
-    ) -> None:
+        regexp_file: str = None,
+        staging_path: str = None,
+        incremental: bool = False,
+        buffers: dict = None
+    ) -> dict:
         '''
-        Uploads files from local staging folder to GCS bucket.
+        Uploads files from local staging folder to GCS bucket, max_workers files at a time.
         Optionally filters files based on regex pattern.
         Parameters:
         - bucket_name (str): name of the Google Cloud Storage bucket
         - blob_folder_name (str): Destination folder in Google Cloud Storage Bucket
         - regexp_file (str) Default None: Regexp for filtering the required files, for instance 'FILE[0-9]+.csv.gz'
+        - staging_path (str) Default None: Folder to upload instead of the one of the uploader
+        - incremental (bool) Default False: Skips the files whose CRC32C/MD5 match the manifest or the
+          remote object, and uploads the rest with generation preconditions
+        - buffers (dict) Default None: Relative path to the bytes of in-memory files, uploaded instead of
+          walking the staging folder
+        Returns:
+        - dict: 'uploaded', 'skipped' and 'failed' lists with one dict per file (local_path, blob_name,
+          bytes, seconds, mb_per_second, error), plus total uploaded 'bytes' and wall 'seconds'
         '''
-        try:
-            # Create GCS client
-            storage_client = storage.Client(project=self.gcp_project_id)
-        except Exception as e:
-            print(f'[Error] Failed to create GCS client: {e}')
-            return
+        staging_path = staging_path if staging_path is not None else self.staging_path
+        result = {'uploaded': [], 'skipped': [], 'failed': [], 'bytes': 0, 'seconds': 0.0}
+        start = time.perf_counter()
 
         try:
             # Get bucket reference
-            bucket = storage_client.bucket(bucket_name)
+            bucket = self.storage_client.bucket(bucket_name)
         except Exception as e:
             print(f'[Error] Failed to access bucket "{bucket_name}": {e}')
-            return
+            result['failed'].append({'local_path': staging_path, 'blob_name': None, 'bytes': 0, 'seconds': 0.0, 'mb_per_second': None, 'status': 'failed', 'error': str(e)})
+            return result
 
-        try:
+        uploads = []
+        if buffers is not None:
+            for relative_path, data in buffers.items():
+                if regexp_file is not None and not re.search(pattern=regexp_file.lower(), string=os.path.basename(relative_path).lower()):
+                    continue
+                uploads.append((relative_path, os.path.join(blob_folder_name, relative_path), data))
+        else:
             # Traverse local staging folder
-            file_list = os.walk(self.staging_path)
-            for root, dirs, files in file_list:
+            for root, dirs, files in os.walk(staging_path):
                 for f in files:
-                    try:
-                        # Check regex match if provided
-                        if regexp_file is not None and not re.search(pattern=regexp_file.lower(), string=f.lower()):
-                            continue
-
-                        # Build blob name and upload path
-                        blob_name = os.path.join(blob_folder_name, f)
-                        local_path = os.path.join(root, f)
-                        
-                        # Upload file to GCS
-                        blob = bucket.blob(blob_name)
-                        blob.upload_from_filename(local_path)
-                        print(f'[Info] Uploaded {local_path} to {blob_name}')
-                    except Exception as e:
-                        print(f'[Error] Failed to upload {file}: {e}')
-            
-            storage_client.close()
+                    # Check regex match if provided
+                    if regexp_file is not None and not re.search(pattern=regexp_file.lower(), string=f.lower()):
+                        continue
+
+                    # Build blob name and upload path, subfolders such as dataset partitions are kept
+                    local_path = os.path.join(root, f)
+                    blob_name = os.path.join(blob_folder_name, os.path.relpath(local_path, staging_path))
+                    uploads.append((local_path, blob_name, None))
+
+        remote_objects = None
+        if incremental and uploads != []:
+            # The remote listing is only needed when some file is not in the manifest
+            with self._manifest_lock:
+                manifest_keys = set(self._manifest)
+            if any(f'{bucket_name}/{blob_name}' not in manifest_keys for _, blob_name, _ in uploads):
+                try:
+                    remote_objects = self._remote_objects(bucket, blob_folder_name)
+                except Exception as e:
+                    print(f'[Error] Failed to list {blob_folder_name} in "{bucket_name}", uploading the files not in the manifest without generation preconditions: {e}')
+
+        with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+            for r in executor.map(lambda u: self._upload_file(bucket, u[0], u[1], incremental=incremental, remote_objects=remote_objects, data=u[2]), uploads):
+                if r['status'] == 'skipped':
+                    result['skipped'].append(r)
+                elif r['status'] == 'failed':
+                    print(f'[Error] Failed to upload {r["local_path"]}: {r["error"]}')
+                    result['failed'].append(r)
+                else:
+                    print(f'[Info] Uploaded {r["local_path"]} to {r["blob_name"]} ({r["mb_per_second"] or 0:.2f} MB/s)')
+                    result['uploaded'].append(r)
+                    result['bytes'] += r['bytes']
+
+        if incremental:
+            with self._manifest_lock:
+                self._save_manifest()
+
+        result['seconds'] = time.perf_counter()-start
+        print(f'[Info] Uploaded {len(result["uploaded"])} files, {result["bytes"]/1024**2:.1f} MB in {result["seconds"]:.2f}s, {len(result["skipped"])} unchanged, {len(result["failed"])} failed')
+        return result
+
+    def gcs_delete(
+        self,
+        bucket_name: str,
+        blob_folder_name: str,
+        relative_paths: list
+    ) -> None:
+        '''
+        Deletes files uploaded by gcs_upload, i.e. the small files removed by a dataset compaction.
+        Parameters:
+        - bucket_name (str): name of the Google Cloud Storage bucket
+        - blob_folder_name (str): Folder in Google Cloud Storage Bucket the files were uploaded to
+        - relative_paths (list): Paths of the files relative to the staging path
+        '''
+        try:
+            bucket = self.storage_client.bucket(bucket_name)
         except Exception as e:
-            print(f'[Error] Failed during file traversal/upload: {e}')
+            print(f'[Error] Failed to access bucket "{bucket_name}": {e}')
+            return
+
+        for relative_path in relative_paths:
+            blob_name = os.path.join(blob_folder_name, relative_path)
+            try:
+                bucket.blob(blob_name).delete()
+                with self._manifest_lock:
+                    self._manifest.pop(f'{bucket_name}/{blob_name}', None)
+                print(f'[Info] Deleted {blob_name}')
+            except Exception as e:
+                print(f'[Error] Failed to delete {blob_name}: {e}')
+        with self._manifest_lock:
+            self._save_manifest()
 
     def sp_bq_upload(
         self,
@@ -85,34 +355,154 @@ class GCP_UPLOADER:
     ) -> None:
         '''
         Calls a BigQuery stored procedure to load/merge GCS data into a table.
+        The arguments are sent as query parameters instead of being interpolated.
         '''
-        try:
-            # Create BigQuery client
-            os.environ['GOOGLE_APPLICATION_CREDENTIALS']= self.cred_path
-            bq_client = bigquery.Client(project=self.gcp_project_id)
-        except Exception as e:
-            print(f'[Error] Failed to create BigQuery client: {e}')
-            return
+        for identifier in [bq_dataset, sp_name] + list(merge_key_columns):
+            _check_identifier(identifier)
 
-    
         # Build merge condition for stored procedure
         merge_conditions = [f'T.{col}=S.{col}' for col in merge_key_columns]
         merge_condition_str = ' AND '.join(merge_conditions)
 
         # Construct the stored procedure call query
         query = f'''
-            CALL `{bq_dataset}.{sp_name}`(
-                '{bucket_name}',
-                '{blob_folder_path}',
-                '{bq_table}',
-                '{merge_condition_str}'
-            )
+            CALL `{bq_dataset}.{sp_name}`(@bucket_name, @blob_folder_path, @bq_table, @merge_condition)
         '''
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter('bucket_name', 'STRING', bucket_name),
+            bigquery.ScalarQueryParameter('blob_folder_path', 'STRING', blob_folder_path),
+            bigquery.ScalarQueryParameter('bq_table', 'STRING', bq_table),
+            bigquery.ScalarQueryParameter('merge_condition', 'STRING', merge_condition_str)
+        ])
 
         try:
             # Run the query
-            query_job = bq_client.query(query)
+            query_job = self.bq_client.query(query, job_config=job_config)
             query_job.result()  # Wait for completion
             print(f'[Info] Stored procedure {sp_name} executed successfully.')
         except Exception as e:
             print(f'[Error] Failed to execute stored procedure: {e}')
+
+    def bq_load_and_merge(
+        self,
+        bq_dataset: str,
+        bq_table: str,
+        source_uris: list,
+        merge_key_columns: list,
+        staging_table: str = None,
+        hive_partition_uri_prefix: str = None,
+        max_uris_per_job: int = 10000
+    ) -> dict:
+        '''
+        Loads every Parquet object of a flow run into a staging table and merges it into the
+        target table with a single MERGE, instead of one load and merge per day.
+        Parameters:
+        - bq_dataset (str): BigQuery dataset of the tables
+        - bq_table (str): Target table. It is created like the staging table if it does not exist
+        - source_uris (list): gs:// uris of the Parquet objects
+        - merge_key_columns (list): Columns identifying a row. Source rows repeating a key are merged once,
+          the one of the latest publication (epoch_public_date, then file_id) wins
+        - staging_table (str) Default None: Staging table, replaced on every call. Defaults to <bq_table>_staging
+        - hive_partition_uri_prefix (str) Default None: gs:// prefix of a Hive-partitioned dataset, so
+          the partition columns are loaded from the paths
+        - max_uris_per_job (int): Uris per load job, the BigQuery limit is 10000
+        Delta files, with change_type and revision columns, are applied in order: the last revision
+        of every key wins and its 'delete' rows remove the key from the target.
+        Returns:
+        - dict: Job statistics, 'load' with jobs, files, input_file_bytes and output_rows, and
+          'merge' with job_id, bytes_processed, bytes_billed, rows_affected, inserted_rows,
+          updated_rows, deleted_rows and slot_millis
+        '''
+        staging_table = staging_table if staging_table is not None else f'{bq_table}_staging'
+        for identifier in [bq_dataset, bq_table, staging_table] + list(merge_key_columns):
+            _check_identifier(identifier)
+        if source_uris == []:
+            raise Exception('No source uris to load into BigQuery')
+
+        project = self.bq_client.project
+        staging_id = f'{project}.{bq_dataset}.{staging_table}'
+        target_id = f'{project}.{bq_dataset}.{bq_table}'
+        stats = {'load': {'jobs': [], 'files': len(source_uris), 'input_file_bytes': 0, 'output_rows': 0}, 'merge': None}
+
+        # One load job for the run, split only above the per job limit of uris
+        for i in range(0, len(source_uris), max_uris_per_job):
+            job_config = bigquery.LoadJobConfig(
+                source_format=bigquery.SourceFormat.PARQUET,
+                write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE if i == 0 else bigquery.WriteDisposition.WRITE_APPEND
+            )
+            if hive_partition_uri_prefix is not None:
+                hive_partitioning = bigquery.HivePartitioningOptions()
+                hive_partitioning.mode = 'AUTO'
+                hive_partitioning.source_uri_prefix = hive_partition_uri_prefix
+                job_config.hive_partitioning = hive_partitioning
+            load_job = self.bq_client.load_table_from_uri(source_uris[i:i+max_uris_per_job], staging_id, job_config=job_config)
+            load_job.result()
+            stats['load']['jobs'].append(load_job.job_id)
+            stats['load']['input_file_bytes'] += load_job.input_file_bytes or 0
+            stats['load']['output_rows'] += load_job.output_rows or 0
+        print(f'[Info] Loaded {stats["load"]["output_rows"]} rows from {len(source_uris)} files into {staging_id}')
+
+        columns = [field.name for field in self.bq_client.get_table(staging_id).schema]
+        for column in columns:
+            _check_identifier(column)
+        missing_keys = [c for c in merge_key_columns if c not in columns]
+        if missing_keys != []:
+            raise Exception(f'Merge key columns {missing_keys} not found in {staging_id}')
+
+        delta = 'change_type' in columns
+        if delta:
+            # change_type only drives the merge, it is not stored in the target
+            self.bq_client.query(f'CREATE TABLE IF NOT EXISTS `{target_id}` AS SELECT * EXCEPT(change_type) FROM `{staging_id}` LIMIT 0').result()
+            columns = [c for c in columns if c != 'change_type']
+        else:
+            self.bq_client.query(f'CREATE TABLE IF NOT EXISTS `{target_id}` LIKE `{staging_id}`').result()
+
+        keys = ', '.join(f'`{c}`' for c in merge_key_columns)
+        on = ' AND '.join(f'T.`{c}` = S.`{c}`' for c in merge_key_columns)
+        update_columns = [c for c in columns if c not in merge_key_columns]
+        update = ', '.join(f'`{c}` = S.`{c}`' for c in update_columns)
+        insert = ', '.join(f'`{c}`' for c in columns)
+        # Source rows repeating a key resolve to the latest publication, the whole row breaks the ties
+        order = []
+        if delta and 'revision' in columns:
+            order.append('`revision` DESC')
+        if 'epoch_public_date' in columns:
+            order.append("SAFE_CAST(REGEXP_EXTRACT(CAST(`epoch_public_date` AS STRING), r'-?[0-9]+') AS INT64) DESC")
+        if 'file_id' in columns:
+            order.append('`file_id` DESC')
+        order.append('TO_JSON_STRING(R) DESC')
+        query = f'''
+            MERGE `{target_id}` T
+            USING (
+                SELECT * FROM `{staging_id}` R
+                QUALIFY ROW_NUMBER() OVER (PARTITION BY {keys} ORDER BY {', '.join(order)}) = 1
+            ) S
+            ON {on}
+            {"WHEN MATCHED AND S.change_type = 'delete' THEN DELETE" if delta else ""}
+            {f"WHEN MATCHED THEN UPDATE SET {update}" if update_columns != [] else ""}
+            WHEN NOT MATCHED {"AND S.change_type != 'delete'" if delta else ""} THEN INSERT ({insert}) VALUES ({insert})
+        '''
+        merge_job = self.bq_client.query(query)
+        merge_job.result()
+
+        dml_stats = merge_job.dml_stats
+        stats['merge'] = {
+            'job_id': merge_job.job_id,
+            'bytes_processed': merge_job.total_bytes_processed,
+            'bytes_billed': merge_job.total_bytes_billed,
+            'rows_affected': merge_job.num_dml_affected_rows,
+            'inserted_rows': dml_stats.inserted_row_count if dml_stats is not None else None,
+            'updated_rows': dml_stats.updated_row_count if dml_stats is not None else None,
+            'deleted_rows': dml_stats.deleted_row_count if dml_stats is not None else None,
+            'slot_millis': merge_job.slot_millis
+        }
+        print(f'[Info] Merged {stats["merge"]["rows_affected"]} rows into {target_id}, {stats["merge"]["bytes_processed"]} bytes processed')
+        return stats
+
+
+def _check_identifier(identifier: str) -> None:
+    '''
+    BigQuery parameters cannot bind table or column names, so identifiers are validated instead.
+    '''
+    if not re.fullmatch(r'[A-Za-z_][A-Za-z0-9_\-]*', str(identifier)):
+        raise Exception(f'Invalid BigQuery identifier: {identifier}')
@@ -0,0 +1,108 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+class RATE_LIMITED_RETRY(Retry):
+    '''
+    Retry policy of the session that goes through the rate limiter: every retried response is
+    reported to the limiter, so 429/5xx slow down the whole run, and every retry waits for a token.
+    '''
+
+    def __init__(self, rate_limiter=None, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.rate_limiter = rate_limiter
+
+    def new(self, **kw) -> 'RATE_LIMITED_RETRY':
+        retry = super().new(**kw)
+        retry.rate_limiter = self.rate_limiter
+        return retry
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None) -> 'RATE_LIMITED_RETRY':
+        ## Raises when the retries are exhausted, the last response is reported by rate_limited_get
+        retry = super().increment(method=method, url=url, response=response, error=error, _pool=_pool, _stacktrace=_stacktrace)
+        if self.rate_limiter is not None:
+            retry_after = self.get_retry_after(response) if response is not None else None
+            self.rate_limiter.report(response.status if response is not None else None, retry_after=retry_after)
+        return retry
+
+    def sleep(self, response=None) -> None:
+        super().sleep(response)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+def build_session(
+    pool_size:int=10,
+    retries:int=3,
+    backoff_factor:float=0.5,
+    status_forcelist:tuple=(429, 500, 502, 503, 504),
+    rate_limiter=None
+) -> requests.Session:
+    '''
+    Builds a keep-alive session with connection pooling and exponential-backoff
+    retries on transient failures. It is meant to be shared by every request sent to CND.
+    Parameters:
+    - pool_size (int): Maximum number of pooled connections per host
+    - retries (int): Number of retries for connection errors and the statuses in status_forcelist
+    - backoff_factor (float): Base of the exponential backoff between retries, in seconds
+    - status_forcelist (tuple): HTTP status codes that are retried
+    - rate_limiter (RATE_LIMITER): Optional limiter shared by every request sent to CND. Every retry
+      takes a token and reports its response to it
+    Returns:
+    - requests.Session: Session ready to be used
+    '''
+    retry = RATE_LIMITED_RETRY(
+        rate_limiter=rate_limiter,
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=status_forcelist,
+        allowed_methods=frozenset(['GET', 'HEAD']),
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def rate_limited_get(
+    session:requests.Session,
+    url:str,
+    params:dict,
+    rate_limiter=None,
+    timeout:float=60,
+    **kwargs
+) -> requests.Response:
+    '''
+    Sends a GET request through the session and the rate limiter, if any, and
+    reports the response status back to the limiter.
+    Parameters:
+    - session (requests.Session): Shared session
+    - url (str): Url of the request
+    - params (dict): Query parameters of the request
+    - rate_limiter (RATE_LIMITER): Optional limiter shared by every request sent to CND
+    - timeout (float): Timeout in seconds for the request
+    - kwargs: Extra arguments for requests.Session.get
+    Returns:
+    - requests.Response: Response of the request
+    '''
+    if rate_limiter is None:
+        return session.get(url, params=params, timeout=timeout, **kwargs)
+
+    rate_limiter.acquire()
+    try:
+        response = session.get(url, params=params, timeout=timeout, **kwargs)
+    except requests.exceptions.RequestException:
+        rate_limiter.report(None)
+        raise
+
+    retry_after = response.headers.get('Retry-After')
+    rate_limiter.report(
+        response.status_code,
+        retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None
+    )
+    return response
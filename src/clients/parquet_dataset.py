@@ -0,0 +1,183 @@
+import os
+import threading
+import uuid
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from src.clients.parquet_writer import PARQUET_WRITER
+
+## Hive partition used for the rows without a valid fecha
+DEFAULT_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+class PARQUET_DATASET_WRITER:
+
+    def __init__(
+        self,
+        root_path:str,
+        writer:PARQUET_WRITER=None,
+        partition_by:str='month',
+        target_file_bytes:int=128*1024**2,
+        max_buffer_bytes:int=512*1024**2
+    )->None:
+        '''
+        Appends parsed dataframes to a Hive-partitioned Parquet dataset, buffering the rows of
+        every partition so each file holds many days instead of one file per day and workbook.
+        Partitions are fecha=YYYY-MM-DD for 'day', where fecha is dropped from the files as
+        Hive readers restore it from the path, and mes=YYYY-MM for 'month'.
+        The dataset is append-only, re-parsed days are appended again.
+        Parameters:
+        - root_path (str): Root folder of the dataset
+        - writer (PARQUET_WRITER): Writer with the schema and codec of the files. Defaults to zstd with the predispatch schema
+        - partition_by (str): 'day' or 'month'
+        - target_file_bytes (int): Rows buffered per partition before a file is written, measured as
+          Arrow in-memory size, so the compressed file is smaller. Also the target of compact
+        - max_buffer_bytes (int): Every partition is flushed once the buffers of all of them reach this size
+        '''
+        if partition_by not in ('day', 'month'):
+            raise Exception(f'Unknown partitioning {partition_by}, use day or month')
+        self.root_path=root_path
+        self.writer=writer if writer is not None else PARQUET_WRITER()
+        self.partition_by=partition_by
+        self.target_file_bytes=target_file_bytes
+        self.max_buffer_bytes=max_buffer_bytes
+        self.appended_partitions=set()
+        self._buffers={}
+        self._buffered_bytes=0
+        self._lock=threading.Lock()
+
+    @property
+    def partition_key(self) -> str:
+      return 'fecha' if self.partition_by == 'day' else 'mes'
+
+    def _partition_values(self, fecha:pd.Series) -> pd.Series:
+      '''
+      This function returns the partition value of every row.
+      '''
+      if not pd.api.types.is_datetime64_any_dtype(fecha):
+        raise Exception('Column fecha must be a timestamp to partition the dataset')
+      values=fecha.dt.strftime('%Y-%m-%d' if self.partition_by == 'day' else '%Y-%m')
+      return values.fillna(DEFAULT_PARTITION)
+
+    def _partition_path(self, partition:str) -> str:
+      return f'{self.root_path}/{self.partition_key}={partition}'
+
+    def _write_file(self, partition:str, table:pa.Table) -> str:
+      '''
+      This function writes a file in the partition. It is written under a hidden name first,
+      which readers ignore, and renamed once complete.
+      '''
+      partition_path=self._partition_path(partition)
+      os.makedirs(partition_path, exist_ok=True)
+      file_name=f'part-{uuid.uuid4().hex}{self.writer.extension}'
+      tmp_path=f'{partition_path}/.{file_name}.tmp'
+      pq.write_table(
+        table,
+        tmp_path,
+        compression=self.writer.compression,
+        compression_level=self.writer.compression_level,
+        row_group_size=self.writer.row_group_size
+      )
+      os.replace(tmp_path, f'{partition_path}/{file_name}')
+      return f'{partition_path}/{file_name}'
+
+    def _flush_partition(self, partition:str) -> str:
+      ## Must be called holding the lock
+      tables=self._buffers.pop(partition, [])
+      if tables == []:
+        return None
+      self._buffered_bytes-=sum(t.nbytes for t in tables)
+      return self._write_file(partition, pa.concat_tables(tables, promote_options='permissive'))
+
+    def append(self, df:pd.DataFrame) -> list:
+      '''
+      This function adds the rows of a parsed dataframe to the buffers of their partitions.
+      Parameters:
+      - df: Parsed dataframe, with a fecha column
+      Returns:
+      - list: Paths of the files written by this call, if any buffer reached its target
+      '''
+      df=self.writer.coerce_schema(df)
+      partitions=self._partition_values(df['fecha'])
+      if self.partition_by == 'day':
+        df=df.drop(columns=['fecha'])
+
+      written=[]
+      with self._lock:
+        for partition, rows in df.groupby(partitions.values, sort=False, observed=True):
+          table=pa.Table.from_pandas(rows, preserve_index=False)
+          self._buffers.setdefault(partition, []).append(table)
+          self.appended_partitions.add(partition)
+          self._buffered_bytes+=table.nbytes
+          if sum(t.nbytes for t in self._buffers[partition]) >= self.target_file_bytes:
+            written.append(self._flush_partition(partition))
+
+        if self._buffered_bytes >= self.max_buffer_bytes:
+          written.extend(self._flush_partition(p) for p in list(self._buffers))
+      return written
+
+    def append_file(self, path:str) -> list:
+      '''
+      This function adds the rows of a parsed Parquet file to the dataset.
+      '''
+      return self.append(pd.read_parquet(path))
+
+    def flush(self) -> list:
+      '''
+      This function writes every buffered partition.
+      Returns:
+      - list: Paths of the written files
+      '''
+      with self._lock:
+        return [self._flush_partition(p) for p in list(self._buffers)]
+
+    def partitions(self) -> list:
+      '''
+      This function lists the partition values found on disk.
+      '''
+      if not os.path.isdir(self.root_path):
+        return []
+      prefix=f'{self.partition_key}='
+      return sorted(d[len(prefix):] for d in os.listdir(self.root_path) if d.startswith(prefix))
+
+    def compact(self, partitions:list=None) -> dict:
+      '''
+      This function merges the small files of every partition into files of up to
+      target_file_bytes on disk. The merged file is written before the small ones are removed.
+      Parameters:
+      - partitions (list): Partition values to compact. None compacts all of them
+      Returns:
+      - dict: 'written' and 'removed' file paths
+      '''
+      self.flush()
+      result={'written': [], 'removed': []}
+      for partition in (partitions if partitions is not None else self.partitions()):
+        partition_path=self._partition_path(partition)
+        if not os.path.isdir(partition_path):
+          continue
+        small_files=sorted(
+          f'{partition_path}/{f}' for f in os.listdir(partition_path)
+          if not f.startswith(('.', '_')) and os.path.getsize(f'{partition_path}/{f}') < self.target_file_bytes
+        )
+
+        ## Greedy groups of small files up to the target size
+        groups=[]
+        group_bytes=0
+        for path in small_files:
+          size=os.path.getsize(path)
+          if groups == [] or group_bytes+size > self.target_file_bytes:
+            groups.append([])
+            group_bytes=0
+          groups[-1].append(path)
+          group_bytes+=size
+
+        for group in groups:
+          if len(group) < 2:
+            continue
+          table=pa.concat_tables([pq.read_table(p) for p in group], promote_options='permissive')
+          result['written'].append(self._write_file(partition, table))
+          for path in group:
+            os.remove(path)
+          result['removed'].extend(group)
+
+      print(f'[Info] Compacted {len(result["removed"])} files into {len(result["written"])} in {self.root_path}')
+      return result
@@ -0,0 +1,111 @@
+import re
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+## Hourly columns as renamed by CND_PARSER._rename_columns, i.e. h0_1, h1_2, h0
+HOURLY_COLUMN_PATTERN = r'^h[0-9]+(_[0-9]+)?$'
+
+## Declared schema of the parsed predispatch files, hourly columns are float32
+PREDISPATCH_SCHEMA = {
+    'fecha': 'timestamp',
+    'epoch_public_date': 'timestamp',
+    'file_id': 'int64',
+    'file_name': 'category',
+    'plantas': 'category',
+    'hour_interval': 'category',
+    'value': 'float32',
+    'interval_start': 'timestamp',
+    'change_type': 'category',
+    'revision': 'int64',
+}
+
+class PARQUET_WRITER:
+
+    def __init__(
+        self,
+        compression:str='zstd',
+        compression_level:int=None,
+        row_group_size:int=None,
+        schema:dict=None
+    )->None:
+        '''
+        Writes the parsed dataframes as Parquet with a declared schema: hourly values as
+        float32, repeated text as dictionary columns and dates as real timestamps.
+        Parameters:
+        - compression (str): Parquet codec, i.e. 'zstd', 'snappy', 'gzip' or 'none'
+        - compression_level (int): Level of the codec, None uses the codec default
+        - row_group_size (int): Maximum number of rows per row group, None uses the pyarrow default
+        - schema (dict): Column name to 'timestamp', 'category' or a pandas dtype. Defaults to PREDISPATCH_SCHEMA
+        '''
+        self.compression=compression
+        self.compression_level=compression_level
+        self.row_group_size=row_group_size
+        self.schema=schema if schema is not None else PREDISPATCH_SCHEMA
+
+    @property
+    def extension(self) -> str:
+      ## gzip keeps the historical .parquet.gz name
+      return '.parquet.gz' if self.compression == 'gzip' else '.parquet'
+
+    @property
+    def signature(self) -> str:
+      ## Identifies the output format, outputs written with another format are not reused
+      return f'{self.compression}{self.compression_level or ""}'
+
+    def _to_timestamp(self, values:pd.Series, column:str) -> pd.Series:
+      '''
+      This function converts a column to timestamps. Digits are taken as epoch in milliseconds,
+      like CND's fechaPublica. Values that cannot be converted are kept as they are.
+      '''
+      if pd.api.types.is_datetime64_any_dtype(values):
+        return values.astype('datetime64[ms]')
+
+      if values.astype(str).str.fullmatch('[0-9]+').all():
+        return pd.to_datetime(values.astype('int64'), unit='ms')
+
+      converted=pd.to_datetime(values, errors='coerce', dayfirst=True)
+      if converted.isna().sum() > values.isna().sum():
+        print(f'[Error] Column {column} could not be converted to timestamp, keeping it as it is')
+        return values
+      return converted.astype('datetime64[ms]')
+
+    def coerce_schema(self, df:pd.DataFrame) -> pd.DataFrame:
+      '''
+      This function applies the declared schema to the dataframe.
+      Parameters:
+      - df: Parsed dataframe
+      Returns:
+      - df: Dataframe with the declared dtypes
+      '''
+      df=df.copy(deep=False)
+      for column in df.columns:
+        if re.search(string=str(column), pattern=HOURLY_COLUMN_PATTERN):
+          df[column]=pd.to_numeric(df[column], errors='coerce').astype('float32')
+        elif column in self.schema:
+          dtype=self.schema[column]
+          if dtype == 'timestamp':
+            df[column]=self._to_timestamp(df[column], column)
+          elif dtype == 'category':
+            df[column]=df[column].astype(str).where(df[column].notna()).astype('category')
+          else:
+            df[column]=df[column].astype(dtype)
+      return df
+
+    def write(self, df:pd.DataFrame, path) -> None:
+      '''
+      This function writes the dataframe with the declared schema.
+      Parameters:
+      - df: Parsed dataframe
+      - path: Output path or writable buffer
+      Returns:
+      - None
+      '''
+      table=pa.Table.from_pandas(self.coerce_schema(df), preserve_index=False)
+      pq.write_table(
+        table,
+        path,
+        compression=self.compression,
+        compression_level=self.compression_level,
+        row_group_size=self.row_group_size
+      )
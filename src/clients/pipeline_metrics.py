@@ -0,0 +1,164 @@
+import contextlib
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+class PIPELINE_METRICS:
+
+    def __init__(
+        self,
+        jsonl_path:str=None,
+        prometheus_path:str=None,
+        run_id:str=None
+    )->None:
+        '''
+        Records timing, byte and row metrics of every stage of the predispatch pipeline:
+        listing, download, parse and upload. Every event is appended to a JSON lines file as it
+        happens and the totals per stage can be exported as a Prometheus textfile.
+        Components take it as an optional argument, None records nothing.
+        Parameters:
+        - jsonl_path (str): JSON lines file the events are appended to. None keeps them only in memory
+        - prometheus_path (str): Textfile for the node_exporter textfile collector, written by export_prometheus
+        - run_id (str): Identifier added to every event. Defaults to the start time of the run
+        '''
+        self.jsonl_path=jsonl_path
+        self.prometheus_path=prometheus_path
+        self.run_id=run_id if run_id is not None else time.strftime('%Y%m%dT%H%M%S')
+        self.events=[]
+        self._lock=threading.Lock()
+
+        if jsonl_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(jsonl_path)), exist_ok=True)
+
+    def record(self, stage:str, **fields) -> dict:
+      '''
+      This function records an event of a stage.
+      Parameters:
+      - stage (str): 'listing', 'download', 'parse' or 'upload'
+      - fields: Values of the event, i.e. date, file_name, seconds, bytes, rows, columns
+      Returns:
+      - dict: Recorded event
+      '''
+      event={'ts': time.time(), 'run_id': self.run_id, 'stage': stage}
+      event.update({k: (v.strftime('%Y-%m-%d') if hasattr(v, 'strftime') else v) for k, v in fields.items()})
+      with self._lock:
+        self.events.append(event)
+        if self.jsonl_path is not None:
+          with open(self.jsonl_path, 'a') as f:
+            f.write(json.dumps(event, default=str)+'\n')
+      return event
+
+    @contextlib.contextmanager
+    def timer(self, stage:str, **fields):
+      '''
+      This function times a block and records it with its seconds. The yielded dict
+      takes the fields only known inside the block, i.e. bytes.
+      '''
+      start=time.perf_counter()
+      extra={}
+      try:
+        yield extra
+      except Exception as e:
+        extra['error']=str(e)
+        raise
+      finally:
+        self.record(stage, seconds=time.perf_counter()-start, **fields, **extra)
+
+    def summary(self) -> dict:
+      '''
+      This function aggregates the events per stage.
+      Returns:
+      - dict: Stage to events, errors, seconds, bytes and rows
+      '''
+      totals={}
+      with self._lock:
+        events=list(self.events)
+      for event in events:
+        total=totals.setdefault(event['stage'], {'events': 0, 'errors': 0, 'seconds': 0.0, 'bytes': 0, 'rows': 0})
+        total['events']+=1
+        total['errors']+=1 if event.get('error') else 0
+        total['seconds']+=event.get('seconds') or 0.0
+        total['bytes']+=event.get('bytes') or 0
+        total['rows']+=event.get('rows') or 0
+      return totals
+
+    def export_prometheus(self) -> None:
+      '''
+      This function writes the totals per stage as a Prometheus textfile, atomically so the
+      collector never reads a partial file.
+      '''
+      if self.prometheus_path is None:
+        return
+      metrics=[
+        ('events', 'counter', 'Events recorded per stage'),
+        ('errors', 'counter', 'Failed events per stage'),
+        ('seconds', 'counter', 'Seconds spent per stage'),
+        ('bytes', 'counter', 'Bytes downloaded, written or uploaded per stage'),
+        ('rows', 'counter', 'Rows produced per stage'),
+      ]
+      summary=self.summary()
+      lines=[]
+      for name, metric_type, description in metrics:
+        lines.append(f'# HELP cnd_predispatch_{name}_total {description}')
+        lines.append(f'# TYPE cnd_predispatch_{name}_total {metric_type}')
+        for stage, total in sorted(summary.items()):
+          lines.append(f'cnd_predispatch_{name}_total{{stage="{stage}"}} {total[name]}')
+      lines.append('# HELP cnd_predispatch_last_run_timestamp_seconds End of the last run')
+      lines.append('# TYPE cnd_predispatch_last_run_timestamp_seconds gauge')
+      lines.append(f'cnd_predispatch_last_run_timestamp_seconds {time.time()}')
+
+      os.makedirs(os.path.dirname(os.path.abspath(self.prometheus_path)), exist_ok=True)
+      tmp_path=f'{self.prometheus_path}.tmp'
+      with open(tmp_path, 'w') as f:
+        f.write('\n'.join(lines)+'\n')
+      os.replace(tmp_path, self.prometheus_path)
+
+## tracemalloc is global to the process, it is shared by the parses running in threads
+_TRACE_LOCK = threading.Lock()
+_TRACE_USERS = 0
+
+@contextlib.contextmanager
+def parse_profiler(profile_path:str=None, trace_memory:bool=False, label:str='parse'):
+    '''
+    Opt-in profiling of a parse. cProfile stats are dumped to <profile_path>/<label>.prof and
+    the tracemalloc peak is set in the yielded dict. With both off it only yields.
+    It runs inside the parse workers, so it does not need the metrics object. With parses
+    running in threads the peak is the one of the process while the parse ran.
+    '''
+    global _TRACE_USERS
+    stats={}
+    if profile_path is None and not trace_memory:
+      yield stats
+      return
+
+    profiler=None
+    if profile_path is not None:
+      profiler=cProfile.Profile()
+      try:
+        profiler.enable()
+      except ValueError as e:
+        ## Only one profiler can be active at a time on recent Python versions
+        print(f'[Error] Profiling of {label} skipped: {e}')
+        profiler=None
+    if trace_memory:
+      with _TRACE_LOCK:
+        if _TRACE_USERS == 0:
+          tracemalloc.start()
+        _TRACE_USERS+=1
+    try:
+      yield stats
+    finally:
+      if trace_memory:
+        with _TRACE_LOCK:
+          stats['peak_memory_bytes']=tracemalloc.get_traced_memory()[1]
+          _TRACE_USERS-=1
+          if _TRACE_USERS == 0:
+            tracemalloc.stop()
+      if profiler is not None:
+        profiler.disable()
+        os.makedirs(profile_path, exist_ok=True)
+        stats['profile_path']=f'{profile_path}/{label}.prof'
+        profiler.dump_stats(stats['profile_path'])
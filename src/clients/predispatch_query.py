@@ -0,0 +1,464 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from datetime import date, datetime, timedelta
+import duckdb
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+from src.clients.parquet_writer import HOURLY_COLUMN_PATTERN
+
+## Path components that tell the days of a file: Hive partitions of PARQUET_DATASET_WRITER
+## and the per day folders of the flow
+DAY_PARTITION_PATTERN = r'^(?:fecha=)?([0-9]{4}-[0-9]{2}-[0-9]{2})$'
+MONTH_PARTITION_PATTERN = r'^mes=([0-9]{4}-[0-9]{2})$'
+
+## Columns kept next to the hours when only some hours are queried
+ID_COLUMNS = ('fecha', 'plantas')
+LONG_COLUMNS = ('fecha', 'plantas', 'hour_interval', 'interval_start', 'value')
+
+def _to_date(value) -> date:
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value)[:10], '%Y-%m-%d').date()
+
+def _month_end(month:str) -> date:
+    first=datetime.strptime(month, '%Y-%m').date()
+    return (first.replace(day=28)+timedelta(days=4)).replace(day=1)-timedelta(days=1)
+
+def _quote(name:str) -> str:
+    return '"'+name.replace('"', '""')+'"'
+
+class PREDISPATCH_QUERY:
+
+    def __init__(
+        self,
+        source_path:str,
+        layout:str='wide',
+        cache_path:str=None,
+        api_endpoint:str=None,
+        listing_ttl:float=60,
+        threads:int=None
+    )->None:
+        '''
+        Queries the parsed predispatch Parquet files with an embedded DuckDB, without loading the
+        whole history. The files are listed once per listing_ttl and pruned by the day or month
+        in their path (fecha=, mes= or the per day folders) before DuckDB opens them, then the
+        filters on fecha and plantas and the projection of the queried hours are pushed down into
+        the Parquet scan, so only the needed row groups and columns are read.
+        Parameters:
+        - source_path (str): Folder of the parsed files: a dataset_path of the flow, the staging_path
+          with the per day folders, or the same layouts in a bucket as 'gs://bucket/folder'
+        - layout (str): 'wide' hourly columns or 'long' one row per unit and hour
+        - cache_path (str): Local folder of the materialized daily aggregates. None aggregates on every query
+        - api_endpoint (str): Storage endpoint of a local emulator for gs:// sources, used anonymously.
+          STORAGE_EMULATOR_HOST is honored as well
+        - listing_ttl (float): Seconds the listing of the files is reused
+        - threads (int): DuckDB threads, None uses every core
+        '''
+        if layout not in ('wide', 'long'):
+            raise Exception(f'Unknown layout {layout}, use wide or long')
+        self.source_path=source_path.rstrip('/')
+        self.layout=layout
+        self.cache_path=cache_path
+        self.listing_ttl=listing_ttl
+        ## Reentrant, the aggregation lists the files while holding it
+        self._lock=threading.RLock()
+        self._listing=None
+        self._listed_at=0
+
+        if self.source_path.startswith('gs://'):
+            api_endpoint=api_endpoint or os.environ.get('STORAGE_EMULATOR_HOST')
+            if api_endpoint is not None:
+                scheme, _, host=api_endpoint.rpartition('://')
+                self.filesystem=pafs.GcsFileSystem(anonymous=True, endpoint_override=host, scheme=scheme or 'https')
+            else:
+                self.filesystem=pafs.GcsFileSystem()
+            self._base_path=self.source_path[len('gs://'):]
+        else:
+            self.filesystem=None
+            self._base_path=os.path.abspath(self.source_path)
+
+        self._con=duckdb.connect()
+        if threads is not None:
+            self._con.execute(f'SET threads={int(threads)}')
+
+    def close(self) -> None:
+      with self._lock:
+        self._con.close()
+
+    def _file_layout(self, relative_path:str) -> str:
+      ## Datasets keep a folder per layout, per day files of the long layout are named <prefix>_long_<file>
+      parts=relative_path.split('/')
+      if 'long' in parts[:-1] or '_long_' in parts[-1]:
+        return 'long'
+      return 'wide'
+
+    def _file_days(self, relative_path:str) -> tuple:
+      '''
+      This function returns the first and last day a file can hold, from the partitions in its path.
+      Files without them return (None, None) and are always scanned.
+      '''
+      for part in reversed(relative_path.split('/')[:-1]):
+        match=re.search(string=part, pattern=DAY_PARTITION_PATTERN)
+        if match is not None:
+          day=_to_date(match[1])
+          return day, day
+        match=re.search(string=part, pattern=MONTH_PARTITION_PATTERN)
+        if match is not None:
+          return _to_date(f'{match[1]}-01'), _month_end(match[1])
+      return None, None
+
+    def files(self, refresh:bool=False) -> list:
+      '''
+      This function lists the Parquet files of the layout, hidden and temporary files excluded.
+      Returns:
+      - list: (path, first_day, last_day, size, mtime) of every file
+      '''
+      with self._lock:
+        if not refresh and self._listing is not None and time.monotonic()-self._listed_at < self.listing_ttl:
+          return self._listing
+
+      if self.filesystem is None:
+        infos=[]
+        for root, dirs, names in os.walk(self._base_path):
+          dirs[:]=[d for d in dirs if not d.startswith(('.', '_'))]
+          for name in names:
+            path=os.path.join(root, name)
+            stat=os.stat(path)
+            infos.append((path, stat.st_size, stat.st_mtime))
+      else:
+        selector=pafs.FileSelector(self._base_path, recursive=True, allow_not_found=True)
+        infos=[
+          (i.path, i.size, i.mtime.timestamp() if i.mtime is not None else None)
+          for i in self.filesystem.get_file_info(selector) if i.type == pafs.FileType.File
+        ]
+
+      listing=[]
+      for path, size, mtime in infos:
+        relative_path=os.path.relpath(path, self._base_path).replace(os.sep, '/')
+        name=relative_path.split('/')[-1]
+        if name.startswith(('.', '_')) or not name.endswith(('.parquet', '.parquet.gz')):
+          continue
+        if any(p.startswith(('.', '_')) for p in relative_path.split('/')[:-1]):
+          continue
+        ## Delta files of the revision index hold changes, not the state of the days
+        if self._file_layout(relative_path) != self.layout or '_delta_' in name:
+          continue
+        listing.append((path, *self._file_days(relative_path), size, mtime))
+
+      listing.sort()
+      with self._lock:
+        self._listing=listing
+        self._listed_at=time.monotonic()
+      return listing
+
+    def _pruned(self, start:date, end:date) -> list:
+      ## Files that may hold days between start and end
+      return [
+        f for f in self.files()
+        if f[1] is None or (f[1] <= end and f[2] >= start)
+      ]
+
+    def _matching(self, start:date, end:date) -> list:
+      '''
+      This function returns the files that may hold days between start and end, and raises when there
+      are none, so a wrong source_path or layout is not mistaken for days without predispatch.
+      '''
+      files=self._pruned(start, end)
+      if files != []:
+        return files
+      if self.files() == []:
+        raise Exception(
+          f'No {self.layout} predispatch files in {self.source_path}. The layout is taken from the paths under '
+          f'source_path, point it at the dataset root or the staging_path, not at its wide or long folder'
+        )
+      raise Exception(f'No {self.layout} predispatch files between {start} and {end} in {self.source_path}')
+
+    def _register(self, name:str, files:list) -> list:
+      '''
+      This function registers the files as a DuckDB view. Local files are scanned by DuckDB,
+      files in a bucket through a pyarrow dataset, which also takes the pushed down filters.
+      Must be called holding the lock.
+      Returns:
+      - list: Columns of the view
+      '''
+      paths=[f[0] for f in files]
+      if self.filesystem is None:
+        relation=self._con.read_parquet(paths, hive_partitioning=True, union_by_name=True)
+        relation.create_view(name, replace=True)
+      else:
+        dataset=ds.dataset(
+          paths,
+          filesystem=self.filesystem,
+          format='parquet',
+          partitioning=ds.partitioning(flavor='hive'),
+          partition_base_dir=self._base_path
+        )
+        self._con.register(name, dataset)
+      return [c[0] for c in self._con.execute(f'DESCRIBE {name}').fetchall()]
+
+    def _hour_columns(self, columns:list, hours:list) -> list:
+      '''
+      This function maps the queried hours, as hour of start (0 to 23) or column names, to the hourly columns.
+      '''
+      hour_cols=[c for c in columns if re.search(string=c, pattern=HOURLY_COLUMN_PATTERN)]
+      if hours is None:
+        return hour_cols
+      selected=[]
+      for hour in hours:
+        if isinstance(hour, str) and not hour.isdigit():
+          matches=[hour] if hour in hour_cols else []
+        else:
+          matches=[c for c in hour_cols if re.search(string=c, pattern=f'^h{int(hour)}(_|$)')]
+        if matches == []:
+          raise Exception(f'Hour {hour} not found in the hourly columns {hour_cols}')
+        selected.extend(m for m in matches if m not in selected)
+      return selected
+
+    def _result(self, sql:str, params:list, output:str):
+      result=self._con.execute(sql, params)
+      if output == 'arrow':
+        return result.to_arrow_table()
+      if output == 'pandas':
+        return result.df()
+      raise Exception(f'Unknown output {output}, use pandas or arrow')
+
+    def query(
+      self,
+      start,
+      end,
+      units:list=None,
+      hours:list=None,
+      columns:list=None,
+      output:str='pandas'
+    ):
+      '''
+      This function queries the predispatch of a range of days.
+      Parameters:
+      - start: First day, as date, datetime or 'YYYY-MM-DD'
+      - end: Last day, included
+      - units (list): Values of plantas to keep. None keeps every unit
+      - hours (list): Hours to keep, as hour of start (0 to 23) or hourly column names, i.e. 'h0_1'.
+        None keeps every hour
+      - columns (list): Other columns to return. With hours and columns None every column is returned
+      - output (str): 'pandas' or 'arrow'
+      Returns:
+      - DataFrame or pyarrow Table with the rows of the days, ordered by fecha and plantas
+      '''
+      start, end=_to_date(start), _to_date(end)
+      files=self._matching(start, end)
+      with self._lock:
+        available=self._register('predispatch', files)
+        where=['fecha >= ?::TIMESTAMP', 'fecha < ?::TIMESTAMP']
+        params=[datetime.combine(start, datetime.min.time()), datetime.combine(end+timedelta(days=1), datetime.min.time())]
+        if units is not None:
+          where.append(f'plantas IN ({", ".join("?"*len(units))})')
+          params.extend(str(u) for u in units)
+
+        if self.layout == 'wide':
+          if hours is None and columns is None:
+            selected=list(available)
+          else:
+            selected=[c for c in ID_COLUMNS if c in available]+self._hour_columns(available, hours)
+        else:
+          selected=[c for c in LONG_COLUMNS if c in available]
+          if hours is not None:
+            ## Hours of start are matched on interval_start, column names on hour_interval
+            names=[h for h in hours if isinstance(h, str) and not h.isdigit()]
+            starts=[int(h) for h in hours if h not in names]
+            matches=[]
+            if names != []:
+              matches.append(f'hour_interval IN ({", ".join("?"*len(names))})')
+              params.extend(names)
+            if starts != []:
+              matches.append(f'hour(interval_start) IN ({", ".join("?"*len(starts))})')
+              params.extend(starts)
+            where.append(f'({" OR ".join(matches)})' if matches != [] else 'FALSE')
+        for c in columns or []:
+          if c not in available:
+            raise Exception(f'Column {c} not found in the {self.layout} predispatch files')
+          if c not in selected:
+            selected.append(c)
+
+        order=[c for c in ('fecha', 'plantas', 'interval_start') if c in selected]
+        sql=(f'SELECT {", ".join(_quote(c) for c in selected)} FROM predispatch WHERE {" AND ".join(where)}'
+             + (f' ORDER BY {", ".join(_quote(c) for c in order)}' if order != [] else ''))
+        return self._result(sql, params, output)
+
+    def _daily_sql(self, available:list) -> str:
+      '''
+      This function returns the aggregation of the view to one row per day and unit: the sum, mean,
+      minimum and maximum of the hourly values and the hours with a value. The wide hourly columns
+      are unpivoted first, so both layouts give the same aggregates.
+      '''
+      if self.layout == 'wide':
+        hour_cols=self._hour_columns(available, None)
+        source=(f'(UNPIVOT (SELECT fecha, plantas, {", ".join(_quote(c) for c in hour_cols)} FROM predispatch '
+                f'WHERE fecha >= ?::TIMESTAMP AND fecha < ?::TIMESTAMP) '
+                f'ON {", ".join(_quote(c) for c in hour_cols)} INTO NAME hour_interval VALUE value)')
+      else:
+        source='(SELECT fecha, plantas, value FROM predispatch WHERE fecha >= ?::TIMESTAMP AND fecha < ?::TIMESTAMP)'
+      return (f'SELECT CAST(fecha AS DATE) AS fecha, plantas, sum(value) AS value_sum, avg(value) AS value_mean, '
+              f'min(value) AS value_min, max(value) AS value_max, count(value) AS hours FROM {source} '
+              f'GROUP BY ALL ORDER BY fecha, plantas')
+
+    def _aggregate(self, start:date, end:date) -> pa.Table:
+      ## Daily aggregates computed from the files, must be called holding the lock
+      files=self._pruned(start, end)
+      if files == []:
+        return None
+      sql=self._daily_sql(self._register('predispatch', files))
+      bounds=[datetime.combine(start, datetime.min.time()), datetime.combine(end+timedelta(days=1), datetime.min.time())]
+      return self._con.execute(sql, bounds).to_arrow_table()
+
+    def _daily_path(self) -> str:
+      return f'{self.cache_path}/{self.layout}_daily'
+
+    def _month_signature(self, month:str) -> str:
+      ## Changes when a file of the month is added, removed or rewritten
+      first, last=_to_date(f'{month}-01'), _month_end(month)
+      files=[(f[0], f[3], f[4]) for f in self._pruned(first, last)]
+      return hashlib.sha1(json.dumps(files).encode()).hexdigest()
+
+    def materialize_daily(self, start, end) -> list:
+      '''
+      This function writes the daily aggregates of the months between start and end to cache_path,
+      one Parquet file per month. Months whose files did not change since they were materialized
+      are skipped.
+      Parameters:
+      - start: First day, as date, datetime or 'YYYY-MM-DD'
+      - end: Last day, included
+      Returns:
+      - list: Months materialized by this call
+      '''
+      if self.cache_path is None:
+        raise Exception('The daily aggregates need a cache_path')
+      start, end=_to_date(start), _to_date(end)
+      self._matching(start, end)
+      manifest_path=f'{self._daily_path()}/_manifest.json'
+      manifest={}
+      if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+          manifest=json.load(f)
+
+      months=sorted({(start+timedelta(days=d)).strftime('%Y-%m') for d in range((end-start).days+1)})
+      materialized=[]
+      for month in months:
+        signature=self._month_signature(month)
+        month_path=f'{self._daily_path()}/mes={month}/daily.parquet'
+        if manifest.get(month) == signature and os.path.exists(month_path):
+          continue
+        with self._lock:
+          table=self._aggregate(_to_date(f'{month}-01'), _month_end(month))
+        if table is None:
+          if os.path.exists(month_path):
+            os.remove(month_path)
+        else:
+          os.makedirs(os.path.dirname(month_path), exist_ok=True)
+          pq.write_table(table, f'{month_path}.tmp', compression='zstd')
+          os.replace(f'{month_path}.tmp', month_path)
+        manifest[month]=signature
+        materialized.append(month)
+
+      if materialized != []:
+        os.makedirs(self._daily_path(), exist_ok=True)
+        with open(f'{manifest_path}.tmp', 'w') as f:
+          json.dump(manifest, f, indent=1)
+        os.replace(f'{manifest_path}.tmp', manifest_path)
+        print(f'[Info] Materialized the daily aggregates of {len(materialized)} months in {self._daily_path()}')
+      return materialized
+
+    def query_daily(self, start, end, units:list=None, output:str='pandas'):
+      '''
+      This function queries the daily aggregates per unit of a range of days, from the cache when
+      there is a cache_path, refreshing the months that changed, or from the files otherwise.
+      Parameters:
+      - start: First day, as date, datetime or 'YYYY-MM-DD'
+      - end: Last day, included
+      - units (list): Values of plantas to keep. None keeps every unit
+      - output (str): 'pandas' or 'arrow'
+      Returns:
+      - DataFrame or pyarrow Table with fecha, plantas, value_sum, value_mean, value_min, value_max and hours
+      '''
+      start, end=_to_date(start), _to_date(end)
+      where=['fecha BETWEEN ? AND ?']
+      params=[start, end]
+      if units is not None:
+        where.append(f'plantas IN ({", ".join("?"*len(units))})')
+        params.extend(str(u) for u in units)
+
+      if self.cache_path is not None:
+        self.materialize_daily(start, end)
+        months=sorted({(start+timedelta(days=d)).strftime('%Y-%m') for d in range((end-start).days+1)})
+        paths=[f'{self._daily_path()}/mes={m}/daily.parquet' for m in months]
+        paths=[p for p in paths if os.path.exists(p)]
+        with self._lock:
+          if paths == []:
+            return pd.DataFrame() if output == 'pandas' else pa.table({})
+          self._con.read_parquet(paths).create_view('daily', replace=True)
+          return self._result(f'SELECT * FROM daily WHERE {" AND ".join(where)} ORDER BY fecha, plantas', params, output)
+
+      with self._lock:
+        self._matching(start, end)
+        table=self._aggregate(start, end)
+        self._con.register('daily', table)
+        return self._result(f'SELECT * FROM daily WHERE {" AND ".join(where)} ORDER BY fecha, plantas', params, output)
+
+## Query layers shared by the calls of a process, per source and options
+_QUERIES = {}
+_QUERIES_LOCK = threading.Lock()
+
+def get_query(source_path:str, layout:str='wide', cache_path:str=None, api_endpoint:str=None) -> PREDISPATCH_QUERY:
+    '''
+    Returns the query layer of the process for a source, so the listing of the files is reused between calls.
+    '''
+    with _QUERIES_LOCK:
+        key=(source_path, layout, cache_path, api_endpoint)
+        if key not in _QUERIES:
+            _QUERIES[key]=PREDISPATCH_QUERY(source_path, layout=layout, cache_path=cache_path, api_endpoint=api_endpoint)
+        return _QUERIES[key]
+
+def query_predispatch(
+    start,
+    end,
+    units:list=None,
+    hours:list=None,
+    source_path:str=None,
+    layout:str='wide',
+    daily:bool=False,
+    cache_path:str=None,
+    output:str='pandas',
+    api_endpoint:str=None
+):
+    '''
+    Queries the parsed predispatch of a range of days, i.e.
+    query_predispatch('2024-01-01', '2024-12-31', units=['BAYANO 1'], hours=[18, 19, 20], source_path='data/dataset')
+    Parameters:
+    - start: First day, as date, datetime or 'YYYY-MM-DD'
+    - end: Last day, included
+    - units (list): Values of plantas to keep. None keeps every unit
+    - hours (list): Hours of start (0 to 23) or hourly column names to keep. Ignored by daily
+    - source_path (str): Folder or 'gs://bucket/folder' of the parsed files. Defaults to PREDISPATCH_SOURCE_PATH
+    - layout (str): 'wide' or 'long' files
+    - daily (bool): Returns the daily aggregates per unit instead of the hourly values
+    - cache_path (str): Folder of the materialized daily aggregates. Defaults to PREDISPATCH_CACHE_PATH, None aggregates every time
+    - output (str): 'pandas' or 'arrow'
+    - api_endpoint (str): Storage endpoint of a local emulator for gs:// sources
+    Returns:
+    - DataFrame or pyarrow Table
+    '''
+    source_path=source_path or os.environ.get('PREDISPATCH_SOURCE_PATH')
+    if source_path is None:
+        raise Exception('No source_path given and PREDISPATCH_SOURCE_PATH is not set')
+    query=get_query(source_path, layout, cache_path or os.environ.get('PREDISPATCH_CACHE_PATH'), api_endpoint)
+    if daily:
+        return query.query_daily(start, end, units=units, output=output)
+    return query.query(start, end, units=units, hours=hours, output=output)
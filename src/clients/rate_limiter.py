@@ -0,0 +1,79 @@
+import threading
+import time
+
+
+class RATE_LIMITER:
+
+    def __init__(
+        self,
+        rate:float=1.0,
+        capacity:float=None,
+        min_rate:float=0.1,
+        max_rate:float=5.0,
+        backoff_factor:float=0.5,
+        recovery_step:float=0.1
+    )->None:
+        '''
+        Token bucket shared by every request sent to CND. The refill rate adapts
+        to the server: it is cut on HTTP 429/5xx and grows back while responses are healthy.
+        Parameters:
+        - rate (float): Initial number of requests per second
+        - capacity (float): Maximum burst of requests. Defaults to max(1, rate)
+        - min_rate (float): Lower bound for the refill rate
+        - max_rate (float): Upper bound for the refill rate
+        - backoff_factor (float): Multiplier applied to the rate on 429/5xx responses
+        - recovery_step (float): Requests per second added back after each healthy response
+        '''
+        self.rate=rate
+        self.capacity=capacity if capacity is not None else max(1.0, rate)
+        self.min_rate=min_rate
+        self.max_rate=max_rate
+        self.backoff_factor=backoff_factor
+        self.recovery_step=recovery_step
+        self._tokens=self.capacity
+        self._last_refill=time.monotonic()
+        self._blocked_until=0.0
+        self._lock=threading.Lock()
+
+    def _refill(self, now:float)->None:
+      '''
+      This function adds the tokens earned since the last refill. Must be called holding the lock.
+      '''
+      self._tokens=min(self.capacity, self._tokens+(now-self._last_refill)*self.rate)
+      self._last_refill=now
+
+    def acquire(self)->None:
+      '''
+      This function blocks until a token is available and consumes it.
+      Parameters:
+      - None
+      Returns:
+      - None
+      '''
+      while True:
+        with self._lock:
+          now=time.monotonic()
+          self._refill(now)
+          if now >= self._blocked_until and self._tokens >= 1:
+            self._tokens-=1
+            return
+          wait=max(self._blocked_until-now, (1-self._tokens)/self.rate)
+        time.sleep(wait)
+
+    def report(self, status_code:int=None, retry_after:float=None)->None:
+      '''
+      This function adapts the refill rate to the last response from the server.
+      Parameters:
+      - status_code (int): HTTP status code of the response. None if the request failed without response
+      - retry_after (float): Seconds requested by the server through the Retry-After header
+      Returns:
+      - None
+      '''
+      with self._lock:
+        if status_code is None or status_code == 429 or status_code >= 500:
+          self.rate=max(self.min_rate, self.rate*self.backoff_factor)
+          self._tokens=min(self._tokens, 0)
+          if retry_after is not None:
+            self._blocked_until=max(self._blocked_until, time.monotonic()+retry_after)
+        elif status_code < 400:
+          self.rate=min(self.max_rate, self.rate+self.recovery_step)
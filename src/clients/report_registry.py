@@ -0,0 +1,67 @@
+import re
+from src.clients.cnd_parser import CND_PARSER
+
+## Reports of CND ingested by the flow, by name. Every report is listed with its categoria and
+## tipo and parsed by a class with the CND_PARSER interface
+REPORTS = {}
+
+def register_report(
+    name:str,
+    categoria:str,
+    tipo:str,
+    header:int=3,
+    output_prefix:str=None,
+    parser:type=CND_PARSER,
+    bq_table:str=None
+) -> dict:
+    '''
+    Adds a report to the registry, or replaces it.
+    Parameters:
+    - name (str): Name of the report, also its folder in staging, the bucket and the datasets
+    - categoria (str): categoria of the CND listing
+    - tipo (str): tipo of the CND listing
+    - header (int): Expected header row of the sheets, detected when the layout differs
+    - output_prefix (str): Prefix of the parsed files. Defaults to cnd_<name>
+    - parser (type): Parser class with the CND_PARSER interface. It must live at module level for the parse pool
+    - bq_table (str): BigQuery table the report is merged into. None skips BigQuery for it
+    Returns:
+    - dict: The registered report
+    '''
+    if not re.fullmatch(r'[a-z0-9_]+', name):
+        raise Exception(f'Invalid report name {name}, use lower case letters, digits and _')
+    REPORTS[name]={
+        'name': name,
+        'categoria': str(categoria),
+        'tipo': str(tipo),
+        'header': header,
+        'output_prefix': output_prefix if output_prefix is not None else f'cnd_{name}',
+        'parser': parser,
+        'bq_table': bq_table
+    }
+    return REPORTS[name]
+
+def get_report(report) -> dict:
+    '''
+    Returns a report of the registry by name. A dict overrides the fields of the registered
+    report of its name, or describes a report that is not registered with at least name,
+    categoria and tipo, taking the defaults of register_report.
+    '''
+    if isinstance(report, dict):
+        missing=[k for k in ('name', 'categoria', 'tipo') if k not in report and k not in REPORTS.get(report.get('name'), {})]
+        if missing != []:
+            raise Exception(f'Report {report} is missing {missing}')
+        defaults={'header': 3, 'output_prefix': f'cnd_{report["name"]}', 'parser': CND_PARSER, 'bq_table': None}
+        return {**defaults, **REPORTS.get(report['name'], {}), **report}
+    if report not in REPORTS:
+        raise Exception(f'Unknown report {report}, registered reports are {sorted(REPORTS)}')
+    return REPORTS[report]
+
+def report_payload(report:dict, payload:dict) -> dict:
+    '''
+    Returns the listing payload of a report: the shared fields of payload, i.e. key and publico,
+    with the categoria and tipo of the report.
+    '''
+    return {**payload, 'categoria': report['categoria'], 'tipo': report['tipo']}
+
+## Weekly predispatch, the report of main public.py
+register_report('predispatch', categoria='6', tipo='76', header=3, output_prefix='cnd_predespacho_diario')
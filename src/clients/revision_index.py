@@ -0,0 +1,283 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+## Columns describing the published file, not the content of a row
+METADATA_COLUMNS = ('fecha', 'file_id', 'file_name', 'epoch_public_date', 'change_type', 'revision')
+## Version of the index, stored as the SQLite user_version. Since version 2 the sources are keyed by file
+INDEX_VERSION = 2
+
+def file_source(file_name:str, member:str='') -> str:
+    '''
+    Returns the source of a workbook in the index: the stem of its file, and of its member for
+    multi-file archives, i.e. predespacho_2025 or predespacho_2025_a. It is the output name of the parser.
+    '''
+    return (file_name.split('.')[0]+('_'+member if member else '')).lower()
+
+def content_hashes(df:pd.DataFrame, unit_column:str) -> np.ndarray:
+    '''
+    Hashes the content of every row, metadata and unit excluded, as int64. The column names are
+    part of the hash, so a row is changed when the columns of its sheet change.
+    Parameters:
+    - df: Parsed dataframe, coerced to the declared schema so equal values hash equal
+    - unit_column (str): Column identifying the unit of a row
+    Returns:
+    - np.ndarray: Hash of every row
+    '''
+    columns=sorted(c for c in df.columns if c != unit_column and c not in METADATA_COLUMNS)
+    names_hash=np.uint64(int(hashlib.sha1('\x1f'.join(columns).encode()).hexdigest()[:15], 16))
+    if columns == []:
+        hashes=np.zeros(len(df), dtype='uint64')
+    else:
+        hashes=pd.util.hash_pandas_object(df[columns], index=False).to_numpy()
+    return (hashes ^ names_hash).view('int64')
+
+class REVISION_INDEX:
+
+    def __init__(
+        self,
+        db_path:str
+    )->None:
+        '''
+        Index of the versions of every day ingested from CND, in a SQLite file. A version is a
+        published file, identified by its file id and fechaPublica, and keeps the content hash of
+        every (fecha, unit) row it had. The workbooks of a multi-file archive are versioned apart,
+        by their member name. When CND republishes a day, the parsed rows are compared with the
+        previous version of the same source so only the inserted, updated and deleted rows are written.
+        A source is a workbook, keyed by the stem of its file, so different files listed for the same
+        day keep their own version history.
+        Parsing the same version again gives the same delta. It is shared by the threads of a
+        process and safe to open from several processes.
+        Parameters:
+        - db_path (str): SQLite file of the index. It must live outside staging_path
+        '''
+        self.db_path=db_path
+        self._lock=threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._conn=sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=60)
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            ## Indexes written before the sources of a day were versioned apart are migrated below
+            legacy=[r[1] for r in self._conn.execute('PRAGMA table_info(versions)')]
+            legacy=legacy != [] and 'source' not in legacy
+            if legacy:
+                self._conn.execute('ALTER TABLE versions RENAME TO versions_legacy')
+                self._conn.execute('ALTER TABLE row_hashes RENAME TO row_hashes_legacy')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS versions (
+                    day TEXT NOT NULL,
+                    source TEXT NOT NULL DEFAULT '',
+                    revision INTEGER NOT NULL,
+                    file_id INTEGER,
+                    file_name TEXT,
+                    epoch_public_date TEXT,
+                    rows INTEGER,
+                    inserted INTEGER,
+                    updated INTEGER,
+                    deleted INTEGER,
+                    delta_paths TEXT,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (day, source, revision)
+                )''')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS row_hashes (
+                    day TEXT NOT NULL,
+                    source TEXT NOT NULL DEFAULT '',
+                    revision INTEGER NOT NULL,
+                    unit TEXT NOT NULL,
+                    occurrence INTEGER NOT NULL,
+                    row_hash INTEGER NOT NULL,
+                    PRIMARY KEY (day, source, revision, unit, occurrence)
+                )''')
+            if legacy:
+                self._conn.execute(
+                    'INSERT INTO versions (day, revision, file_id, file_name, epoch_public_date, rows, inserted, updated, deleted, delta_paths, created_at) '
+                    'SELECT day, revision, file_id, file_name, epoch_public_date, rows, inserted, updated, deleted, delta_paths, created_at FROM versions_legacy'
+                )
+                self._conn.execute(
+                    'INSERT INTO row_hashes (day, revision, unit, occurrence, row_hash) '
+                    'SELECT day, revision, unit, occurrence, row_hash FROM row_hashes_legacy'
+                )
+                self._conn.execute('DROP TABLE versions_legacy')
+                self._conn.execute('DROP TABLE row_hashes_legacy')
+            if self._conn.execute('PRAGMA user_version').fetchone()[0] < INDEX_VERSION:
+                self._rekey_sources()
+
+    def _rekey_sources(self) -> None:
+      '''
+      This function keys the versions of indexes before INDEX_VERSION by file. Their sources were ''
+      for single workbooks and the member name for archives, so every file of a day shared one history.
+      Must be called holding the lock.
+      '''
+      self._conn.execute('BEGIN IMMEDIATE')
+      try:
+        if self._conn.execute('PRAGMA user_version').fetchone()[0] < INDEX_VERSION:
+          versions=self._conn.execute('SELECT day, source, revision, file_name FROM versions').fetchall()
+          ## Moved aside first, so a new source can not collide with an old one
+          for table in ('versions', 'row_hashes'):
+            self._conn.execute(f"UPDATE {table} SET source = char(31) || source")
+          for day, source, revision, file_name in versions:
+            for table in ('versions', 'row_hashes'):
+              self._conn.execute(
+                f'UPDATE {table} SET source = ? WHERE day = ? AND source = ? AND revision = ?',
+                (file_source(file_name or '', source), day, chr(31)+source, revision)
+              )
+          self._conn.execute(f'PRAGMA user_version={INDEX_VERSION}')
+        self._conn.execute('COMMIT')
+      except Exception:
+        self._conn.execute('ROLLBACK')
+        raise
+
+    def close(self) -> None:
+      with self._lock:
+        self._conn.close()
+
+    def _row_keys(self, df:pd.DataFrame, unit_column:str) -> pd.DataFrame:
+      ## Units repeated in a sheet are told apart by their occurrence
+      units=df[unit_column].astype(str).where(df[unit_column].notna(), '')
+      return pd.DataFrame({'unit': units.to_numpy(), 'occurrence': units.groupby(units.to_numpy()).cumcount().to_numpy()})
+
+    def diff(self, df:pd.DataFrame, unit_column:str, source:str='') -> tuple:
+      '''
+      This function compares the rows of a parsed day with the previous version of the day.
+      Parameters:
+      - df: Parsed dataframe of a single fecha, with the metadata of its file and the declared schema
+      - unit_column (str): Column identifying the unit of a row, i.e. plantas
+      - source (str): Workbook the day was read from, see file_source
+      Returns:
+      - tuple: Delta dataframe and the revision to commit once the delta is written. The delta has
+        the inserted and updated rows, plus one row with the unit and metadata per deleted row,
+        with change_type 'insert', 'update' or 'delete' and the revision of the day
+      '''
+      day=pd.to_datetime(df['fecha'].iloc[0]).strftime('%Y-%m-%d')
+      file_id=int(df['file_id'].iloc[0])
+      epoch_public_date=str(df['epoch_public_date'].iloc[0])
+      keys=self._row_keys(df, unit_column)
+      keys['row_hash']=content_hashes(df, unit_column)
+
+      with self._lock:
+        versions=self._conn.execute(
+          'SELECT revision, file_id, epoch_public_date FROM versions WHERE day = ? AND source = ? ORDER BY revision',
+          (day, source)
+        ).fetchall()
+        same=[v[0] for v in versions if v[1] == file_id and v[2] == epoch_public_date]
+        ## The same version parsed again is compared with the version before it
+        revision=same[-1] if same != [] else (versions[-1][0]+1 if versions != [] else 1)
+        previous=[v[0] for v in versions if v[0] < revision]
+        rows=self._conn.execute(
+          'SELECT unit, occurrence, row_hash FROM row_hashes WHERE day = ? AND source = ? AND revision = ?',
+          (day, source, previous[-1])
+        ).fetchall() if previous != [] else []
+      ## Nullable, so the hashes of the units not seen before do not turn to float
+      previous_hashes=pd.DataFrame(rows, columns=['unit', 'occurrence', 'previous_hash']).astype({'occurrence': 'int64', 'previous_hash': 'Int64'})
+
+      merged=keys.merge(previous_hashes, on=['unit', 'occurrence'], how='left')
+      inserted=merged['previous_hash'].isna().to_numpy()
+      updated=~inserted & (merged['previous_hash'].fillna(0).to_numpy(dtype='int64') != merged['row_hash'].to_numpy())
+      change=np.where(inserted, 'insert', np.where(updated, 'update', ''))
+      delta=df[change != ''].copy()
+      delta['change_type']=change[change != '']
+
+      deleted=previous_hashes.merge(keys, on=['unit', 'occurrence'], how='left', indicator=True)
+      deleted=deleted[deleted['_merge'] == 'left_only']
+      if len(deleted) > 0:
+        deletes=pd.DataFrame({
+          unit_column: deleted['unit'].to_numpy(),
+          'fecha': df['fecha'].iloc[0],
+          'file_id': df['file_id'].iloc[0],
+          'file_name': df['file_name'].iloc[0],
+          'epoch_public_date': df['epoch_public_date'].iloc[0],
+          'change_type': 'delete'
+        })
+        delta=pd.concat([delta, deletes], ignore_index=True)
+      delta['revision']=revision
+
+      counts={c: int((delta['change_type'] == c).sum()) for c in ('insert', 'update', 'delete')}
+      return delta, {
+        'day': day,
+        'source': source,
+        'revision': revision,
+        'file_id': file_id,
+        'file_name': str(df['file_name'].iloc[0]),
+        'epoch_public_date': epoch_public_date,
+        'rows': len(df),
+        'counts': counts,
+        'keys': keys
+      }
+
+    def commit(self, revision:dict, delta_paths:list=None) -> None:
+      '''
+      This function records a revision from diff as the current version of its day.
+      Parameters:
+      - revision (dict): Revision returned by diff
+      - delta_paths (list): Files the delta was written to
+      '''
+      day, source, number=revision['day'], revision['source'], revision['revision']
+      keys=revision['keys']
+      with self._lock:
+        self._conn.execute('BEGIN')
+        try:
+          self._conn.execute('DELETE FROM row_hashes WHERE day = ? AND source = ? AND revision = ?', (day, source, number))
+          self._conn.executemany(
+            'INSERT INTO row_hashes (day, source, revision, unit, occurrence, row_hash) VALUES (?, ?, ?, ?, ?, ?)',
+            [(day, source, number, u, int(o), int(h)) for u, o, h in zip(keys['unit'], keys['occurrence'], keys['row_hash'])]
+          )
+          self._conn.execute(
+            'INSERT OR REPLACE INTO versions (day, source, revision, file_id, file_name, epoch_public_date, rows, inserted, updated, deleted, delta_paths, created_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (day, source, number, revision['file_id'], revision['file_name'], revision['epoch_public_date'], revision['rows'],
+             revision['counts']['insert'], revision['counts']['update'], revision['counts']['delete'],
+             json.dumps(delta_paths or []), time.time())
+          )
+          ## Older versions only keep their summary, their hashes are not compared anymore
+          self._conn.execute('DELETE FROM row_hashes WHERE day = ? AND source = ? AND revision < ?', (day, source, number-1))
+          self._conn.execute('COMMIT')
+        except Exception:
+          self._conn.execute('ROLLBACK')
+          raise
+
+    def versions(self, requested_date=None) -> pd.DataFrame:
+      '''
+      This function returns the version index, one row per day, source and revision with its file
+      and the inserted, updated and deleted rows.
+      Parameters:
+      - requested_date: Day to return. None returns every day
+      '''
+      query='SELECT day, source, revision, file_id, file_name, epoch_public_date, rows, inserted, updated, deleted, delta_paths, created_at FROM versions'
+      params=()
+      if requested_date is not None:
+        query+=' WHERE day = ?'
+        params=(pd.to_datetime(requested_date).strftime('%Y-%m-%d'),)
+      with self._lock:
+        rows=self._conn.execute(f'{query} ORDER BY day, source, revision', params).fetchall()
+      return pd.DataFrame(rows, columns=['day', 'source', 'revision', 'file_id', 'file_name', 'epoch_public_date', 'rows',
+                                         'inserted', 'updated', 'deleted', 'delta_paths', 'created_at'])
+
+## Indexes shared by the parses of a process, per path
+_INDEXES = {}
+_INDEXES_LOCK = threading.Lock()
+
+def get_index(db_path:str) -> REVISION_INDEX:
+    '''
+    Returns the revision index of the process for a path. Parses in threads share it, every worker
+    of a process pool opens its own connection to db_path.
+    '''
+    with _INDEXES_LOCK:
+        if db_path not in _INDEXES:
+            _INDEXES[db_path]=REVISION_INDEX(db_path)
+        return _INDEXES[db_path]
+
+def close_index(db_path:str) -> None:
+    '''
+    Closes the revision index of the process for a path, if it was opened.
+    '''
+    with _INDEXES_LOCK:
+        index=_INDEXES.pop(db_path, None)
+    if index is not None:
+        index.close()
@@ -0,0 +1,247 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import pandas as pd
+
+## Hour interval headers of the CND sheets, i.e. '0-1' or '23 - 24'
+HOUR_HEADER_PATTERN = r'^\s*[0-9]{1,2}\s*[-–]\s*[0-9]{1,2}\s*$'
+
+## Same cleaning as CND_PARSER._rename_columns, the table is built once
+COLUMN_TRANSLATION = str.maketrans({
+    '-': '_',
+    ' ': '',
+    '(': '',
+    ')': '',
+    '[': '',
+    ']': '',
+    '$': '_USD'
+})
+
+## Dtypes cached per layout. Integer columns are left to the inference, a blank turns them to float
+HINTED_DTYPES = ('float64',)
+
+## Version of the layouts built by the registry. Older persisted layouts are rebuilt from their header
+LAYOUT_VERSION = 3
+
+def clean_column(name:str, hours_cols_bool:bool=True) -> str:
+    '''
+    Removes special characters, white spaces to '', - to _ and $ to USD, in lower case.
+    With hours_cols_bool the hourly columns get an h prefix, i.e. 0_1 to h0_1.
+    '''
+    col=name.translate(COLUMN_TRANSLATION).strip().lower()
+    if hours_cols_bool and col[:1].isdigit():
+        col=f'h{col}'
+    return col
+
+def _cell(value) -> str:
+    ## Header cell as text, empty cells as ''
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        value=int(value)
+    return str(value).strip()
+
+class SCHEMA_REGISTRY:
+
+    def __init__(
+        self,
+        registry_path:str=None,
+        strict:bool=False,
+        scan_rows:int=20
+    )->None:
+        '''
+        Registry of the sheet layouts seen by CND_PARSER. A layout is identified by the
+        fingerprint of its header row, and keeps the header row index, the used columns,
+        their cleaned names and the dtypes inferred the first time it was parsed. Repeated
+        layouts keep only their used columns and skip the dtype inference, new layouts get
+        their header row detected and are reported as layout drift.
+        Parameters:
+        - registry_path (str): JSON file where the layouts are persisted. None keeps them in memory
+        - strict (bool): Raises on layout drift instead of only reporting it
+        - scan_rows (int): Rows at the top of a sheet read to find its header
+        '''
+        self.registry_path=registry_path
+        self.strict=strict
+        self.scan_rows=scan_rows
+        self._lock=threading.Lock()
+        self._layouts={}
+
+        if registry_path is not None and os.path.exists(registry_path):
+            with open(registry_path) as f:
+                self._layouts={k: self._upgrade(l) for k, l in json.load(f)['layouts'].items()}
+
+    @property
+    def layouts(self) -> dict:
+      with self._lock:
+        return dict(self._layouts)
+
+    def _save(self) -> None:
+      '''
+      This function writes the layouts atomically, merged with the ones other processes
+      saved meanwhile. Must be called holding the lock.
+      '''
+      if self.registry_path is None:
+        return
+      if os.path.exists(self.registry_path):
+        with open(self.registry_path) as f:
+          for fingerprint, layout in json.load(f)['layouts'].items():
+            self._layouts.setdefault(fingerprint, layout)
+      os.makedirs(os.path.dirname(os.path.abspath(self.registry_path)), exist_ok=True)
+      tmp_path=f'{self.registry_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+      with open(tmp_path, 'w') as f:
+        json.dump({'layouts': self._layouts}, f, indent=1)
+      os.replace(tmp_path, self.registry_path)
+
+    def fingerprint(self, header_row:int, cells:list) -> str:
+      '''
+      This function fingerprints a header row by its position and its cells, trailing empty cells ignored.
+      '''
+      cells=[_cell(c) for c in cells]
+      while cells and cells[-1] == '':
+        cells.pop()
+      return hashlib.sha1(json.dumps([header_row, cells]).encode()).hexdigest()[:16]
+
+    def detect_header(self, rows:list) -> int:
+      '''
+      This function finds the header row of a sheet: the first row with hour interval
+      headers, or else the first row starting with Plantas.
+      Parameters:
+      - rows (list): Top rows of the sheet
+      Returns:
+      - int: Index of the header row, None if not found
+      '''
+      for i, row in enumerate(rows):
+        if sum(1 for c in row if re.search(string=_cell(c), pattern=HOUR_HEADER_PATTERN)) >= 6:
+          return i
+      for i, row in enumerate(rows):
+        if row and _cell(row[0]).lower().startswith('planta'):
+          return i
+      return None
+
+    def _upgrade(self, layout:dict) -> dict:
+      '''
+      This function rebuilds a persisted layout of an older version from its header cells,
+      keeping its history. Cached dtypes are dropped, they are inferred again.
+      '''
+      if layout.get('version') == LAYOUT_VERSION:
+        return layout
+      upgraded=self._new_layout(layout['header_row'], layout['header'])
+      upgraded.update(first_seen=layout['first_seen'], sheets=layout['sheets'])
+      return upgraded
+
+    def _new_layout(self, header_row:int, cells:list) -> dict:
+      '''
+      This function builds a layout from its header cells. Every column up to the last header is read,
+      like pd.read_excel does: columns without header are named after their position, i.e. unnamed:27,
+      and repeated headers are numbered, i.e. total, total.1. Trailing columns without header, i.e.
+      notes right of the table, are not part of the layout, as for its fingerprint.
+      '''
+      used=[_cell(c) for c in cells]
+      while used and used[-1] == '':
+        used.pop()
+      usecols, columns, seen=[], [], {}
+      for i, c in enumerate(cells[:len(used)]):
+        name=_cell(c)
+        if name == '':
+          name=f'Unnamed: {i}'
+        if name in seen:
+          seen[name]+=1
+          name=f'{name}.{seen[name]}'
+        else:
+          seen[name]=0
+        usecols.append(i)
+        columns.append(clean_column(name))
+      return {
+        'header_row': header_row,
+        'header': [_cell(c) for c in cells],
+        'usecols': usecols,
+        'columns': columns,
+        'dtypes': None,
+        'version': LAYOUT_VERSION,
+        'first_seen': time.time(),
+        'sheets': 0
+      }
+
+    def _drift(self, layout:dict, location:str) -> None:
+      '''
+      This function reports a layout that differs from the known ones.
+      '''
+      previous=max(self._layouts.values(), key=lambda l: l['first_seen'])
+      added=[c for c in layout['columns'] if c not in previous['columns']]
+      removed=[c for c in previous['columns'] if c not in layout['columns']]
+      message=(f'Layout drift in {location}: header in row {layout["header_row"]} instead of {previous["header_row"]}, '
+               f'columns added {added}, removed {removed}')
+      if self.strict:
+        raise Exception(message)
+      print(f'[Error] {message}')
+
+    def resolve(self, rows:list, header:int=None, location:str=None) -> tuple:
+      '''
+      This function finds the layout of a sheet from its top rows. Known layouts are matched
+      by fingerprint, otherwise the header row is detected and the layout registered.
+      Parameters:
+      - rows (list): Top rows of the sheet, at least scan_rows when available
+      - header (int): Expected header row, it is checked first. None relies on the detection
+      - location (str): Sheet for messages
+      Returns:
+      - tuple: Fingerprint and layout
+      '''
+      with self._lock:
+        candidates=sorted({l['header_row'] for l in self._layouts.values()} | ({header} if header is not None else set()))
+        for header_row in candidates:
+          if header_row < len(rows):
+            fingerprint=self.fingerprint(header_row, rows[header_row])
+            if fingerprint in self._layouts:
+              self._layouts[fingerprint]['sheets']+=1
+              return fingerprint, self._layouts[fingerprint]
+
+        header_row=self.detect_header(rows)
+        if header_row is None:
+          raise Exception(f'Header row not found in the first {len(rows)} rows of {location}')
+        fingerprint=self.fingerprint(header_row, rows[header_row])
+        if fingerprint in self._layouts:
+          self._layouts[fingerprint]['sheets']+=1
+          return fingerprint, self._layouts[fingerprint]
+
+        layout=self._new_layout(header_row, rows[header_row])
+        if self._layouts != {}:
+          self._drift(layout, location)
+        else:
+          print(f'[Info] Registered layout {fingerprint} of {location}, header in row {header_row}')
+        layout['sheets']=1
+        self._layouts[fingerprint]=layout
+        self._save()
+        return fingerprint, layout
+
+    def dtype_hints(self, fingerprint:str) -> dict:
+      with self._lock:
+        return dict(self._layouts[fingerprint]['dtypes'] or {})
+
+    def record_dtypes(self, fingerprint:str, df:pd.DataFrame) -> None:
+      '''
+      This function keeps the float dtypes inferred the first time a layout is parsed,
+      so the next sheets of the layout skip the inference of those columns.
+      '''
+      dtypes={c: str(t) for c, t in df.dtypes.items() if str(t) in HINTED_DTYPES}
+      with self._lock:
+        if self._layouts[fingerprint]['dtypes'] != dtypes:
+          self._layouts[fingerprint]['dtypes']=dtypes
+          self._save()
+
+## Registries shared by the parses of a process, per registry path and strictness
+_REGISTRIES = {}
+_REGISTRIES_LOCK = threading.Lock()
+
+def get_registry(registry_path:str=None, strict:bool=False) -> SCHEMA_REGISTRY:
+    '''
+    Returns the registry of the process for a path. Parses in threads share it, every worker
+    of a process pool loads its own from registry_path.
+    '''
+    with _REGISTRIES_LOCK:
+        key=(registry_path, strict)
+        if key not in _REGISTRIES:
+            _REGISTRIES[key]=SCHEMA_REGISTRY(registry_path=registry_path, strict=strict)
+        return _REGISTRIES[key]
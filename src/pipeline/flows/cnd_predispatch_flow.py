@@ -1,14 +1,478 @@
+import asyncio
+import io
 import os
+import multiprocessing
+import time
+import pandas as pd
 from datetime import datetime
-from src.clients.cnd_downloader import CND_DOWNLOADER
-from src.clients.cnd_parser import CND_PARSER
-from src.clients.gcp_client import GCP_UPLOADER
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+from typing import TYPE_CHECKING
+from src.clients.backfill_planner import plan_weekly_backfill
+from src.clients.backfill_state import BACKFILL_STATE
+from src.clients.cnd_listing import CND_LISTING
 from src.clients.date_adjuster import DATE_ADJUSTER
+from src.clients.download_cache import DOWNLOAD_CACHE
+from src.clients.http_session import build_session
+from src.clients.parquet_dataset import PARQUET_DATASET_WRITER
+from src.clients.parquet_writer import PARQUET_WRITER
+from src.clients.pipeline_metrics import PIPELINE_METRICS
+from src.clients.rate_limiter import RATE_LIMITER
 from src.clients.remove_directory import rm_directory
-from src.pipeline.tasks.cnd_predispatch_downparse import download_and_parse_files
-import time
+from src.clients.report_registry import get_report, report_payload
+from src.clients.revision_index import close_index
+from src.pipeline.tasks.cnd_predispatch_downparse import download_buffers, download_files, parse_downloaded_files
 import shutil
 
+## The cloud SDKs are imported only by runs that upload, see cnd_predispatch
+if TYPE_CHECKING:
+    from src.clients.gcp_client import GCP_UPLOADER
+
+def _upload_day(
+    day_staging_path:str,
+    date_str:str,
+    uploader:'GCP_UPLOADER'=None,
+    incremental_upload:bool=False,
+    bucket_name:str=None,
+    blob_folder_name:str=None,
+    gcs_regexp_file:str=None,
+    metrics:PIPELINE_METRICS=None,
+    buffers:dict=None
+) -> list:
+    '''
+    Uploads the parsed files of a day to <blob_folder_name>/<date> and cleans its staging folder.
+    The staging folder is kept when a file failed to upload. buffers, file name to Parquet bytes,
+    are uploaded instead of the staging folder.
+    Returns the upload result, if any, in a list.
+    '''
+    if uploader is not None: ## Without uploader we will only save them local
+        gcs_folder_name= f'{blob_folder_name}/{date_str}'
+
+        result=uploader.gcs_upload(
+                bucket_name=bucket_name,
+                blob_folder_name=gcs_folder_name,
+                regexp_file=gcs_regexp_file,
+                staging_path=day_staging_path,
+                incremental=incremental_upload,
+                buffers=buffers
+        )
+        _record_uploads(metrics, result, date=date_str)
+
+        if buffers is not None:
+            return [result]
+        if result['failed'] != []:
+            print(f'[Error] {len(result["failed"])} files of {date_str} failed to upload, keeping {day_staging_path}')
+            return [result]
+        rm_directory(day_staging_path)
+        return [result]
+    return []
+
+def _record_uploads(metrics:PIPELINE_METRICS, result:dict, **fields) -> None:
+    '''
+    Records every file of an upload result.
+    '''
+    if metrics is None:
+        return
+    for status in ('uploaded', 'skipped', 'failed'):
+        for r in result[status]:
+            metrics.record(
+                'upload',
+                status=status,
+                file_name=os.path.basename(r['local_path']),
+                blob_name=r['blob_name'],
+                seconds=r['seconds'],
+                bytes=r['bytes'] if status == 'uploaded' else 0,
+                mb_per_second=r['mb_per_second'],
+                error=r['error'],
+                **fields
+            )
+
+def _append_to_datasets(day_staging_path:str, datasets:dict, writer:PARQUET_WRITER, buffers:dict=None) -> None:
+    '''
+    Appends the parsed files of a day, or its buffers of Parquet bytes, to the dataset of
+    their layout and cleans its staging folder.
+    '''
+    if buffers is not None:
+        for f in sorted(buffers):
+            df=pd.read_parquet(io.BytesIO(buffers[f]))
+            datasets['long' if 'hour_interval' in df.columns else 'wide'].append(df)
+        return
+    if os.path.isdir(day_staging_path):
+        for f in sorted(os.listdir(day_staging_path)):
+            if not f.endswith(writer.extension):
+                continue
+            df=pd.read_parquet(f'{day_staging_path}/{f}')
+            datasets['long' if 'hour_interval' in df.columns else 'wide'].append(df)
+    rm_directory(day_staging_path)
+
+def _upload_datasets(
+    dataset_path:str,
+    datasets:dict,
+    compact:bool=True,
+    uploader:'GCP_UPLOADER'=None,
+    incremental_upload:bool=False,
+    bucket_name:str=None,
+    blob_folder_name:str=None,
+    gcs_regexp_file:str=None,
+    metrics:PIPELINE_METRICS=None
+) -> list:
+    '''
+    Writes the buffered rows, compacts the partitions appended in this run and mirrors the
+    dataset to <blob_folder_name>, removing the objects of the files merged by the compaction.
+    Returns the upload result, if any, in a list.
+    '''
+    removed=[]
+    for dataset in datasets.values():
+        dataset.flush()
+        if compact:
+            removed.extend(dataset.compact(sorted(dataset.appended_partitions))['removed'])
+
+    if uploader is None:
+        return []
+
+    result=uploader.gcs_upload(
+        bucket_name=bucket_name,
+        blob_folder_name=blob_folder_name,
+        regexp_file=gcs_regexp_file,
+        staging_path=dataset_path,
+        incremental=incremental_upload
+    )
+    _record_uploads(metrics, result, dataset=dataset_path)
+    if removed != []:
+        uploader.gcs_delete(
+            bucket_name=bucket_name,
+            blob_folder_name=blob_folder_name,
+            relative_paths=[os.path.relpath(p, dataset_path) for p in removed]
+        )
+    return [result]
+
+def _bigquery_uris(upload_results:list, bucket_name:str, layout:str, partition_dirs:set=None) -> list:
+    '''
+    Returns the gs:// uris of the uploaded objects of a layout, unchanged objects included.
+    Dataset files live under <layout>/, per day files of the long layout are named <prefix>_long_<file>.
+    partition_dirs keeps only the dataset partitions appended in the run, i.e. {'mes=2025-03'}.
+    '''
+    uris=[]
+    for result in upload_results:
+        for r in result['uploaded']+result['skipped']:
+            blob_layout='long' if '/long/' in f'/{r["blob_name"]}' or '_long_' in os.path.basename(r['blob_name']) else 'wide'
+            if partition_dirs is not None and os.path.basename(os.path.dirname(r['blob_name'])) not in partition_dirs:
+                continue
+            if blob_layout == layout and r['blob_name'].endswith(('.parquet', '.parquet.gz')):
+                uris.append(f'gs://{bucket_name}/{r["blob_name"]}')
+    return sorted(set(uris))
+
+def _report_path(path:str, folder:str) -> str:
+    ## Per report file of a state, schema registry or revision index, i.e. state.sqlite to state_<report>.sqlite
+    if path is None or folder is None:
+        return path
+    root, extension=os.path.splitext(path)
+    return f'{root}_{folder}{extension}'
+
+## Stage of the backfill state completed by each step of a unit
+_STAGE_STATES = {'download': 'downloaded', 'parse': 'parsed', 'upload': 'uploaded'}
+
+def _pipeline_unit(work_item, week_bool:bool, staging_path:str, report:dict, records:list=None) -> dict:
+    '''
+    Describes a day, or a week plan, of a report as a unit of work of the flow. Reports with a
+    folder stage and archive their files under it.
+    '''
+    folder=report['folder']
+    staging_path=f'{staging_path}/{folder}' if folder is not None else staging_path
+    archive_path=f'archive/{folder}' if folder is not None else 'archive'
+    label=f'{folder} ' if folder is not None else ''
+    if week_bool:
+        week_str=f'{work_item["anio"]}_{work_item["semana"]:02d}'
+        return {
+            'label': f'{label}week {week_str}',
+            'report': report,
+            'records': records,
+            'download_date': work_item['week_start'],
+            'week_bool': True,
+            'download_path': f'{staging_path}/week_{week_str}',
+            'archive_path': f'{archive_path}/week_{week_str}',
+            'output_dirs': {d: f'{staging_path}/{d.strftime("%Y-%m-%d")}' for d, _ in work_item['days']},
+            'upload_only': False
+        }
+    date_str=work_item.strftime("%Y-%m-%d")
+    return {
+        'label': f'{label}day {date_str}',
+        'report': report,
+        'records': records,
+        'download_date': work_item,
+        'week_bool': False,
+        'download_path': f'{staging_path}/{date_str}',
+        'archive_path': f'{archive_path}/{date_str}',
+        'output_dirs': {work_item: f'{staging_path}/{date_str}'},
+        'upload_only': False
+    }
+
+def _resume_units(units:list, final_stage:str) -> list:
+    '''
+    Records the files listed for every day in the state of its report and drops the days whose
+    final stage is done for the same files. Units whose days are all parsed, with their outputs
+    still in staging, only upload. Returns the units with work left.
+    '''
+    pending=[]
+    for unit in units:
+        state=unit['report']['state']
+        if state is None:
+            pending.append(unit)
+            continue
+        records=unit['records']
+        for requested_date in unit['output_dirs']:
+            if records is not None:
+                state.sync_listing(requested_date, records)
+            elif not state.is_done(requested_date, final_stage):
+                ## Without a listing the recorded files can not be checked, the download lists the day again
+                state.mark(requested_date, 'listed', status='failed', error='Listing failed')
+        done=[d for d in unit['output_dirs'] if state.is_done(d, final_stage)]
+        if done != []:
+            print(f'[Info] Skipping {len(done)} completed days of {unit["label"]}')
+        unit['output_dirs']={d: p for d, p in unit['output_dirs'].items() if d not in done}
+        if unit['output_dirs'] == {}:
+            continue
+        unit['upload_only']=final_stage == 'uploaded' and all(
+            state.is_done(d, 'parsed') and os.path.isdir(p) for d, p in unit['output_dirs'].items()
+        )
+        pending.append(unit)
+    return pending
+
+def _download_unit(unit:dict, **kwargs) -> list:
+    if unit['upload_only']:
+        return None
+    state=unit['report']['state']
+    if state is not None:
+        ## Leftovers of an interrupted run of the unit are not trusted
+        for path in [unit['download_path'], *unit['output_dirs'].values()]:
+            if os.path.isdir(path):
+                rm_directory(path)
+
+    if kwargs['staging_mode'] == 'memory':
+        file_metadata, unit['buffers']=download_buffers(
+            requested_date=unit['download_date'],
+            base_url=kwargs['base_url'],
+            payload=unit['report']['payload'],
+            week_bool=unit['week_bool'],
+            rate_limiter=kwargs['rate_limiter'],
+            session=kwargs['session'],
+            max_download_workers=kwargs['max_download_workers'],
+            listing=kwargs['listing'],
+            metrics=kwargs['metrics'],
+            download_url=kwargs['download_url'],
+            spool_max_bytes=kwargs['spool_max_bytes']
+        )
+    else:
+        file_metadata=download_files(
+            requested_date=unit['download_date'],
+            base_url=kwargs['base_url'],
+            payload=unit['report']['payload'],
+            staging_path=unit['download_path'],
+            week_bool=unit['week_bool'],
+            rate_limiter=kwargs['rate_limiter'],
+            session=kwargs['session'],
+            max_download_workers=kwargs['max_download_workers'],
+            cache=kwargs['cache'],
+            listing=kwargs['listing'],
+            metrics=kwargs['metrics'],
+            download_url=kwargs['download_url']
+        )
+    if state is not None:
+        for requested_date in unit['output_dirs']:
+            if unit['records'] is None:
+                state.mark(requested_date, 'listed', detail={'files': len(file_metadata)})
+            state.mark(requested_date, 'downloaded', detail={'files': len(file_metadata)})
+    return file_metadata
+
+def _parse_unit(unit:dict, **kwargs) -> dict:
+    if unit['upload_only']:
+        return {}
+    results=parse_downloaded_files(
+        file_metadata=unit['download'],
+        download_path=unit['download_path'],
+        requested_dates=list(unit['output_dirs']),
+        output_dirs=unit['output_dirs'],
+        header=unit['report']['header'],
+        output_prefix=unit['report']['output_prefix'],
+        cache=kwargs['cache'],
+        excel_engine=kwargs['excel_engine'],
+        parse_executor=kwargs['parse_executor'],
+        writer=kwargs['writer'],
+        output_layout=kwargs['output_layout'],
+        metrics=kwargs['metrics'],
+        parse_profile_path=kwargs['parse_profile_path'],
+        trace_parse_memory=kwargs['trace_parse_memory'],
+        schema_registry_path=unit['report']['schema_registry_path'],
+        strict_layout=kwargs['strict_layout'],
+        revision_index_path=unit['report']['revision_index_path'],
+        parser_class=unit['report']['parser'],
+        archive_path=unit['archive_path'],
+        buffers=unit.get('buffers')
+    )
+    if unit.get('buffers') is not None:
+        ## Parquet bytes of every day, by file name
+        unit['buffers']=None
+        unit['outputs']={
+            d: {os.path.basename(path): content for r in results.values() for path, content in r.get('output_buffers', {}).items() if os.path.dirname(path) == output_dir}
+            for d, output_dir in unit['output_dirs'].items()
+        }
+    elif unit['week_bool']:
+        ## The weekly workbook is not required anymore
+        rm_directory(unit['download_path'])
+
+    state=unit['report']['state']
+    if state is not None:
+        errors=[f'{r["file_name"]}: {r["error"]}' for r in results.values() if r['status'] == 'failed']
+        for requested_date in unit['output_dirs']:
+            if errors == []:
+                state.mark(requested_date, 'parsed', detail={'files': len(results)})
+            else:
+                state.mark(requested_date, 'parsed', status='failed', error='; '.join(errors))
+    return results
+
+def _upload_unit(unit:dict, **kwargs) -> list:
+    report=unit['report']
+    state=report['state']
+    upload_results=[]
+    for requested_date, day_staging_path in unit['output_dirs'].items():
+        buffers=unit['outputs'][requested_date] if 'outputs' in unit else None
+        if report['datasets'] is not None:
+            ## Marked as uploaded once the datasets are written at the end of the run
+            _append_to_datasets(day_staging_path, report['datasets'], kwargs['writer'], buffers)
+            continue
+        day_results=_upload_day(
+            day_staging_path=day_staging_path,
+            date_str=requested_date.strftime("%Y-%m-%d"),
+            uploader=kwargs['uploader'],
+            incremental_upload=kwargs['incremental_upload'],
+            bucket_name=kwargs['bucket_name'],
+            blob_folder_name=report['blob_folder_name'],
+            gcs_regexp_file=kwargs['gcs_regexp_file'],
+            metrics=kwargs['metrics'],
+            buffers=buffers
+        )
+        if state is not None and day_results != [] and state.is_done(requested_date, 'parsed'):
+            failed=day_results[0]['failed']
+            if failed == []:
+                state.mark(requested_date, 'uploaded', detail={
+                    'uploaded': len(day_results[0]['uploaded']),
+                    'skipped': len(day_results[0]['skipped'])
+                })
+            else:
+                state.mark(requested_date, 'uploaded', status='failed', error='; '.join(f'{r["blob_name"]}: {r["error"]}' for r in failed))
+        upload_results+=day_results
+    return upload_results
+
+def _run_stage(name:str, func, unit:dict, stage_kwargs:dict) -> bool:
+    '''
+    Runs a stage of a unit and keeps its result in unit[name]. A unit that failed to download
+    or parse is archived, and the stage is recorded as failed so a later run retries it.
+    Returns True if the stage succeeded.
+    '''
+    try:
+        unit[name]=func(unit, **stage_kwargs)
+    except Exception as e:
+        print(f'Issue in {name} stage for {unit["label"]}: {e}')
+        state=unit['report']['state']
+        if state is not None:
+            for requested_date in unit['output_dirs']:
+                state.mark(requested_date, _STAGE_STATES[name], status='failed', error=str(e))
+        ## Parsed outputs stay in staging, so the upload can be retried
+        if name != 'upload' and os.path.exists(unit['download_path']):
+            archive_path=unit['archive_path']
+            if os.path.exists(archive_path):
+                archive_path=f'{archive_path}_{time.strftime("%Y%m%dT%H%M%S")}'
+            os.makedirs('archive', exist_ok=True)
+            shutil.move(unit['download_path'], archive_path)
+        return False
+    return True
+
+def _run_unit(unit:dict, **stage_kwargs) -> list:
+    '''
+    Downloads, parses and uploads a unit from start to end. Every day works on its own
+    staging folder so concurrent units cannot clobber each other.
+    Returns the upload results of the unit.
+    '''
+    print(f'Downloading for {unit["label"]}')
+    for name, func in (('download', _download_unit), ('parse', _parse_unit), ('upload', _upload_unit)):
+        if not _run_stage(name, func, unit, stage_kwargs):
+            return []
+    return unit['upload']
+
+def _run_coroutine(coroutine):
+    '''
+    Runs a coroutine to completion. Called from a running event loop, i.e. a notebook or an async
+    orchestrator, it runs in a thread with its own loop, since asyncio.run can not be nested.
+    '''
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+async def _run_pipeline(
+    units:list,
+    stage_kwargs:dict,
+    download_tasks:int=1,
+    parse_tasks:int=1,
+    upload_tasks:int=1,
+    queue_size:int=2
+) -> list:
+    '''
+    Runs the download, parse and upload stages concurrently, connected by bounded queues.
+    A stage waits when the next queue is full, so at most download_tasks+queue_size+parse_tasks
+    units of raw files and queue_size+upload_tasks units of parsed files sit in staging.
+    The blocking work of every stage runs in a thread, parsing goes on to the parse pool if any.
+    Returns the upload results of all the units.
+    '''
+    loop=asyncio.get_running_loop()
+    executor=ThreadPoolExecutor(max_workers=download_tasks+parse_tasks+upload_tasks)
+    to_download=asyncio.Queue()
+    to_parse=asyncio.Queue(maxsize=queue_size)
+    to_upload=asyncio.Queue(maxsize=queue_size)
+    busy_seconds={'download': 0.0, 'parse': 0.0, 'upload': 0.0}
+    upload_results=[]
+
+    async def _stage(name, func, inbox, outbox):
+        while True:
+            unit=await inbox.get()
+            if unit is None:
+                return
+            start=time.perf_counter()
+            try:
+                succeeded=await loop.run_in_executor(executor, _run_stage, name, func, unit, stage_kwargs)
+            finally:
+                busy_seconds[name]+=time.perf_counter()-start
+            if not succeeded:
+                continue
+            if outbox is not None:
+                await outbox.put(unit)
+            else:
+                upload_results.extend(unit[name])
+
+    start=time.perf_counter()
+    for unit in units:
+        to_download.put_nowait(unit)
+    downloaders=[asyncio.create_task(_stage('download', _download_unit, to_download, to_parse)) for _ in range(download_tasks)]
+    parsers=[asyncio.create_task(_stage('parse', _parse_unit, to_parse, to_upload)) for _ in range(parse_tasks)]
+    uploaders=[asyncio.create_task(_stage('upload', _upload_unit, to_upload, None)) for _ in range(upload_tasks)]
+
+    try:
+        ## Every stage is closed once the previous one is done
+        for stage_tasks, inbox in ((downloaders, to_download), (parsers, to_parse), (uploaders, to_upload)):
+            for _ in stage_tasks:
+                await inbox.put(None)
+            await asyncio.gather(*stage_tasks)
+    finally:
+        ## A stage that raised leaves the others waiting on their queues
+        for task in downloaders+parsers+uploaders:
+            task.cancel()
+        executor.shutdown()
+
+    print(f'[Info] Pipeline of {len(units)} units in {time.perf_counter()-start:.2f}s, busy seconds per stage {{{", ".join(f"{k}: {v:.2f}" for k, v in busy_seconds.items())}}}')
+    return upload_results
+
 def cnd_predispatch(
     base_url:str,
     payload:dict,
@@ -20,60 +484,378 @@ def cnd_predispatch(
     gcs_regexp_file:str=None,
     requested_date:datetime =None,
     days_shift:int =0,
-    days_backfill:int=0
-) -> None:
-    
-    # Removing temp files if we set it for loading to GCP
-    if gcp_project_id != None or bucket_name != None:
+    days_backfill:int=0,
+    max_workers:int=1,
+    requests_per_second:float=1.0,
+    max_download_workers:int=4,
+    http_retries:int=3,
+    cache_path:str=None,
+    cache_max_bytes:int=5*1024**3,
+    listing_cache_path:str=None,
+    listing_ttl_seconds:float=3600,
+    excel_engine:str=None,
+    week_bool:bool=False,
+    parse_workers:int=1,
+    parquet_compression:str='zstd',
+    parquet_compression_level:int=None,
+    parquet_row_group_size:int=None,
+    output_layout:str='wide',
+    dataset_path:str=None,
+    dataset_partition_by:str='month',
+    dataset_target_file_bytes:int=128*1024**2,
+    dataset_compact:bool=True,
+    gcs_api_endpoint:str=None,
+    upload_workers:int=8,
+    incremental_upload:bool=False,
+    upload_manifest_path:str=None,
+    bq_dataset:str=None,
+    bq_table:str=None,
+    merge_key_columns:list=None,
+    bq_staging_table:str=None,
+    bq_layout:str=None,
+    pipelined:bool=False,
+    pipeline_queue_size:int=2,
+    metrics_path:str=None,
+    metrics_prometheus_path:str=None,
+    parse_profile_path:str=None,
+    trace_parse_memory:bool=False,
+    download_url:str='https://sitioprivado.cnd.com.pa/Informe/Download',
+    state_path:str=None,
+    schema_registry_path:str=None,
+    strict_layout:bool=False,
+    staging_mode:str='disk',
+    spool_max_bytes:int=64*1024**2,
+    revision_index_path:str=None,
+    reports:list=None
+) -> dict:
+    '''
+    Parameters:
+    - max_workers (int): Number of days processed concurrently during the backfill
+    - requests_per_second (float): Initial request rate to CND. It is shared by all the
+      workers and adapts itself when CND answers with 429/5xx
+    - max_download_workers (int): Number of attachments of a day downloaded in parallel
+    - http_retries (int): Retries with exponential backoff for transient HTTP failures
+    - cache_path (str): Directory of the persistent download cache. None disables it. It must
+      live outside staging_path, which is wiped on every run
+    - cache_max_bytes (int): Size limit of the download cache
+    - listing_cache_path (str): Directory of the listing cache. None keeps it only in memory for the run
+    - listing_ttl_seconds (float): Time to live of the cached listings of recent days
+    - excel_engine (str): Engine used to read the workbooks, i.e. 'calamine'. None lets pandas choose
+    - week_bool (bool): Uses the weekly workbooks. The backfill is planned per CND week, so each
+      workbook is downloaded once and all its needed day sheets are parsed in one open
+    - parse_workers (int): Size of the process pool shared by all the days for parsing workbooks.
+      1 parses in the calling thread
+    - parquet_compression (str): Codec of the parsed Parquet files, i.e. 'zstd', 'snappy' or 'gzip'
+    - parquet_compression_level (int): Level of the codec, None uses the codec default
+    - parquet_row_group_size (int): Maximum number of rows per row group
+    - output_layout (str): 'wide' hourly columns, 'long' one row per unit, fecha and hour
+      interval, or 'both' from the same parse
+    - dataset_path (str): Root of a Hive-partitioned dataset the parsed days are appended to,
+      with one dataset per layout in <dataset_path>/<layout>. It is uploaded to blob_folder_name
+      instead of one folder per day. None keeps the per day files. It must live outside staging_path
+    - dataset_partition_by (str): 'day' (fecha=YYYY-MM-DD) or 'month' (mes=YYYY-MM) partitions
+    - dataset_target_file_bytes (int): Target size of the dataset files
+    - dataset_compact (bool): Merges the small files of the partitions appended in the run
+    - gcs_api_endpoint (str): Storage endpoint of a local emulator, i.e. fake-gcs-server. None uses GCS
+    - upload_workers (int): Number of files uploaded concurrently, with one client for the whole run
+    - incremental_upload (bool): Skips the files whose CRC32C/MD5 already match the remote object,
+      and uploads the rest with generation preconditions. False uploads every file
+    - upload_manifest_path (str): Local manifest of the uploaded checksums, so re-runs skip unchanged
+      files without asking GCS. It must live outside staging_path
+    - bq_dataset (str): BigQuery dataset of bq_table
+    - bq_table (str): Table the uploaded files of the whole run are loaded and merged into with a
+      single load job and a single MERGE. None skips BigQuery. With reports, each report is merged
+      into the bq_table of its registry entry instead, with its default staging table
+    - merge_key_columns (list): Columns identifying a row of bq_table, i.e. ['fecha', 'plantas']
+    - bq_staging_table (str): Staging table of the load. Defaults to <bq_table>_staging
+    - bq_layout (str): Layout loaded into BigQuery. Defaults to output_layout, or 'long' for 'both'
+    - pipelined (bool): Overlaps the download, parse and upload stages with asyncio instead of
+      running each day from start to end. max_workers downloads, parse_workers parses and max_workers
+      uploads run at the same time
+    - pipeline_queue_size (int): Units waiting between two stages. It bounds the staging disk usage
+    - metrics_path (str): JSON lines file with the listing, download, parse and upload metrics of
+      every day and file. None, with metrics_prometheus_path None too, records nothing
+    - metrics_prometheus_path (str): Prometheus textfile with the totals per stage of the run
+    - parse_profile_path (str): Folder for a cProfile dump of every parse. None disables it
+    - trace_parse_memory (bool): Records the tracemalloc peak of every parse
+    - download_url (str): Url from CND to download each attachment by its id, i.e. a local mock
+    - state_path (str): SQLite file recording the status of every day at every stage with the files
+      it was listed with. Re-runs skip the days already uploaded (parsed when there is no upload)
+      for the same file versions and retry only the failed or missing stages. Staging is not wiped
+      at the start so parsed days can resume with their upload. None disables it. It must live
+      outside staging_path
+    - schema_registry_path (str): JSON file of the sheet layouts seen so far. Repeated layouts are read
+      with their cached columns and dtypes, new ones get their header row detected and are reported
+      as layout drift. None keeps the layouts in memory for the run. It must live outside staging_path
+    - strict_layout (bool): Fails the files whose layout drifted instead of only reporting it
+    - staging_mode (str): 'disk' stages the downloaded and parsed files in staging_path. 'memory' passes
+      them between the stages as buffers: downloads go to spooled buffers, the Parquet outputs are
+      uploaded, or appended to the datasets, straight from memory and nothing is left to clean. It
+      needs an upload or a dataset_path, and it does not use the download cache
+    - spool_max_bytes (int): Size above which a downloaded file spills from memory to a temporary file
+    - revision_index_path (str): SQLite version index of the ingested days. Every parsed day is compared
+      by (fecha, unit) content hash with its previous version, and only the inserted, updated and deleted
+      rows are written, uploaded and merged, as <prefix>_delta_<file> files with change_type and revision
+      columns. Unchanged republications write nothing. None writes the full days. It must live outside
+      staging_path, and it can not be used with dataset_path
+    - reports (list): Reports of the report registry to ingest in the same run, by name or as report dicts.
+      Their days are listed with the categoria and tipo of each report and flow through the same
+      session, rate limiter, parse pool and uploader. Every report works under its own folder of
+      staging_path, blob_folder_name and dataset_path, with its own state, schema registry and
+      revision index files (state.sqlite to state_<report>.sqlite), and is merged into its bq_table.
+      None ingests the report of payload with the predispatch parser
+    Returns:
+    - dict: Statistics of the BigQuery load and merge, None if it did not run. With reports,
+      the statistics per report name
+    '''
+
+    if staging_mode not in ('disk', 'memory'):
+        raise Exception(f'Unknown staging mode {staging_mode}, use disk or memory')
+    if staging_mode == 'memory' and gcp_project_id == None and bucket_name == None and dataset_path is None:
+        raise Exception('Memory staging needs an upload or a dataset_path, the parsed files would be lost')
+    if revision_index_path is not None and dataset_path is not None:
+        ## The datasets hold the full state of every day, the deltas would be appended to it as rows
+        raise Exception('revision_index_path writes delta files, which can not be appended to the dataset_path datasets. Use one of them')
+
+    # Removing temp files if we set it for loading to GCP. With a state store the parsed days
+    # waiting for their upload are kept, every other unit cleans its own folders
+    if (gcp_project_id != None or bucket_name != None) and state_path is None and staging_mode == 'disk':
         ## Removing Temp folder
         rm_directory(staging_path)
-        
-    ## For loop for historical backfill
-    for d in range(days_backfill):
-        ## Fixing date requirement
-        days_shift += 1
-        
-        adjuster=DATE_ADJUSTER(input_date=requested_date, shift_days=days_shift*-1)
-        requested_date_adjusted=adjuster.adjust_date()
-        print(requested_date_adjusted)
-
-        date_str =requested_date_adjusted.strftime("%Y-%m-%d")
-        print(f'Downloading for day {date_str}')
-        
-        try:
-            ## Downloading and parse data task
-            download_and_parse_files(
-                requested_date=requested_date_adjusted,
-                base_url=base_url,
-                payload=payload,
-                staging_path=staging_path
-            )
 
-            rm_directory(f'{staging_path}/UNZIP')
-        except:
-            print(f'Issue parsing files from {date_str}')
-            os.makedirs('archive', exist_ok=True)
-            dest = shutil.move(staging_path, f'archive_{date_str}') 
-        
-        # Load to GCP 
-        if gcp_project_id != None or bucket_name != None: ## One of them is None, we will only save them local
-            gcp_client=GCP_UPLOADER(
+    ## Everything opened for the run is closed when it ends, also when a stage raises
+    with ExitStack() as cleanup:
+        ## Shared by all the days to avoid being blacklisted
+        rate_limiter=RATE_LIMITER(rate=requests_per_second)
+        ## One keep-alive session for the whole run
+        session=build_session(pool_size=max(1, max_workers)*max(1, max_download_workers), retries=http_retries, rate_limiter=rate_limiter)
+        cleanup.callback(session.close)
+        cache=DOWNLOAD_CACHE(cache_path=cache_path, max_bytes=cache_max_bytes) if cache_path is not None else None
+        if cache is not None:
+            ## Saves the last accesses of the cache hits of the run
+            cleanup.callback(cache.flush)
+        metrics=PIPELINE_METRICS(
+            jsonl_path=metrics_path,
+            prometheus_path=metrics_prometheus_path
+        ) if metrics_path is not None or metrics_prometheus_path is not None else None
+        listing=CND_LISTING(
+            base_url=base_url,
+            session=session,
+            rate_limiter=rate_limiter,
+            cache_path=listing_cache_path,
+            ttl_seconds=listing_ttl_seconds,
+            metrics=metrics
+        )
+        ## Spawned workers, forking while the download threads run is not safe
+        parse_executor=ProcessPoolExecutor(
+            max_workers=parse_workers,
+            mp_context=multiprocessing.get_context('spawn')
+        ) if parse_workers > 1 else None
+        if parse_executor is not None:
+            cleanup.callback(parse_executor.shutdown)
+        writer=PARQUET_WRITER(
+            compression=parquet_compression,
+            compression_level=parquet_compression_level,
+            row_group_size=parquet_row_group_size
+        )
+        ## One storage client and connection pool for the whole run
+        uploader=None
+        if gcp_project_id != None or bucket_name != None:
+            from src.clients.gcp_client import GCP_UPLOADER
+            uploader=GCP_UPLOADER(
                 gcp_project_id=gcp_project_id,
                 staging_path=staging_path,
-                cred_path=cred_path
+                cred_path=cred_path,
+                api_endpoint=gcs_api_endpoint,
+                max_workers=upload_workers,
+                manifest_path=upload_manifest_path
             )
+            cleanup.callback(uploader.close)
+
+        ## Reports of the run. Without reports the report of payload keeps the flat staging, bucket and dataset layout
+        if reports is None:
+            folders=[None]
+            run_reports=[get_report({'name': 'predispatch', 'categoria': payload.get('categoria'), 'tipo': payload.get('tipo'), 'bq_table': bq_table})]
+        else:
+            run_reports=[get_report(r) for r in reports]
+            folders=[r['name'] for r in run_reports]
+            if len(set(folders)) != len(folders):
+                raise Exception(f'Repeated reports in {folders}')
+
+        layouts=['wide', 'long'] if output_layout == 'both' else [output_layout]
+        run=[]
+        for report, folder in zip(run_reports, folders):
+            report_dataset_path=dataset_path if folder is None or dataset_path is None else f'{dataset_path}/{folder}'
+            ## Days, layouts and versions of every report are recorded apart
+            state=BACKFILL_STATE(db_path=_report_path(state_path, folder)) if state_path is not None else None
+            if state is not None:
+                cleanup.callback(state.close)
+            report_revision_index_path=_report_path(revision_index_path, folder)
+            if report_revision_index_path is not None:
+                ## Opened by the parses of this process
+                cleanup.callback(close_index, report_revision_index_path)
+            run.append({
+                **report,
+                'folder': folder,
+                'payload': payload if folder is None else report_payload(report, payload),
+                'blob_folder_name': blob_folder_name if folder is None else '/'.join(p for p in (blob_folder_name, folder) if p),
+                'dataset_path': report_dataset_path,
+                'datasets': {
+                    layout: PARQUET_DATASET_WRITER(
+                        root_path=f'{report_dataset_path}/{layout}',
+                        writer=writer,
+                        partition_by=dataset_partition_by,
+                        target_file_bytes=dataset_target_file_bytes
+                    )
+                    for layout in layouts
+                } if report_dataset_path is not None else None,
+                'state': state,
+                'schema_registry_path': _report_path(schema_registry_path, folder),
+                'revision_index_path': report_revision_index_path
+            })
+        ## Last stage of a day, the per day files are only parsed without upload nor dataset
+        final_stage='uploaded' if uploader is not None or dataset_path is not None else 'parsed'
+
+        ## Dates for historical backfill
+        requested_dates=[]
+        for d in range(days_backfill):
+            ## Fixing date requirement
+            days_shift += 1
 
-            gcs_folder_name= f'{blob_folder_name}/{date_str}'
+            adjuster=DATE_ADJUSTER(input_date=requested_date, shift_days=days_shift*-1)
+            requested_dates.append(adjuster.adjust_date())
 
-            gcp_client.gcs_upload(
+        shared_kwargs=dict(
+            base_url=base_url,
+            staging_path=staging_path,
+            rate_limiter=rate_limiter,
+            session=session,
+            max_download_workers=max_download_workers,
+            cache=cache,
+            listing=listing,
+            excel_engine=excel_engine,
+            parse_executor=parse_executor,
+            writer=writer,
+            output_layout=output_layout,
+            uploader=uploader,
+            incremental_upload=incremental_upload,
+            bucket_name=bucket_name,
+            gcs_regexp_file=gcs_regexp_file,
+            metrics=metrics,
+            parse_profile_path=parse_profile_path,
+            trace_parse_memory=trace_parse_memory,
+            download_url=download_url,
+            strict_layout=strict_layout,
+            staging_mode=staging_mode,
+            spool_max_bytes=spool_max_bytes
+        )
+
+        ## The units of every report share the session, rate limiter and pools of the run
+        units=[]
+        week_plans=plan_weekly_backfill(requested_dates) if week_bool else None
+        for report in run:
+            label=f'{report["folder"]} ' if report['folder'] is not None else ''
+            if week_bool:
+                ## One unit of work per weekly workbook
+                listings=listing.prefetch(report['payload'], [w['week_start'] for w in week_plans], week_bool=True, max_workers=max_workers)
+                for week_plan in week_plans:
+                    if listings[week_plan['week_start']] == []:
+                        print(f'No files listed for {label}week {week_plan["anio"]}_{week_plan["semana"]:02d}, skipping')
+                    elif listings[week_plan['week_start']] is None:
+                        print(f'[Error] Listing of {label}week {week_plan["anio"]}_{week_plan["semana"]:02d} failed, it is listed again by its download')
+                units+=[_pipeline_unit(w, True, staging_path, report, listings[w['week_start']]) for w in week_plans if listings[w['week_start']] != []]
+            else:
+                ## Listing the whole range up front, days without files are skipped
+                listings=listing.prefetch(report['payload'], requested_dates, max_workers=max_workers)
+                for requested_date_adjusted, records in listings.items():
+                    if records == []:
+                        print(f'No files listed for {label}day {requested_date_adjusted.strftime("%Y-%m-%d")}, skipping')
+                    elif records is None:
+                        print(f'[Error] Listing of {label}day {requested_date_adjusted.strftime("%Y-%m-%d")} failed, it is listed again by its download')
+                units+=[_pipeline_unit(d, False, staging_path, report, listings[d]) for d in requested_dates if listings[d] != []]
+        units=_resume_units(units, final_stage)
+
+        if pipelined:
+            _run_coroutine(_run_pipeline(
+                units=units,
+                stage_kwargs=shared_kwargs,
+                download_tasks=max(1, max_workers),
+                parse_tasks=max(1, parse_workers),
+                upload_tasks=max(1, max_workers),
+                queue_size=pipeline_queue_size
+            ))
+        elif max_workers <= 1:
+            for unit in units:
+                _run_unit(unit, **shared_kwargs)
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(lambda unit: _run_unit(unit, **shared_kwargs), units))
+
+        bq_stats={}
+        for report in run:
+            report_units=[unit for unit in units if unit['report'] is report]
+            upload_results=[r for unit in report_units for r in (unit.get('upload') or [])]
+            state=report['state']
+            datasets=report['datasets']
+            if datasets is not None:
+                dataset_results=_upload_datasets(
+                    dataset_path=report['dataset_path'],
+                    datasets=datasets,
+                    compact=dataset_compact,
+                    uploader=uploader,
+                    incremental_upload=incremental_upload,
                     bucket_name=bucket_name,
-                    blob_folder_name=gcs_folder_name,
-                    regexp_file=gcs_regexp_file
-            )
-            
-            rm_directory(staging_path)
+                    blob_folder_name=report['blob_folder_name'],
+                    gcs_regexp_file=gcs_regexp_file,
+                    metrics=metrics
+                )
+                upload_results+=dataset_results
+                if state is not None:
+                    ## The days appended in the run are delivered with the dataset
+                    failed=[r for result in dataset_results for r in result['failed']]
+                    for unit in report_units:
+                        for requested_date in unit['output_dirs']:
+                            if not state.is_done(requested_date, 'parsed'):
+                                continue
+                            if failed == []:
+                                state.mark(requested_date, 'uploaded', detail={'dataset': report['dataset_path']})
+                            else:
+                                state.mark(requested_date, 'uploaded', status='failed', error=f'{len(failed)} dataset files failed to upload')
+
+            if uploader is not None and report['bq_table'] is not None:
+                ## One load job and one MERGE per report for the whole run
+                bq_layout=bq_layout if bq_layout is not None else ('long' if output_layout == 'both' else output_layout)
+                partition_dirs=None
+                if datasets is not None:
+                    partition_dirs={f'{datasets[bq_layout].partition_key}={p}' for p in datasets[bq_layout].appended_partitions}
+                source_uris=_bigquery_uris(upload_results, bucket_name, bq_layout, partition_dirs)
+                if source_uris == []:
+                    print(f'[Error] No uploaded files of {report["name"]} to load into BigQuery')
+                else:
+                    hive_prefix=f'gs://{bucket_name}/{report["blob_folder_name"]}/{bq_layout}' if datasets is not None else None
+                    try:
+                        bq_stats[report['name']]=uploader.bq_load_and_merge(
+                            bq_dataset=bq_dataset,
+                            bq_table=report['bq_table'],
+                            source_uris=source_uris,
+                            merge_key_columns=merge_key_columns,
+                            staging_table=bq_staging_table if reports is None else None,
+                            hive_partition_uri_prefix=hive_prefix
+                        )
+                    except Exception as e:
+                        print(f'[Error] Failed to load and merge {report["name"]} into BigQuery: {e}')
+
+        for report in run:
+            if report['state'] is not None:
+                label=f'{report["folder"]} ' if report['folder'] is not None else ''
+                for stage, statuses in report['state'].summary(requested_dates).items():
+                    print(f'[Info] {label}{stage}: {statuses}')
 
-        ## Delay time to avoid being blacklisted
-        time.sleep(3)
-        
+        if metrics is not None:
+            metrics.export_prometheus()
+            for stage, total in metrics.summary().items():
+                print(f'[Info] {stage}: {total["events"]} events, {total["errors"]} errors, {total["seconds"]:.2f}s, {total["bytes"]/1024**2:.1f} MB, {total["rows"]} rows')
 
+    if reports is None:
+        return bq_stats.get('predispatch')
+    return bq_stats
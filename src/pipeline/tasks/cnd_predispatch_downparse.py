@@ -1,56 +1,295 @@
+import io
 import os
+import time
+from concurrent.futures import Executor
 from datetime import datetime
-from src.clients.cnd_downloader import CND_DOWNLOADER
-from src.clients.cnd_parser import CND_PARSER
-from src.clients.gcp_client import GCP_UPLOADER
+from src.clients.cnd_downloader import CND_DOWNLOADER, staged_file_name
+from src.clients.cnd_listing import CND_LISTING
+from src.clients.cnd_parser import CND_PARSER, OUTPUT_VERSION
+from src.clients.download_cache import DOWNLOAD_CACHE
+from src.clients.parquet_writer import PARQUET_WRITER
+from src.clients.pipeline_metrics import PIPELINE_METRICS, parse_profiler
+from src.clients.rate_limiter import RATE_LIMITER
+from src.clients.revision_index import get_index
+from src.clients.schema_registry import get_registry
 import re
+import requests
 import shutil
 
-def download_and_parse_files(
+def _parsed_variant(output_prefix:str, requested_date:datetime, writer:PARQUET_WRITER, output_layout:str) -> str:
+    ## Identifies the parsed outputs of a file version for one day in the download cache
+    return f'{output_prefix}_{requested_date.strftime("%Y%m%d")}_{writer.signature}_{output_layout}_{OUTPUT_VERSION}'
+
+def _buffer_bytes(buffer) -> bytes:
+    buffer.seek(0)
+    content=buffer.read()
+    buffer.seek(0)
+    return content
+
+def _parse_file(job:dict) -> dict:
+    '''
+    Parses a single workbook. It lives at module level so it can be sent to a process pool.
+    Errors are returned, not raised, so one bad workbook does not abort the rest.
+    '''
+    start=time.perf_counter()
+    result={'file_id': job['file_id'], 'file_name': job['file_name'], 'output_paths': [], 'outputs': [], 'error': None}
+    profile=parse_profiler(
+        profile_path=job.get('parse_profile_path'),
+        trace_memory=job.get('trace_parse_memory', False),
+        label=f'{job["file_id"]}_{os.path.splitext(job["file_name"])[0]}'
+    )
+    try:
+        with profile as profile_stats:
+            ## Buffers sent to a process pool arrive as bytes
+            file_path=io.BytesIO(job['file_path']) if isinstance(job['file_path'], bytes) else job['file_path']
+            parser=job.get('parser_class', CND_PARSER)(
+                file_path=file_path,
+                file_metadata=(job['file_id'], job['file_name'], job['fecha_publica']),
+                staging_path=job['staging_path'],
+                engine=job['excel_engine'],
+                writer=job['writer'],
+                output_layout=job['output_layout'],
+                schema_registry=get_registry(job.get('schema_registry_path'), job.get('strict_layout', False)),
+                in_memory=job.get('in_memory', False),
+                revision_index=get_index(job['revision_index_path']) if job.get('revision_index_path') is not None else None
+            )
+            result['output_paths']=parser.parse_predispatch_days(
+                requested_dates=job['requested_dates'],
+                header=job['header'],
+                output_prefix=job['output_prefix'],
+                output_dirs=job['output_dirs']
+            )
+        result['outputs']=parser.output_stats
+        result['output_buffers']=parser.output_buffers
+        result.update(profile_stats)
+        result['status']='parsed'
+    except Exception as e:
+        result['status']='failed'
+        result['error']=str(e)
+    result['seconds']=time.perf_counter()-start
+    return result
+
+def parse_files(jobs:list, parse_executor:Executor=None) -> dict:
+    '''
+    Parsing stage. Sends the workbooks to the executor, usually a process pool, or
+    parses them inline when there is none.
+    Parameters:
+    - jobs (list): One dict per workbook with file_id, file_name, fecha_publica, file_path,
+      staging_path, requested_dates, output_dirs, header, output_prefix, excel_engine, writer,
+      output_layout and optionally parse_profile_path, trace_parse_memory, schema_registry_path,
+      strict_layout, in_memory, revision_index_path and parser_class. file_path can be a buffer, or its bytes for a process pool
+    - parse_executor (Executor): Pool shared by the whole flow run
+    Returns:
+    - dict: Result per (file_id, file_name) with file_id, file_name, status, output_paths, outputs (path, rows, columns
+      and bytes), output_buffers (path to bytes) of in memory jobs, error and seconds, plus
+      peak_memory_bytes and profile_path when profiled
+    '''
+    if parse_executor is None or len(jobs) <= 1:
+        results=[_parse_file(job) for job in jobs]
+    else:
+        results=list(parse_executor.map(_parse_file, jobs))
+
+    for r in results:
+        if r['status'] == 'failed':
+            print(f'[Error] Failed to parse {r["file_name"]} ({r["file_id"]}): {r["error"]}')
+        else:
+            print(f'[Info] Parsed {r["file_name"]} ({r["file_id"]}) in {r["seconds"]:.2f}s')
+    return {(r['file_id'], r['file_name']): r for r in results}
+
+def parse_downloaded_files(
+    file_metadata:list,
+    download_path:str,
+    requested_dates:list,
+    output_dirs:dict,
+    header:int,
+    output_prefix:str,
+    cache:DOWNLOAD_CACHE=None,
+    excel_engine:str=None,
+    parse_executor:Executor=None,
+    archive_path:str='archive',
+    writer:PARQUET_WRITER=None,
+    output_layout:str='wide',
+    metrics:PIPELINE_METRICS=None,
+    parse_profile_path:str=None,
+    trace_parse_memory:bool=False,
+    schema_registry_path:str=None,
+    strict_layout:bool=False,
+    buffers:dict=None,
+    revision_index_path:str=None,
+    parser_class:type=CND_PARSER
+) -> dict:
+    '''
+    Parses the downloaded files, paired with their metadata by file id and name. Parsed raw files
+    are removed, the ones that failed are moved to archive_path for inspection.
+    The parse of every file is recorded in metrics, parse_profile_path and trace_parse_memory
+    turn on cProfile and tracemalloc around each parse. The sheet layouts are kept in the schema
+    registry of schema_registry_path, strict_layout fails the files whose layout drifted.
+    With buffers, (file_id, file_name) to the buffer from download_buffers, nothing is read from or written to
+    download_path: the outputs are returned in output_buffers, the parsed cache is not used and only
+    the files that failed are written to archive_path.
+    With revision_index_path only the rows that changed since the previous version of every day are
+    written, as delta outputs. The parsed cache is not used then, a delta depends on the index.
+    parser_class parses the workbooks of other reports, with the interface of CND_PARSER.
+    Returns:
+    - dict: Result per (file_id, file_name) from parse_files
+    '''
+    writer=writer if writer is not None else PARQUET_WRITER()
+    jobs=[]
+    results={}
+    for file_id, file_name, fecha_publica in file_metadata:
+        ### Getting files to parse. CND can share zip, xls, xlsx
+        if not (re.search(string=file_name, pattern='.xl') or re.search(string=file_name, pattern='.zip')):
+            continue
+
+        ## Days already parsed for the same file version
+        pending_dates=[
+            d for d in requested_dates
+            if cache is None or buffers is not None or revision_index_path is not None or cache.get_parsed(file_id, fecha_publica, _parsed_variant(output_prefix, d, writer, output_layout), output_dirs[d]) is None
+        ]
+        if pending_dates == []:
+            print(f'Cache hit for parsed {file_name}, skipping parse')
+            results[(file_id, file_name)]={'file_id': file_id, 'file_name': file_name, 'status': 'cached', 'output_paths': [], 'error': None, 'seconds': 0.0}
+            continue
+
+        jobs.append({
+            'file_id': file_id,
+            'file_name': file_name,
+            'fecha_publica': fecha_publica,
+            'file_path': f'{download_path}/{staged_file_name(file_id, file_name)}' if buffers is None
+                else (buffers[(file_id, file_name)] if parse_executor is None else _buffer_bytes(buffers[(file_id, file_name)])),
+            'staging_path': download_path,
+            'requested_dates': pending_dates,
+            'output_dirs': output_dirs,
+            'header': header,
+            'output_prefix': output_prefix,
+            'excel_engine': excel_engine,
+            'writer': writer,
+            'output_layout': output_layout,
+            'parse_profile_path': parse_profile_path,
+            'trace_parse_memory': trace_parse_memory,
+            'schema_registry_path': schema_registry_path,
+            'strict_layout': strict_layout,
+            'in_memory': buffers is not None,
+            'revision_index_path': revision_index_path,
+            'parser_class': parser_class
+        })
+    print(f'Files to parse {[job["file_name"] for job in jobs]}')
+
+    results.update(parse_files(jobs, parse_executor=parse_executor))
+
+    if metrics is not None:
+        for job in jobs:
+            r=results[(job['file_id'], job['file_name'])]
+            metrics.record(
+                'parse',
+                dates=[d.strftime('%Y-%m-%d') for d in job['requested_dates']],
+                file_id=r['file_id'],
+                file_name=r['file_name'],
+                seconds=r['seconds'],
+                outputs=len(r['outputs']),
+                rows=sum(o['rows'] for o in r['outputs']),
+                columns=max([o['columns'] for o in r['outputs']], default=0),
+                bytes=sum(o['bytes'] for o in r['outputs']),
+                peak_memory_bytes=r.get('peak_memory_bytes'),
+                error=r['error']
+            )
+
+    for job in jobs:
+        r=results[(job['file_id'], job['file_name'])]
+        if r['status'] == 'parsed' and cache is not None and buffers is None and revision_index_path is None:
+            for d in job['requested_dates']:
+                day_paths=[p for p in r['output_paths'] if os.path.dirname(p) == output_dirs[d]]
+                cache.put_parsed(job['file_id'], job['fecha_publica'], _parsed_variant(output_prefix, d, writer, output_layout), day_paths)
+
+    ## Removing non required files. This is helpful for other iterations
+    if buffers is not None:
+        for key, buffer in buffers.items():
+            if key in results and results[key]['status'] == 'failed':
+                os.makedirs(archive_path, exist_ok=True)
+                with open(f'{archive_path}/{staged_file_name(*key)}', 'wb') as f:
+                    f.write(_buffer_bytes(buffer))
+            buffer.close()
+    else:
+        for file_id, file_name, _ in file_metadata:
+            f=f'{download_path}/{staged_file_name(file_id, file_name)}'
+            if not os.path.isfile(f):
+                continue
+            if (file_id, file_name) in results and results[(file_id, file_name)]['status'] == 'failed':
+                os.makedirs(archive_path, exist_ok=True)
+                shutil.move(f, f'{archive_path}/{staged_file_name(file_id, file_name)}')
+            else:
+                os.remove(f)
+
+    if results != {} and all(r['status'] == 'failed' for r in results.values()):
+        raise Exception(f'Every file failed to parse: {[r["error"] for r in results.values()]}')
+    return results
+
+def download_files(
     requested_date:datetime,
     base_url:str,
     payload:dict,
     staging_path:str,
-) -> None:
-           
-
+    week_bool:bool=False,
+    rate_limiter:RATE_LIMITER=None,
+    session:requests.Session=None,
+    max_download_workers:int=4,
+    cache:DOWNLOAD_CACHE=None,
+    listing:CND_LISTING=None,
+    metrics:PIPELINE_METRICS=None,
+    download_url:str='https://sitioprivado.cnd.com.pa/Informe/Download'
+) -> list:
+    '''
+    Downloads the files of a day, or of the week of requested_date, into staging_path, named after
+    staged_file_name.
+    Returns:
+    - list: Tuples of (file_id, file_name, fechaPublica) of the downloaded files
+    '''
     cnd_client=CND_DOWNLOADER(
         requested_date=requested_date,
         base_url=base_url,
         payload=payload,
-        staging_path=staging_path
+        staging_path=staging_path,
+        week_bool=week_bool,
+        rate_limiter=rate_limiter,
+        session=session,
+        max_download_workers=max_download_workers,
+        cache=cache,
+        listing=listing,
+        metrics=metrics,
+        download_url=download_url
     )
-    file_metadata=cnd_client.cnd_file_download()
-    downloaded_files=os.listdir(staging_path)
-
-    ### Getting files to parse. CND can share zip, xls, xlsx
-    files_to_parse = [
-        f'{staging_path}/{f}' for f in downloaded_files 
-        if re.search(string=f, pattern='.xl') or re.search(string=f, pattern='.zip') 
-    ]
-    print(f'Files to parse {files_to_parse}')
-
-    ### Due to this task will be used for historical backfill, we will remove parsed files 
-    files_to_remove = [
-        f'{staging_path}/{f}' for f in downloaded_files 
-        if not re.search(string=f, pattern='.gz')
-    ]
-
-    print(f'Files to remove {files_to_remove}')
-
-    ## Parsing files
-    for i in range(len(files_to_parse)):
-        parser=CND_PARSER(
-            file_path=files_to_parse[i],
-            file_metadata=file_metadata[i],
-            staging_path=staging_path
-        )
-        parser.parse_predispatch(requested_date,3,'cnd_predespacho_diario')
+    return cnd_client.cnd_file_download()
 
-    ## Removing non required files. This is helpful for other iterations
-    for f in files_to_remove:
-        if os.path.isfile(f):
-            os.remove(f)
-        elif os.path.isdir(f):
-            shutil.rmtree(f)
-    
+def download_buffers(
+    requested_date:datetime,
+    base_url:str,
+    payload:dict,
+    week_bool:bool=False,
+    rate_limiter:RATE_LIMITER=None,
+    session:requests.Session=None,
+    max_download_workers:int=4,
+    listing:CND_LISTING=None,
+    metrics:PIPELINE_METRICS=None,
+    download_url:str='https://sitioprivado.cnd.com.pa/Informe/Download',
+    spool_max_bytes:int=64*1024**2
+) -> tuple:
+    '''
+    Downloads the files of a day, or of the week of requested_date, into spooled buffers that
+    spill to a temporary file above spool_max_bytes. Nothing is written to staging.
+    Returns:
+    - tuple: List of (file_id, file_name, fechaPublica) and dict of (file_id, file_name) to its buffer
+    '''
+    cnd_client=CND_DOWNLOADER(
+        requested_date=requested_date,
+        base_url=base_url,
+        payload=payload,
+        staging_path=None,
+        week_bool=week_bool,
+        rate_limiter=rate_limiter,
+        session=session,
+        max_download_workers=max_download_workers,
+        listing=listing,
+        metrics=metrics,
+        download_url=download_url
+    )
+    return cnd_client.cnd_file_download_buffers(spool_max_bytes=spool_max_bytes)
@@ -0,0 +1,17 @@
+from datetime import datetime
+import pytest
+from benchmarks.mock_cnd_server import MOCK_CND_SERVER
+from benchmarks.synthetic_workbooks import make_corpus
+
+PAYLOAD = {'categoria': '6', 'tipo': '76', 'key': 'public_key', 'page': '0', 'publico': '1'}
+
+@pytest.fixture(scope='session')
+def corpus(tmp_path_factory) -> dict:
+    ## Two CND weeks, from Saturday 2025-03-01 to Friday 2025-03-14
+    path=tmp_path_factory.mktemp('corpus')
+    return make_corpus(str(path), [datetime(2025, 3, 1), datetime(2025, 3, 8)], formats=('xlsx',), units=5)
+
+@pytest.fixture
+def mock_cnd(corpus):
+    with MOCK_CND_SERVER({w: p for w, p in corpus['xlsx']}) as mock:
+        yield mock
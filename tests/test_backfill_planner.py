@@ -0,0 +1,27 @@
+from datetime import datetime, timedelta
+from src.clients.backfill_planner import plan_weekly_backfill
+from src.clients.cnd_listing import dated_payload
+
+def test_days_are_grouped_by_cnd_week():
+    ## Friday to the next Saturday: two CND weeks, Saturday to Friday
+    days=[datetime(2025, 3, 7)+timedelta(days=d) for d in range(2)]
+    plans=plan_weekly_backfill(days)
+    assert [p['week_start'] for p in plans] == [datetime(2025, 3, 1), datetime(2025, 3, 8)]
+    assert [p['days'] for p in plans] == [[(datetime(2025, 3, 7), 7)], [(datetime(2025, 3, 8), 1)]]
+
+def test_week_of_every_day_is_the_one_of_its_saturday():
+    ## Monday to Friday belong to the ISO week after their Saturday
+    plans=plan_weekly_backfill([datetime(2025, 3, 1)+timedelta(days=d) for d in range(7)])
+    assert len(plans) == 1
+    assert (plans[0]['anio'], plans[0]['semana']) == (2025, 9)
+    assert [n for _, n in plans[0]['days']] == [1, 2, 3, 4, 5, 6, 7]
+
+def test_year_and_week_follow_the_iso_calendar():
+    ## The week-52 workbook holds Friday 2025-01-03
+    plan=plan_weekly_backfill([datetime(2025, 1, 3)])[0]
+    assert (plan['week_start'], plan['anio'], plan['semana']) == (datetime(2024, 12, 28), 2024, 52)
+    ## Saturday 2022-01-01 is in week 52 of 2021
+    plan=plan_weekly_backfill([datetime(2022, 1, 1)])[0]
+    assert (plan['anio'], plan['semana']) == (2021, 52)
+    payload=dated_payload({}, plan['week_start'], week_bool=True)
+    assert (payload['anio'], payload['semana']) == ('2021', '52')
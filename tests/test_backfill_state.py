@@ -0,0 +1,63 @@
+from datetime import datetime
+from conftest import PAYLOAD
+from src.clients.backfill_state import BACKFILL_STATE
+
+DAY = datetime(2025, 3, 3)
+
+def _records(fecha_publica:str) -> list:
+    return [{'id': 1, 'adjunto': {'path': 'Informes\\Predespacho\\predespacho.xlsx'}, 'fechaPublica': fecha_publica}]
+
+def test_failed_stage_invalidates_the_later_ones(tmp_path):
+    state=BACKFILL_STATE(str(tmp_path/'state.sqlite'))
+    for stage in ('listed', 'downloaded', 'parsed', 'uploaded'):
+        state.mark(DAY, stage)
+    state.mark(DAY, 'downloaded', status='failed', error='timeout')
+    stages=state.stages(DAY)
+    assert sorted(stages) == ['downloaded', 'listed']
+    assert stages['downloaded']['error'] == 'timeout'
+    assert state.summary([DAY]) == {'listed': {'done': 1}, 'downloaded': {'failed': 1}, 'parsed': {}, 'uploaded': {}}
+
+def test_republished_files_clear_the_day(tmp_path):
+    state=BACKFILL_STATE(str(tmp_path/'state.sqlite'))
+    assert state.sync_listing(DAY, _records('/Date(1)/'))
+    state.mark(DAY, 'parsed')
+    ## Same files, the stages are kept
+    assert not state.sync_listing(DAY, _records('/Date(1)/'))
+    assert state.is_done(DAY, 'parsed')
+    ## New version of the file
+    assert state.sync_listing(DAY, _records('/Date(2)/'))
+    assert not state.is_done(DAY, 'parsed')
+    assert state.files(DAY) == [(1, 'predespacho.xlsx', '/Date(2)/')]
+    state.close()
+
+    ## Persisted for the next run
+    assert BACKFILL_STATE(str(tmp_path/'state.sqlite')).is_done(DAY, 'listed')
+
+def test_flow_resumes_only_the_unfinished_days(mock_cnd, tmp_path):
+    from src.pipeline.flows.cnd_predispatch_flow import cnd_predispatch
+    state_path=str(tmp_path/'state.sqlite')
+    run=lambda: cnd_predispatch(
+        base_url=mock_cnd.base_url,
+        download_url=mock_cnd.download_url,
+        payload=PAYLOAD,
+        staging_path=str(tmp_path/'staging'),
+        requested_date=datetime(2025, 3, 4),
+        days_backfill=2,
+        requests_per_second=1000,
+        state_path=state_path
+    )
+    run()
+    assert mock_cnd.requests['download'] == 2
+
+    ## Every day parsed for the same files, nothing is downloaded again
+    run()
+    assert mock_cnd.requests['download'] == 2
+
+    ## A day whose parse failed runs again, alone
+    state=BACKFILL_STATE(state_path)
+    state.mark(DAY, 'parsed', status='failed', error='interrupted')
+    state.close()
+    run()
+    assert mock_cnd.requests['download'] == 3
+    state=BACKFILL_STATE(state_path)
+    assert state.is_done(DAY, 'parsed') and state.is_done(datetime(2025, 3, 2), 'parsed')
@@ -0,0 +1,33 @@
+import json
+import subprocess
+import sys
+from datetime import datetime
+from src.cli import build_parser, resolve_parameters
+
+def _resolve(argv:list, environ:dict=None) -> dict:
+    return resolve_parameters(build_parser().parse_args(['predispatch']+argv), environ=environ or {})
+
+def test_date_range_is_both_ends_included():
+    params=_resolve(['--from', '2025-03-01', '--to', '2025-03-05'])
+    assert (params['requested_date'], params['days_shift'], params['days_backfill']) == (datetime(2025, 3, 6), 0, 5)
+
+def test_toml_dates_become_datetimes(tmp_path):
+    config=tmp_path/'predispatch.toml'
+    config.write_text('[predispatch]\nrequested_date = 2025-03-01\ndays_backfill = 2\n')
+    params=_resolve(['--config', str(config)])
+    assert params['requested_date'] == datetime(2025, 3, 1)
+    assert type(params['requested_date']) is datetime
+
+def test_command_line_over_environment_over_config(tmp_path):
+    config=tmp_path/'predispatch.json'
+    config.write_text(json.dumps({'max_workers': 2, 'parse_workers': 2, 'bucket_name': 'config-bucket'}))
+    environ={'ENERGY_SOURCES_CONFIG': str(config), 'ENERGY_SOURCES_PARSE_WORKERS': '3', 'ENERGY_SOURCES_REQUESTED_DATE': '2025-03-01'}
+    params=_resolve(['--max-workers', '4'], environ)
+    assert (params['max_workers'], params['parse_workers'], params['bucket_name']) == (4, 3, 'config-bucket')
+    assert params['requested_date'] == datetime(2025, 3, 1)
+    assert _resolve(['--local-only'], environ)['bucket_name'] is None
+
+def test_help_does_not_import_the_pipeline():
+    code='import sys, src.cli\ntry:\n    src.cli.main(["predispatch", "--help"])\nexcept SystemExit:\n    pass\nprint([m for m in ("pandas", "pyarrow", "google.cloud.storage") if m in sys.modules])'
+    output=subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    assert output.strip().splitlines()[-1] == '[]'
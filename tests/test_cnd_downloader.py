@@ -0,0 +1,89 @@
+import io
+import os
+import zipfile
+from datetime import datetime
+import pytest
+import requests
+from conftest import PAYLOAD
+from src.clients.cnd_downloader import CND_DOWNLOADER, staged_file_name
+from src.clients.download_cache import DOWNLOAD_CACHE
+
+DAY = datetime(2025, 3, 1)
+NAME = 'predespacho.xlsx'
+
+def _downloader(mock_cnd, staging_path:str, **kwargs) -> CND_DOWNLOADER:
+    return CND_DOWNLOADER(DAY, mock_cnd.base_url, PAYLOAD, staging_path, download_url=mock_cnd.download_url, **kwargs)
+
+def _workbook(corpus) -> bytes:
+    ## Served by the mock as file id 1
+    with open(corpus['xlsx'][0][1], 'rb') as f:
+        return f.read()
+
+def test_part_file_is_resumed_with_a_range_request(mock_cnd, corpus, tmp_path):
+    content=_workbook(corpus)
+    downloader=_downloader(mock_cnd, str(tmp_path))
+    part_path=tmp_path/f'{staged_file_name(1, NAME)}.part'
+    part_path.write_bytes(content[:1000])
+
+    assert downloader._fetch_file(1, NAME, '/Date(1)/') is False
+    assert (tmp_path/staged_file_name(1, NAME)).read_bytes() == content
+    assert not part_path.exists()
+    assert downloader.checksums[(1, NAME)]['size'] == len(content)
+
+def test_part_file_beyond_the_size_starts_over(mock_cnd, corpus, tmp_path):
+    ## The server answers 416 to the Range request
+    content=_workbook(corpus)
+    downloader=_downloader(mock_cnd, str(tmp_path))
+    (tmp_path/f'{staged_file_name(1, NAME)}.part').write_bytes(b'x'*(len(content)+10))
+
+    downloader._fetch_file(1, NAME, '/Date(1)/')
+    assert (tmp_path/staged_file_name(1, NAME)).read_bytes() == content
+
+def test_interrupted_transfer_resumes_from_the_received_bytes(mock_cnd, corpus, tmp_path, monkeypatch):
+    content=_workbook(corpus)
+    downloader=_downloader(mock_cnd, str(tmp_path))
+    stream_to=CND_DOWNLOADER._stream_to
+    attempts=[]
+
+    def interrupted(self, file_id, file_name, target):
+        attempts.append(target.seek(0, os.SEEK_END))
+        if len(attempts) == 1:
+            target.write(content[:2048])
+            raise requests.exceptions.ConnectionError('connection reset')
+        return stream_to(self, file_id, file_name, target)
+    monkeypatch.setattr(CND_DOWNLOADER, '_stream_to', interrupted)
+
+    downloader._fetch_file(1, NAME, '/Date(1)/')
+    ## The second attempt started from the 2048 bytes of the first one
+    assert attempts == [0, 2048]
+    assert (tmp_path/staged_file_name(1, NAME)).read_bytes() == content
+
+def test_size_mismatch_is_rejected_and_the_part_removed(mock_cnd, tmp_path, monkeypatch):
+    downloader=_downloader(mock_cnd, str(tmp_path))
+    ## The server announces more bytes than it sends
+    monkeypatch.setattr(CND_DOWNLOADER, '_stream_to_part', lambda self, file_id, file_name, part_path: 10**9)
+    (tmp_path/f'{staged_file_name(1, NAME)}.part').write_bytes(b'abc')
+
+    with pytest.raises(Exception, match='Size mismatch'):
+        downloader._fetch_file(1, NAME, '/Date(1)/')
+    assert os.listdir(tmp_path) == []
+
+def test_corrupted_zip_members_are_rejected(tmp_path):
+    buffer=io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as zf:
+        zf.writestr('a.xlsx', b'a'*1000)
+    content=bytearray(buffer.getvalue())
+    ## Flips a byte of the member data, its CRC does not match anymore
+    content[content.index(b'a'*10)]=ord('b')
+    downloader=CND_DOWNLOADER(DAY, 'http://unused', PAYLOAD, str(tmp_path))
+    with pytest.raises(Exception, match='Corrupted member a.xlsx'):
+        downloader._verify_file('a.zip', io.BytesIO(bytes(content)), len(content))
+
+def test_verified_downloads_are_served_from_the_cache(mock_cnd, corpus, tmp_path):
+    cache=DOWNLOAD_CACHE(str(tmp_path/'cache'))
+    os.makedirs(tmp_path/'s1')
+    assert _downloader(mock_cnd, str(tmp_path/'s1'), cache=cache)._fetch_file(1, NAME, '/Date(1)/') is False
+    downloads=mock_cnd.requests['download']
+    assert _downloader(mock_cnd, str(tmp_path/'s2'), cache=cache)._fetch_file(1, NAME, '/Date(1)/') is True
+    assert mock_cnd.requests['download'] == downloads
+    assert (tmp_path/'s2'/staged_file_name(1, NAME)).read_bytes() == _workbook(corpus)
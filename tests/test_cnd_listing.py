@@ -0,0 +1,46 @@
+import time
+from datetime import datetime, timedelta
+from benchmarks.mock_cnd_server import MOCK_CND_SERVER
+from src.clients.cnd_listing import CND_LISTING, dated_payload
+from conftest import PAYLOAD
+
+DAYS = [datetime(2025, 3, 1)+timedelta(days=d) for d in range(10)]
+
+def test_prefetch_lists_every_day_with_one_request(mock_cnd, tmp_path):
+    listing=CND_LISTING(mock_cnd.base_url, cache_path=str(tmp_path))
+    listings=listing.prefetch(PAYLOAD, DAYS)
+    assert all(len(records) == 1 for records in listings.values())
+    assert mock_cnd.requests['listing'] == len(DAYS)
+
+    ## Served from the cache
+    listing.prefetch(PAYLOAD, DAYS)
+    assert mock_cnd.requests['listing'] == len(DAYS)
+
+def test_pages_are_requested_only_after_a_full_page(corpus):
+    with MOCK_CND_SERVER({w: p for w, p in corpus['xlsx']}, page_size=1) as mock:
+        listing=CND_LISTING(mock.base_url, page_size=1)
+        assert len(listing.list_files(dated_payload(PAYLOAD, DAYS[0]))) == 1
+        ## Page 0 was full, page 1 empty
+        assert mock.requests['listing'] == 2
+
+def test_empty_listings_are_not_cached(mock_cnd, tmp_path):
+    listing=CND_LISTING(mock_cnd.base_url, cache_path=str(tmp_path))
+    payload=dated_payload(PAYLOAD, datetime(2024, 1, 1))
+    assert listing.list_files(payload) == []
+    assert listing.list_files(payload) == []
+    assert mock_cnd.requests['listing'] == 2
+    assert list(tmp_path.iterdir()) == []
+
+def test_listing_fetched_before_the_day_was_stable_expires(tmp_path):
+    listing=CND_LISTING('http://127.0.0.1:9/unused', cache_path=str(tmp_path), ttl_seconds=3600, stable_after_days=7)
+    payload=dated_payload(PAYLOAD, datetime(2025, 3, 1))
+    ## Fetched the same day, long ago: CND could have published the day afterwards
+    assert not listing._is_fresh({'fetched_at': datetime(2025, 3, 1, 12).timestamp(), 'records': []}, payload)
+    ## Fetched once the day was stable
+    assert listing._is_fresh({'fetched_at': datetime(2025, 3, 20).timestamp(), 'records': []}, payload)
+    ## Recent fetches are fresh for the TTL
+    assert listing._is_fresh({'fetched_at': time.time(), 'records': []}, dated_payload(PAYLOAD, datetime.now()))
+
+def test_failed_listings_are_none_not_empty():
+    listing=CND_LISTING('http://127.0.0.1:9/unused', timeout=1)
+    assert listing.prefetch(PAYLOAD, DAYS[:1]) == {DAYS[0]: None}
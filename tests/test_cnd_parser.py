@@ -0,0 +1,107 @@
+import glob
+import json
+from datetime import datetime
+import openpyxl
+import pandas as pd
+import pytest
+from benchmarks.synthetic_workbooks import make_predispatch_workbook
+from src.clients.cnd_parser import CND_PARSER
+from src.clients.schema_registry import SCHEMA_REGISTRY, clean_column
+
+DAY = datetime(2025, 3, 1)
+
+def _parse(path:str, staging_path:str, registry:SCHEMA_REGISTRY=None) -> pd.DataFrame:
+    parser=CND_PARSER(file_metadata=(1, 'predespacho.xlsx', '/Date(0)/'), file_path=path, staging_path=staging_path, schema_registry=registry)
+    parser.parse_predispatch_days(requested_dates=[DAY], header=3, output_prefix='test')
+    return pd.read_parquet(glob.glob(f'{staging_path}/*.parquet')[0])
+
+def test_columns_match_read_excel(tmp_path):
+    path=make_predispatch_workbook(str(tmp_path/'predespacho.xlsx'), DAY, units=5, seed=1)
+    expected=[clean_column(c) for c in pd.read_excel(path, header=3, sheet_name='Día 1').columns]
+    df=_parse(path, str(tmp_path/'staging'))
+    assert list(df.columns) == expected+['fecha', 'file_id', 'file_name', 'epoch_public_date']
+    ## The column without header is kept, empty, like the baseline output
+    assert 'unnamed:27' in df.columns and df['unnamed:27'].isna().all()
+
+def test_layouts_of_older_registries_are_rebuilt(tmp_path):
+    path=make_predispatch_workbook(str(tmp_path/'predespacho.xlsx'), DAY, units=5, seed=1)
+    registry_path=str(tmp_path/'layouts.json')
+    registry=SCHEMA_REGISTRY(registry_path=registry_path)
+    _parse(path, str(tmp_path/'s1'), registry)
+
+    ## A layout persisted before the columns without header were read
+    with open(registry_path) as f:
+        layouts=json.load(f)
+    for layout in layouts['layouts'].values():
+        del layout['version']
+        keep=[i for i, c in enumerate(layout['columns']) if not c.startswith('unnamed')]
+        layout['usecols']=[layout['usecols'][i] for i in keep]
+        layout['columns']=[layout['columns'][i] for i in keep]
+    with open(registry_path, 'w') as f:
+        json.dump(layouts, f)
+
+    df=_parse(path, str(tmp_path/'s2'), SCHEMA_REGISTRY(registry_path=registry_path))
+    assert 'unnamed:27' in df.columns
+
+def _edit_sheets(path:str, edit) -> str:
+    ## Applies edit to every sheet of a synthetic workbook
+    wb=openpyxl.load_workbook(path)
+    for ws in wb.worksheets:
+        edit(ws)
+    wb.save(path)
+    return path
+
+def test_known_layouts_read_only_their_columns_with_cached_dtypes(tmp_path, monkeypatch):
+    path=make_predispatch_workbook(str(tmp_path/'predespacho.xlsx'), DAY, units=5, seed=1)
+    ## A note right of the table, outside the header
+    _edit_sheets(path, lambda ws: ws.cell(row=8, column=40, value='nota'))
+    registry=SCHEMA_REGISTRY()
+    first=_parse(path, str(tmp_path/'s1'), registry)
+
+    calls=[]
+    parse=pd.ExcelFile.parse
+    def spy(self, *args, **kwargs):
+        calls.append(kwargs)
+        return parse(self, *args, **kwargs)
+    monkeypatch.setattr(pd.ExcelFile, 'parse', spy)
+    second=_parse(path, str(tmp_path/'s2'), registry)
+
+    ## The top rows to find the layout, then the body with the hints of the layout
+    assert [c.get('nrows') for c in calls] == [registry.scan_rows, None]
+    body=calls[1]
+    assert body['skiprows'] == 4 and body['usecols'] == list(range(29))
+    assert body['dtype'] != {} and all(t == 'float64' for t in body['dtype'].values())
+    assert 'unnamed:39' not in second.columns
+    pd.testing.assert_frame_equal(first, second)
+
+def test_header_row_is_detected(tmp_path):
+    path=make_predispatch_workbook(str(tmp_path/'predespacho.xlsx'), DAY, units=5, seed=1)
+    expected=_parse(path, str(tmp_path/'s1'))
+    ## Two more title rows, the header moves from row 3 to row 5
+    _edit_sheets(path, lambda ws: ws.insert_rows(3, amount=2))
+    registry=SCHEMA_REGISTRY()
+    df=_parse(path, str(tmp_path/'s2'), registry)
+    assert [l['header_row'] for l in registry.layouts.values()] == [5]
+    pd.testing.assert_frame_equal(df.drop(columns='fecha'), expected.drop(columns='fecha'))
+
+def test_layout_drift_is_reported(tmp_path, capsys):
+    registry_path=str(tmp_path/'layouts.json')
+    path=make_predispatch_workbook(str(tmp_path/'v1/predespacho.xlsx'), DAY, units=5, seed=1)
+    _parse(path, str(tmp_path/'s1'), SCHEMA_REGISTRY(registry_path=registry_path))
+
+    ## A new column after Pot. $
+    drifted=make_predispatch_workbook(str(tmp_path/'v2/predespacho.xlsx'), DAY, units=5, seed=1)
+    def add_column(ws):
+        ws.cell(row=4, column=30, value='Reserva')
+        for r in range(5, ws.max_row+1):
+            ws.cell(row=r, column=30, value=1.5)
+    _edit_sheets(drifted, add_column)
+
+    with pytest.raises(Exception, match=r"Layout drift .* columns added \['reserva'\], removed \[\]"):
+        _parse(drifted, str(tmp_path/'s2'), SCHEMA_REGISTRY(registry_path=registry_path, strict=True))
+    capsys.readouterr()
+    registry=SCHEMA_REGISTRY(registry_path=registry_path)
+    df=_parse(drifted, str(tmp_path/'s3'), registry)
+    assert '[Error] Layout drift' in capsys.readouterr().out
+    assert list(df['reserva']) == [1.5]*5
+    assert len(registry.layouts) == 2
@@ -0,0 +1,35 @@
+import os
+from datetime import datetime
+from conftest import PAYLOAD
+from src.pipeline.tasks.cnd_predispatch_downparse import download_buffers, download_files, parse_downloaded_files
+
+DAY = datetime(2025, 3, 1)
+
+class STUB_LISTING:
+    ## Lists the two workbooks of the mock under the same name
+    def list_files(self, payload:dict) -> list:
+        return [
+            {'id': file_id, 'adjunto': {'path': 'Informes\\Predespacho\\predespacho.xlsx'}, 'fechaPublica': f'/Date({file_id})/'}
+            for file_id in (1, 2)
+        ]
+
+def test_files_with_the_same_name_are_kept_apart(mock_cnd, tmp_path):
+    download_path=str(tmp_path/'download')
+    file_metadata=download_files(DAY, mock_cnd.base_url, PAYLOAD, download_path, listing=STUB_LISTING(), download_url=mock_cnd.download_url)
+    assert sorted(os.listdir(download_path)) == ['1_predespacho.xlsx', '2_predespacho.xlsx']
+    assert os.path.getsize(f'{download_path}/1_predespacho.xlsx') != os.path.getsize(f'{download_path}/2_predespacho.xlsx')
+
+    output_dirs={DAY: str(tmp_path/'2025-03-01')}
+    results=parse_downloaded_files(file_metadata, download_path, [DAY], output_dirs, header=3, output_prefix='test')
+    assert sorted(results) == [(1, 'predespacho.xlsx'), (2, 'predespacho.xlsx')]
+    assert all(r['status'] == 'parsed' for r in results.values())
+    ## Parsed raw files are removed
+    assert os.listdir(download_path) == []
+
+def test_buffers_are_keyed_by_file_id_and_name(mock_cnd, tmp_path):
+    file_metadata, buffers=download_buffers(DAY, mock_cnd.base_url, PAYLOAD, listing=STUB_LISTING(), download_url=mock_cnd.download_url)
+    assert sorted(buffers) == [(1, 'predespacho.xlsx'), (2, 'predespacho.xlsx')]
+    results=parse_downloaded_files(file_metadata, str(tmp_path/'download'), [DAY], {DAY: str(tmp_path/'out')},
+                                   header=3, output_prefix='test', buffers=buffers)
+    assert sorted(results) == sorted(buffers)
+    assert all(r['output_buffers'] != {} for r in results.values())
@@ -0,0 +1,82 @@
+import os
+from datetime import datetime
+import pandas as pd
+import pyarrow.dataset as ds
+import pytest
+from conftest import PAYLOAD
+from src.pipeline.flows.cnd_predispatch_flow import cnd_predispatch
+
+def _run(mock_cnd, tmp_path, **kwargs):
+    return cnd_predispatch(
+        base_url=mock_cnd.base_url,
+        download_url=mock_cnd.download_url,
+        payload=PAYLOAD,
+        staging_path=kwargs.pop('staging_path', str(tmp_path/'staging')),
+        requested_date=datetime(2025, 3, 4),
+        days_backfill=kwargs.pop('days_backfill', 2),
+        requests_per_second=1000,
+        **kwargs
+    )
+
+def test_revision_index_with_datasets_is_rejected(mock_cnd, tmp_path):
+    with pytest.raises(Exception, match='revision_index_path'):
+        _run(mock_cnd, tmp_path, dataset_path=str(tmp_path/'dataset'), revision_index_path=str(tmp_path/'revisions.sqlite'))
+    ## Nothing was listed nor written
+    assert mock_cnd.requests['listing'] == 0
+    assert not (tmp_path/'dataset').exists()
+
+def test_pipelined_run_inside_an_event_loop(mock_cnd, tmp_path):
+    import asyncio
+
+    async def orchestrator():
+        ## As from a notebook or an async orchestrator
+        return _run(mock_cnd, tmp_path, pipelined=True, state_path=str(tmp_path/'state.sqlite'))
+    asyncio.run(orchestrator())
+    assert sorted(os.listdir(tmp_path/'staging')) == ['2025-03-02', '2025-03-03']
+
+def test_resources_are_closed_when_the_run_raises(mock_cnd, tmp_path, monkeypatch):
+    from src.pipeline.flows import cnd_predispatch_flow
+    closed=[]
+    build_session=cnd_predispatch_flow.build_session
+    def tracked_session(**kwargs):
+        session=build_session(**kwargs)
+        close=session.close
+        session.close=lambda: (closed.append('session'), close())
+        return session
+    monkeypatch.setattr(cnd_predispatch_flow, 'build_session', tracked_session)
+    close_state=cnd_predispatch_flow.BACKFILL_STATE.close
+    monkeypatch.setattr(cnd_predispatch_flow.BACKFILL_STATE, 'close', lambda self: (closed.append('state'), close_state(self)))
+    def failing_resume(units, final_stage):
+        raise Exception('resume failed')
+    monkeypatch.setattr(cnd_predispatch_flow, '_resume_units', failing_resume)
+
+    with pytest.raises(Exception, match='resume failed'):
+        _run(mock_cnd, tmp_path, state_path=str(tmp_path/'state.sqlite'))
+    assert sorted(closed) == ['session', 'state']
+
+def _dataset_rows(dataset_path) -> pd.DataFrame:
+    rows=ds.dataset(str(dataset_path), format='parquet', partitioning='hive').to_table().to_pandas()
+    return rows.sort_values(['fecha', 'plantas']).reset_index(drop=True)
+
+def test_memory_staging_needs_an_output(mock_cnd, tmp_path):
+    with pytest.raises(Exception, match='Memory staging needs an upload or a dataset_path'):
+        _run(mock_cnd, tmp_path, staging_mode='memory')
+
+def test_memory_staging_matches_disk_staging(mock_cnd, tmp_path):
+    _run(mock_cnd, tmp_path, dataset_path=str(tmp_path/'disk'))
+    _run(mock_cnd, tmp_path, dataset_path=str(tmp_path/'memory'), staging_mode='memory', staging_path=str(tmp_path/'memory_staging'))
+    ## Nothing was staged on disk
+    assert not (tmp_path/'memory_staging').exists()
+    rows=_dataset_rows(tmp_path/'memory'/'wide')
+    assert len(rows) == 10
+    pd.testing.assert_frame_equal(rows, _dataset_rows(tmp_path/'disk'/'wide'))
+
+def test_memory_staging_archives_the_files_that_failed(mock_cnd, tmp_path, monkeypatch):
+    from src.clients.cnd_parser import CND_PARSER
+    def failing_parse(self, **kwargs):
+        raise Exception('broken workbook')
+    monkeypatch.setattr(CND_PARSER, 'parse_predispatch_days', failing_parse)
+    monkeypatch.chdir(tmp_path)
+    _run(mock_cnd, tmp_path, dataset_path=str(tmp_path/'dataset'), staging_mode='memory', days_backfill=1)
+    assert os.listdir(tmp_path/'archive'/'2025-03-03') == ['1_predespacho_20250301.xlsx']
+    assert not (tmp_path/'dataset').exists()
@@ -0,0 +1,58 @@
+import json
+import os
+from src.clients.download_cache import DOWNLOAD_CACHE
+
+def _file(path, size:int, fill:bytes) -> str:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(fill*size)
+    return str(path)
+
+def _index(cache_path) -> dict:
+    with open(f'{cache_path}/index.json') as f:
+        return json.load(f)
+
+def test_hits_are_saved_only_on_flush(tmp_path, monkeypatch):
+    cache=DOWNLOAD_CACHE(str(tmp_path/'cache'))
+    cache.put_file(1, '/Date(1)/', _file(tmp_path/'a.xlsx', 10, b'a'))
+    saved=_index(tmp_path/'cache')['files']['1_1']['last_access']
+
+    saves=[]
+    save_index=DOWNLOAD_CACHE._save_index
+    monkeypatch.setattr(DOWNLOAD_CACHE, '_save_index', lambda self: (saves.append(1), save_index(self)))
+    for n in range(5):
+        assert cache.get_file(1, '/Date(1)/', str(tmp_path/f'hit_{n}.xlsx'))
+    assert saves == []
+    cache.flush()
+    assert saves == [1]
+    assert _index(tmp_path/'cache')['files']['1_1']['last_access'] > saved
+    ## Nothing new to save
+    cache.flush()
+    assert saves == [1]
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache=DOWNLOAD_CACHE(str(tmp_path/'cache'), max_bytes=25)
+    cache.put_file(1, '/Date(1)/', _file(tmp_path/'a.xlsx', 10, b'a'))
+    cache.put_file(2, '/Date(2)/', _file(tmp_path/'b.xlsx', 10, b'b'))
+    ## 1 is used again, 2 becomes the least recently used
+    assert cache.get_file(1, '/Date(1)/', str(tmp_path/'hit.xlsx'))
+    cache.put_file(3, '/Date(3)/', _file(tmp_path/'c.xlsx', 10, b'c'))
+    assert sorted(_index(tmp_path/'cache')['files']) == ['1_1', '3_3']
+    assert not cache.get_file(2, '/Date(2)/', str(tmp_path/'miss.xlsx'))
+    assert len([f for _, _, files in os.walk(tmp_path/'cache'/'objects') for f in files]) == 2
+
+def test_processes_sharing_the_cache_keep_each_other_entries(tmp_path):
+    first=DOWNLOAD_CACHE(str(tmp_path/'cache'))
+    second=DOWNLOAD_CACHE(str(tmp_path/'cache'))
+    first.put_file(1, '/Date(1)/', _file(tmp_path/'a.xlsx', 10, b'a'))
+    second.put_file(2, '/Date(2)/', _file(tmp_path/'b.xlsx', 10, b'b'))
+    first.put_parsed(1, '/Date(1)/', 'wide', [_file(tmp_path/'out'/'a.parquet', 10, b'p')])
+    index=_index(tmp_path/'cache')
+    assert sorted(index['files']) == ['1_1', '2_2'] and list(index['parsed']) == ['1_1/wide']
+    assert DOWNLOAD_CACHE(str(tmp_path/'cache')).get_file(2, '/Date(2)/', str(tmp_path/'hit.xlsx'))
+
+    ## An entry evicted by one process is not written back by the other
+    third=DOWNLOAD_CACHE(str(tmp_path/'cache'), max_bytes=15)
+    third.put_file(3, '/Date(3)/', _file(tmp_path/'c.xlsx', 10, b'c'))
+    first.put_file(4, '/Date(4)/', _file(tmp_path/'d.xlsx', 1, b'd'))
+    assert '1_1' not in _index(tmp_path/'cache')['files']
@@ -0,0 +1,280 @@
+import base64
+import hashlib
+import re
+import threading
+from types import SimpleNamespace
+import pytest
+
+pytest.importorskip('google.cloud.bigquery')
+import google_crc32c
+from google.api_core.exceptions import PreconditionFailed
+from src.clients.gcp_client import GCP_UPLOADER
+
+class STUB_BLOB:
+
+    def __init__(self, bucket:'STUB_BUCKET', name:str) -> None:
+        self.bucket=bucket
+        self.name=name
+        self.generation=None
+
+    def upload_from_file(self, f, size:int=None, if_generation_match:int=None) -> None:
+        self.bucket.storage.write(self.bucket.name, self.name, f.read(), if_generation_match)
+        self.generation=self.bucket.storage.objects[(self.bucket.name, self.name)]['generation']
+
+    def upload_from_filename(self, path:str, if_generation_match:int=None) -> None:
+        with open(path, 'rb') as f:
+            self.upload_from_file(f, if_generation_match=if_generation_match)
+
+    def delete(self) -> None:
+        with self.bucket.storage._lock:
+            del self.bucket.storage.objects[(self.bucket.name, self.name)]
+
+class STUB_BUCKET:
+
+    def __init__(self, storage:'STUB_STORAGE_CLIENT', name:str) -> None:
+        self.storage=storage
+        self.name=name
+
+    def blob(self, name:str, chunk_size:int=None) -> STUB_BLOB:
+        return STUB_BLOB(self, name)
+
+class STUB_STORAGE_CLIENT:
+    '''
+    In-memory GCS with object generations and if_generation_match preconditions.
+    '''
+
+    def __init__(self, fail_listing:bool=False) -> None:
+        self.objects={}
+        self.writes=0
+        self.fail_listing=fail_listing
+        self._lock=threading.Lock()
+
+    def bucket(self, name:str) -> STUB_BUCKET:
+        return STUB_BUCKET(self, name)
+
+    def write(self, bucket_name:str, name:str, data:bytes, if_generation_match:int=None) -> None:
+        with self._lock:
+            current=self.objects.get((bucket_name, name))
+            if if_generation_match is not None and (current['generation'] if current is not None else 0) != if_generation_match:
+                raise PreconditionFailed(f'{name} is not at generation {if_generation_match}')
+            crc32c=google_crc32c.Checksum(data)
+            self.objects[(bucket_name, name)]={
+                'data': data,
+                'generation': (current['generation'] if current is not None else 0)+1,
+                'crc32c': base64.b64encode(crc32c.digest()).decode(),
+                'md5': base64.b64encode(hashlib.md5(data).digest()).decode()
+            }
+            self.writes+=1
+
+    def list_blobs(self, bucket:STUB_BUCKET, prefix:str=None) -> list:
+        if self.fail_listing:
+            raise Exception('listing unavailable')
+        return [
+            SimpleNamespace(name=name, crc32c=o['crc32c'], md5_hash=o['md5'], generation=o['generation'])
+            for (bucket_name, name), o in self.objects.items() if bucket_name == bucket.name and name.startswith(prefix)
+        ]
+
+    def close(self) -> None:
+        pass
+
+def _uploader(staging_path:str, storage:STUB_STORAGE_CLIENT, manifest_path:str=None) -> GCP_UPLOADER:
+    uploader=GCP_UPLOADER(gcp_project_id='test-project', staging_path=staging_path, max_workers=4, manifest_path=manifest_path)
+    uploader._storage_client=storage
+    return uploader
+
+def test_failed_remote_listing_uploads_without_precondition(tmp_path):
+    (tmp_path/'day.parquet').write_bytes(b'new content')
+    storage=STUB_STORAGE_CLIENT(fail_listing=True)
+    storage.write('bucket', 'folder/day.parquet', b'old content')
+
+    result=_uploader(str(tmp_path), storage).gcs_upload('bucket', 'folder', incremental=True)
+    assert [r['blob_name'] for r in result['uploaded']] == ['folder/day.parquet']
+    assert result['failed'] == []
+    assert storage.objects[('bucket', 'folder/day.parquet')]['data'] == b'new content'
+
+class STUB_BQ_CLIENT:
+    '''
+    BigQuery client recording the jobs it is sent, with the staging table of the given columns.
+    '''
+
+    def __init__(self, columns:list) -> None:
+        self.project='test-project'
+        self.columns=columns
+        self.queries=[]
+        self.loads=[]
+
+    def _job(self, **fields) -> SimpleNamespace:
+        return SimpleNamespace(result=lambda: None, job_id=f'job_{len(self.queries)+len(self.loads)}', **fields)
+
+    def load_table_from_uri(self, uris:list, table_id:str, job_config=None) -> SimpleNamespace:
+        self.loads.append((list(uris), table_id))
+        return self._job(input_file_bytes=100*len(uris), output_rows=10*len(uris))
+
+    def get_table(self, table_id:str) -> SimpleNamespace:
+        return SimpleNamespace(schema=[SimpleNamespace(name=c) for c in self.columns])
+
+    def query(self, sql:str) -> SimpleNamespace:
+        self.queries.append(sql)
+        dml_stats=SimpleNamespace(inserted_row_count=1, updated_row_count=2, deleted_row_count=0)
+        return self._job(total_bytes_processed=10, total_bytes_billed=10, num_dml_affected_rows=3, dml_stats=dml_stats, slot_millis=1)
+
+def _merge(columns:list) -> str:
+    client=STUB_BQ_CLIENT(columns)
+    uploader=GCP_UPLOADER(gcp_project_id='test-project', staging_path='unused', bq_client=client)
+    stats=uploader.bq_load_and_merge(
+        bq_dataset='energy',
+        bq_table='predispatch',
+        source_uris=['gs://bucket/a.parquet', 'gs://bucket/b.parquet'],
+        merge_key_columns=['fecha', 'plantas']
+    )
+    assert stats['load']['files'] == 2
+    assert client.loads == [(['gs://bucket/a.parquet', 'gs://bucket/b.parquet'], 'test-project.energy.predispatch_staging')]
+    return client.queries[-1]
+
+def _window_order(sql:str) -> str:
+    return re.search(r'PARTITION BY `fecha`, `plantas` ORDER BY (.*)\) = 1', sql).group(1)
+
+def test_merge_keeps_the_latest_publication_of_a_key():
+    sql=_merge(['fecha', 'plantas', 'h0_1', 'file_id', 'file_name', 'epoch_public_date'])
+    order=_window_order(sql)
+    assert order.index('epoch_public_date') < order.index('file_id') < order.index('TO_JSON_STRING')
+    assert 'DELETE' not in sql
+
+def test_delta_merge_orders_by_revision_first():
+    sql=_merge(['fecha', 'plantas', 'h0_1', 'file_id', 'file_name', 'epoch_public_date', 'change_type', 'revision'])
+    assert _window_order(sql).startswith('`revision` DESC')
+    assert "WHEN MATCHED AND S.change_type = 'delete' THEN DELETE" in sql
+
+def test_merge_without_publication_columns_is_still_ordered():
+    assert _window_order(_merge(['fecha', 'plantas', 'h0_1'])) == 'TO_JSON_STRING(R) DESC'
+
+def _write_files(path, count:int, content:bytes=b'content') -> None:
+    for i in range(count):
+        (path/f'mes=2025-{i+1:02d}').mkdir(parents=True, exist_ok=True)
+        (path/f'mes=2025-{i+1:02d}'/f'part-{i}.parquet').write_bytes(content+bytes([i]))
+
+def test_parallel_upload_keeps_the_partition_folders(tmp_path):
+    _write_files(tmp_path/'staging', 12)
+    storage=STUB_STORAGE_CLIENT()
+    result=_uploader(str(tmp_path/'staging'), storage).gcs_upload('bucket', 'wide', regexp_file='.parquet')
+    assert len(result['uploaded']) == 12 and result['failed'] == []
+    assert sorted(name for _, name in storage.objects) == sorted(f'wide/mes=2025-{i+1:02d}/part-{i}.parquet' for i in range(12))
+
+def test_incremental_upload_skips_unchanged_files(tmp_path):
+    _write_files(tmp_path/'staging', 6)
+    storage=STUB_STORAGE_CLIENT()
+    manifest_path=str(tmp_path/'manifest.json')
+    assert len(_uploader(str(tmp_path/'staging'), storage, manifest_path).gcs_upload('bucket', 'wide', incremental=True)['uploaded']) == 6
+
+    ## A new run with the manifest sends only the changed file
+    (tmp_path/'staging'/'mes=2025-01'/'part-0.parquet').write_bytes(b'changed')
+    result=_uploader(str(tmp_path/'staging'), storage, manifest_path).gcs_upload('bucket', 'wide', incremental=True)
+    assert [r['blob_name'] for r in result['uploaded']] == ['wide/mes=2025-01/part-0.parquet']
+    assert len(result['skipped']) == 5
+    assert storage.writes == 7
+
+    ## Without the manifest, the checksums of the remote listing are compared
+    result=_uploader(str(tmp_path/'staging'), storage).gcs_upload('bucket', 'wide', incremental=True)
+    assert len(result['skipped']) == 6 and storage.writes == 7
+
+def test_incremental_upload_does_not_overwrite_concurrent_changes(tmp_path):
+    _write_files(tmp_path/'staging', 1)
+    storage=STUB_STORAGE_CLIENT()
+    manifest_path=str(tmp_path/'manifest.json')
+    _uploader(str(tmp_path/'staging'), storage, manifest_path).gcs_upload('bucket', 'wide', incremental=True)
+
+    ## Another run replaces the object after this run recorded its generation
+    storage.write('bucket', 'wide/mes=2025-01/part-0.parquet', b'other run')
+    (tmp_path/'staging'/'mes=2025-01'/'part-0.parquet').write_bytes(b'changed')
+    result=_uploader(str(tmp_path/'staging'), storage, manifest_path).gcs_upload('bucket', 'wide', incremental=True)
+    assert len(result['failed']) == 1 and 'changed by another run' in result['failed'][0]['error']
+    assert storage.objects[('bucket', 'wide/mes=2025-01/part-0.parquet')]['data'] == b'other run'
+
+def test_in_memory_buffers_are_uploaded_and_deleted(tmp_path):
+    storage=STUB_STORAGE_CLIENT()
+    uploader=_uploader(str(tmp_path), storage)
+    buffers={'2025-03-01/a.parquet': b'a', '2025-03-01/b.parquet': b'b', '2025-03-01/c.csv': b'c'}
+    result=uploader.gcs_upload('bucket', 'folder', regexp_file='.parquet', buffers=buffers)
+    assert sorted(r['blob_name'] for r in result['uploaded']) == ['folder/2025-03-01/a.parquet', 'folder/2025-03-01/b.parquet']
+    uploader.gcs_delete('bucket', 'folder', ['2025-03-01/a.parquet'])
+    assert list(storage.objects) == [('bucket', 'folder/2025-03-01/b.parquet')]
+
+def test_load_jobs_are_split_above_the_uri_limit():
+    client=STUB_BQ_CLIENT(['fecha', 'plantas', 'h0_1'])
+    uploader=GCP_UPLOADER(gcp_project_id='test-project', staging_path='unused', bq_client=client)
+    uris=[f'gs://bucket/{i}.parquet' for i in range(5)]
+    stats=uploader.bq_load_and_merge(bq_dataset='energy', bq_table='predispatch', source_uris=uris,
+                                     merge_key_columns=['fecha', 'plantas'], max_uris_per_job=2)
+    assert [len(u) for u, _ in client.loads] == [2, 2, 1]
+    assert stats['load']['output_rows'] == 50
+    ## One MERGE for the whole run, after creating the target
+    assert len([q for q in client.queries if q.strip().startswith('MERGE')]) == 1
+
+def test_invalid_identifiers_are_rejected():
+    uploader=GCP_UPLOADER(gcp_project_id='test-project', staging_path='unused', bq_client=STUB_BQ_CLIENT([]))
+    with pytest.raises(Exception, match='Invalid BigQuery identifier'):
+        uploader.bq_load_and_merge(bq_dataset='energy', bq_table='x; DROP TABLE y', source_uris=['gs://b/a.parquet'], merge_key_columns=['fecha'])
+
+def test_flow_uploads_and_merges_the_run(mock_cnd, tmp_path, monkeypatch):
+    from conftest import PAYLOAD
+    from datetime import datetime
+    from src.pipeline.flows.cnd_predispatch_flow import cnd_predispatch
+
+    storage=STUB_STORAGE_CLIENT()
+    client=STUB_BQ_CLIENT(['fecha', 'plantas', 'h0_1', 'file_id', 'file_name', 'epoch_public_date'])
+    monkeypatch.setattr(GCP_UPLOADER, 'storage_client', property(lambda self: storage))
+    monkeypatch.setattr(GCP_UPLOADER, 'bq_client', property(lambda self: client))
+    monkeypatch.chdir(tmp_path)
+
+    stats=cnd_predispatch(
+        base_url=mock_cnd.base_url,
+        download_url=mock_cnd.download_url,
+        payload=PAYLOAD,
+        staging_path=str(tmp_path/'staging'),
+        gcp_project_id='test-project',
+        bucket_name='bucket',
+        blob_folder_name='predispatch',
+        requested_date=datetime(2025, 3, 4),
+        days_backfill=3,
+        requests_per_second=1000,
+        max_workers=2,
+        dataset_path=str(tmp_path/'dataset'),
+        bq_dataset='energy',
+        bq_table='predispatch',
+        merge_key_columns=['fecha', 'plantas']
+    )
+    uploaded=sorted(name for _, name in storage.objects)
+    assert uploaded != [] and all(name.startswith('predispatch/wide/mes=2025-03/') for name in uploaded)
+    ## A single load of the uploaded partition and a single MERGE
+    assert len(client.loads) == 1
+    assert sorted(client.loads[0][0]) == sorted(f'gs://bucket/{name}' for name in uploaded)
+    assert stats['merge']['rows_affected'] == 3
+
+def test_flow_uploads_every_file_unless_incremental(mock_cnd, tmp_path, monkeypatch):
+    from conftest import PAYLOAD
+    from datetime import datetime
+    from src.pipeline.flows.cnd_predispatch_flow import cnd_predispatch
+
+    storage=STUB_STORAGE_CLIENT()
+    monkeypatch.setattr(GCP_UPLOADER, 'storage_client', property(lambda self: storage))
+    monkeypatch.chdir(tmp_path)
+    run=lambda **kwargs: cnd_predispatch(
+        base_url=mock_cnd.base_url,
+        download_url=mock_cnd.download_url,
+        payload=PAYLOAD,
+        staging_path=str(tmp_path/'staging'),
+        gcp_project_id='test-project',
+        bucket_name='bucket',
+        blob_folder_name='predispatch',
+        requested_date=datetime(2025, 3, 4),
+        days_backfill=2,
+        requests_per_second=1000,
+        **kwargs
+    )
+    run()
+    run()
+    ## Without incremental_upload every file is uploaded again
+    assert {o['generation'] for o in storage.objects.values()} == {2}
+    writes=storage.writes
+    run(incremental_upload=True)
+    assert storage.writes == writes
@@ -0,0 +1,33 @@
+from benchmarks.mock_cnd_server import MOCK_CND_SERVER
+from src.clients.http_session import build_session, rate_limited_get
+from src.clients.rate_limiter import RATE_LIMITER
+from conftest import PAYLOAD
+
+class RECORDING_LIMITER(RATE_LIMITER):
+
+    def __init__(self, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.acquired=0
+        self.reported=[]
+
+    def acquire(self) -> None:
+        self.acquired+=1
+        super().acquire()
+
+    def report(self, status_code:int=None, retry_after:float=None) -> None:
+        self.reported.append(status_code)
+        super().report(status_code, retry_after)
+
+def test_retries_take_tokens_and_report_to_the_limiter(corpus):
+    limiter=RECORDING_LIMITER(rate=1000, max_rate=1000, min_rate=100)
+    session=build_session(retries=10, backoff_factor=0, rate_limiter=limiter)
+    with MOCK_CND_SERVER({w: p for w, p in corpus['xlsx']}, error_rate=0.5, seed=1) as mock:
+        for day in range(1, 11):
+            params={**PAYLOAD, 'anio': '2025', 'mes': '3', 'dia': str(day), 'semana': '0'}
+            assert rate_limited_get(session, mock.base_url, params, rate_limiter=limiter).status_code == 200
+        requests_sent=mock.requests['listing']+mock.requests['errors']
+    assert mock.requests['errors'] > 0
+    ## Every request sent, retries included, took a token and was reported
+    assert limiter.acquired == requests_sent
+    assert len(limiter.reported) == requests_sent
+    assert limiter.reported.count(503) == mock.requests['errors']
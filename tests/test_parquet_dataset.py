@@ -0,0 +1,67 @@
+import os
+from datetime import datetime, timedelta
+import pandas as pd
+import pyarrow.dataset as ds
+from src.clients.parquet_dataset import PARQUET_DATASET_WRITER
+
+def _day(day:datetime, units:int=3) -> pd.DataFrame:
+    return pd.DataFrame({
+        'plantas': [f'UNIT {u}' for u in range(units)],
+        'h0_1': [float(u) for u in range(units)],
+        'fecha': day,
+        'file_id': 1
+    })
+
+def _files(root_path) -> list:
+    return sorted(os.path.relpath(os.path.join(r, f), root_path) for r, _, files in os.walk(root_path) for f in files)
+
+def _rows(root_path) -> pd.DataFrame:
+    return ds.dataset(str(root_path), format='parquet', partitioning='hive').to_table().to_pandas()
+
+def test_small_files_of_a_partition_are_compacted(tmp_path):
+    dataset=PARQUET_DATASET_WRITER(str(tmp_path/'wide'), target_file_bytes=1024**2)
+    ## One file per day, as when every day is flushed on its own
+    for d in range(5):
+        dataset.append(_day(datetime(2025, 3, 1)+timedelta(days=d)))
+        dataset.flush()
+    dataset.append(_day(datetime(2025, 4, 1)))
+    dataset.flush()
+    assert len([f for f in _files(tmp_path/'wide') if f.startswith('mes=2025-03')]) == 5
+    before=_rows(tmp_path/'wide')
+
+    result=dataset.compact(['2025-03'])
+    assert len(result['written']) == 1 and len(result['removed']) == 5
+    assert [f.split('/')[0] for f in _files(tmp_path/'wide')] == ['mes=2025-03', 'mes=2025-04']
+    after=_rows(tmp_path/'wide')
+    ## No row lost nor duplicated
+    key=['fecha', 'plantas']
+    pd.testing.assert_frame_equal(after.sort_values(key).reset_index(drop=True), before.sort_values(key).reset_index(drop=True))
+    assert dataset.appended_partitions == {'2025-03', '2025-04'}
+
+def test_files_at_the_target_size_are_kept(tmp_path):
+    dataset=PARQUET_DATASET_WRITER(str(tmp_path/'wide'))
+    for d in range(3):
+        dataset.append(_day(datetime(2025, 3, 1)+timedelta(days=d), units=200))
+        dataset.flush()
+    sizes=sorted(os.path.getsize(tmp_path/'wide'/f) for f in _files(tmp_path/'wide'))
+    ## Two small files fit the target, the third one does not
+    dataset.target_file_bytes=sizes[0]+sizes[1]
+    result=dataset.compact()
+    assert len(result['removed']) == 2
+    assert len(_files(tmp_path/'wide')) == 2
+    assert len(_rows(tmp_path/'wide')) == 600
+
+def test_day_partitions_restore_fecha_from_the_path(tmp_path):
+    dataset=PARQUET_DATASET_WRITER(str(tmp_path/'wide'), partition_by='day')
+    dataset.append(pd.concat([_day(datetime(2025, 3, 1)), _day(datetime(2025, 3, 2))]))
+    assert _files(tmp_path/'wide') == []
+    written=dataset.flush()
+    assert sorted(os.path.basename(os.path.dirname(p)) for p in written) == ['fecha=2025-03-01', 'fecha=2025-03-02']
+    rows=_rows(tmp_path/'wide')
+    assert len(rows) == 6 and sorted(rows['fecha'].astype(str).unique()) == ['2025-03-01', '2025-03-02']
+
+def test_buffers_are_flushed_at_the_target_size(tmp_path):
+    dataset=PARQUET_DATASET_WRITER(str(tmp_path/'wide'), target_file_bytes=1)
+    written=dataset.append(_day(datetime(2025, 3, 1)))
+    assert len(written) == 1 and os.path.exists(written[0])
+    assert dataset.flush() == []
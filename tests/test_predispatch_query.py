@@ -0,0 +1,50 @@
+import os
+from datetime import datetime
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from src.clients.predispatch_query import PREDISPATCH_QUERY
+
+@pytest.fixture
+def dataset(tmp_path):
+    ## One wide and one long file of March 2025, in the folders of a dataset_path
+    days=[datetime(2025, 3, 1), datetime(2025, 3, 2)]
+    wide=pa.table({
+      'fecha': days,
+      'plantas': ['BAYANO 1', 'BAYANO 1'],
+      'h0_1': pa.array([1.0, 2.0], pa.float32()),
+      'h1_2': pa.array([3.0, 4.0], pa.float32())
+    })
+    long=pa.table({
+      'fecha': [days[0], days[0]],
+      'plantas': ['BAYANO 1', 'BAYANO 1'],
+      'hour_interval': ['h0_1', 'h1_2'],
+      'interval_start': [days[0], days[0].replace(hour=1)],
+      'value': pa.array([1.0, 3.0], pa.float32())
+    })
+    for folder, table in ((tmp_path/'mes=2025-03', wide), (tmp_path/'long'/'mes=2025-03', long)):
+        os.makedirs(folder)
+        pq.write_table(table, folder/'predispatch.parquet')
+    return tmp_path
+
+def test_both_layouts_are_read_from_the_dataset_root(dataset):
+    wide=PREDISPATCH_QUERY(str(dataset)).query('2025-03-01', '2025-03-31')
+    assert list(wide['h0_1']) == [1.0, 2.0]
+    long=PREDISPATCH_QUERY(str(dataset), layout='long').query('2025-03-01', '2025-03-31', hours=[1])
+    assert list(long['value']) == [3.0]
+
+def test_layout_folder_as_source_path_raises(dataset):
+    query=PREDISPATCH_QUERY(str(dataset/'long'), layout='long')
+    with pytest.raises(Exception, match='dataset root'):
+        query.query('2025-03-01', '2025-03-31')
+    with pytest.raises(Exception, match='dataset root'):
+        query.query_daily('2025-03-01', '2025-03-31')
+
+def test_range_without_files_raises(dataset, tmp_path_factory):
+    query=PREDISPATCH_QUERY(str(dataset), cache_path=str(tmp_path_factory.mktemp('cache')))
+    with pytest.raises(Exception, match='between 2025-05-01 and 2025-05-31'):
+        query.query('2025-05-01', '2025-05-31')
+    with pytest.raises(Exception, match='between 2025-05-01 and 2025-05-31'):
+        query.query_daily('2025-05-01', '2025-05-31')
+    daily=query.query_daily('2025-03-01', '2025-03-31')
+    assert list(daily['value_sum']) == [4.0, 6.0]
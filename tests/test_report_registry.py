@@ -0,0 +1,61 @@
+import os
+from datetime import datetime
+import pytest
+from conftest import PAYLOAD
+from src.clients.backfill_state import BACKFILL_STATE
+from src.clients.cnd_parser import CND_PARSER
+from src.clients.report_registry import get_report, report_payload
+
+class FAILING_PARSER(CND_PARSER):
+    def parse_predispatch_days(self, **kwargs) -> list:
+        raise Exception('unsupported layout')
+
+def _run(mock_cnd, tmp_path, reports:list):
+    from src.pipeline.flows.cnd_predispatch_flow import cnd_predispatch
+    return cnd_predispatch(
+        base_url=mock_cnd.base_url,
+        download_url=mock_cnd.download_url,
+        payload=PAYLOAD,
+        staging_path=str(tmp_path/'staging'),
+        requested_date=datetime(2025, 3, 4),
+        days_backfill=1,
+        requests_per_second=1000,
+        state_path=str(tmp_path/'state.sqlite'),
+        reports=reports
+    )
+
+def test_reports_are_resolved_from_the_registry():
+    report=get_report({'name': 'predispatch', 'bq_table': 'predispatch_v2'})
+    assert (report['categoria'], report['tipo'], report['bq_table']) == ('6', '76', 'predispatch_v2')
+    payload=report_payload(get_report({'name': 'other', 'categoria': 7, 'tipo': 1}), PAYLOAD)
+    assert (payload['categoria'], payload['tipo'], payload['key']) == (7, 1, 'public_key')
+    with pytest.raises(Exception, match='missing'):
+        get_report({'name': 'other'})
+    with pytest.raises(Exception, match='Unknown report'):
+        get_report('other')
+
+def test_reports_of_a_run_are_isolated(mock_cnd, tmp_path, monkeypatch):
+    listed=[]
+    records=mock_cnd._records
+    monkeypatch.setattr(mock_cnd, '_records', lambda params: (listed.append((params['categoria'][0], params['tipo'][0])), records(params))[1])
+
+    _run(mock_cnd, tmp_path, ['predispatch', {'name': 'other', 'categoria': '7', 'tipo': '1'}])
+    ## Every report is listed with its own categoria and tipo
+    assert sorted(set(listed)) == [('6', '76'), ('7', '1')]
+    assert os.listdir(tmp_path/'staging'/'predispatch'/'2025-03-03') == ['cnd_predespacho_diario_predespacho_20250301.parquet']
+    assert os.listdir(tmp_path/'staging'/'other'/'2025-03-03') == ['cnd_other_predespacho_20250301.parquet']
+    for name in ('predispatch', 'other'):
+        assert BACKFILL_STATE(str(tmp_path/f'state_{name}.sqlite')).is_done(datetime(2025, 3, 3), 'parsed')
+
+def test_a_failing_report_does_not_stop_the_others(mock_cnd, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    _run(mock_cnd, tmp_path, ['predispatch', {'name': 'other', 'categoria': '7', 'tipo': '1', 'parser': FAILING_PARSER}])
+    assert BACKFILL_STATE(str(tmp_path/'state_predispatch.sqlite')).is_done(datetime(2025, 3, 3), 'parsed')
+    stages=BACKFILL_STATE(str(tmp_path/'state_other.sqlite')).stages(datetime(2025, 3, 3))
+    assert stages['parsed']['status'] == 'failed' and 'unsupported layout' in stages['parsed']['error']
+    ## The workbook of the failed report is archived under its folder
+    assert os.listdir(tmp_path/'archive'/'other'/'2025-03-03') == ['1_predespacho_20250301.xlsx']
+
+def test_repeated_reports_are_rejected(mock_cnd, tmp_path):
+    with pytest.raises(Exception, match='Repeated reports'):
+        _run(mock_cnd, tmp_path, ['predispatch', {'name': 'predispatch', 'header': 4}])
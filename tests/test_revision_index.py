@@ -0,0 +1,86 @@
+import os
+import sqlite3
+from datetime import datetime
+import pandas as pd
+from benchmarks.synthetic_workbooks import make_predispatch_workbook, make_zip
+from src.clients.cnd_parser import CND_PARSER
+from src.clients.revision_index import REVISION_INDEX
+
+DAY = datetime(2025, 3, 1)
+
+def _parse(path:str, staging_path:str, index:REVISION_INDEX, file_id:int, epoch:str) -> list:
+    parser=CND_PARSER(
+        file_metadata=(file_id, os.path.basename(path), epoch),
+        file_path=path,
+        staging_path=staging_path,
+        revision_index=index
+    )
+    return parser.parse_predispatch_days(requested_dates=[DAY], header=3, output_prefix='test')
+
+def _changes(paths:list) -> dict:
+    df=pd.concat([pd.read_parquet(p) for p in paths]) if paths != [] else pd.DataFrame({'change_type': []})
+    return df['change_type'].value_counts().to_dict()
+
+def test_republished_workbook_writes_only_the_delta(tmp_path):
+    index=REVISION_INDEX(str(tmp_path/'index.sqlite'))
+    first=make_predispatch_workbook(str(tmp_path/'v1/predespacho.xlsx'), DAY, units=5, seed=1)
+    assert _changes(_parse(first, str(tmp_path/'s1'), index, 1, '/Date(1)/')) == {'insert': 5}
+    ## The same version parsed again gives the same delta
+    assert _changes(_parse(first, str(tmp_path/'s2'), index, 1, '/Date(1)/')) == {'insert': 5}
+
+    ## Unchanged republication
+    same=make_predispatch_workbook(str(tmp_path/'v2/predespacho.xlsx'), DAY, units=5, seed=1)
+    assert _parse(same, str(tmp_path/'s3'), index, 1, '/Date(2)/') == []
+
+    ## One unit less, the rest with new values
+    fewer=make_predispatch_workbook(str(tmp_path/'v3/predespacho.xlsx'), DAY, units=4, seed=2)
+    assert _changes(_parse(fewer, str(tmp_path/'s4'), index, 1, '/Date(3)/')) == {'update': 4, 'delete': 1}
+    assert list(index.versions()['revision']) == [1, 2, 3]
+
+def test_members_of_an_archive_are_versioned_apart(tmp_path):
+    index=REVISION_INDEX(str(tmp_path/'index.sqlite'))
+    a=make_predispatch_workbook(str(tmp_path/'v1/a.xlsx'), DAY, units=5, seed=1)
+    b=make_predispatch_workbook(str(tmp_path/'v1/b.xlsx'), DAY, units=5, seed=2)
+    archive=make_zip(str(tmp_path/'v1/predespacho.zip'), [a, b])
+    assert _changes(_parse(archive, str(tmp_path/'s1'), index, 1, '/Date(1)/')) == {'insert': 10}
+    versions=index.versions()
+    assert sorted(versions['source']) == ['predespacho_a', 'predespacho_b']
+    assert list(versions['rows']) == [5, 5]
+
+    ## Only member b changed in the republished archive
+    b_changed=make_predispatch_workbook(str(tmp_path/'v2/b.xlsx'), DAY, units=5, seed=3)
+    republished=make_zip(str(tmp_path/'v2/predespacho.zip'), [a, b_changed])
+    paths=_parse(republished, str(tmp_path/'s2'), index, 1, '/Date(2)/')
+    assert _changes(paths) == {'update': 5}
+    assert all(p.endswith('_b.parquet') for p in paths)
+    assert index.versions().groupby('source')['revision'].max().to_dict() == {'predespacho_a': 2, 'predespacho_b': 2}
+
+def test_files_of_the_same_day_are_versioned_apart(tmp_path):
+    index=REVISION_INDEX(str(tmp_path/'index.sqlite'))
+    a=make_predispatch_workbook(str(tmp_path/'predespacho_a.xlsx'), DAY, units=5, seed=1)
+    b=make_predispatch_workbook(str(tmp_path/'predespacho_b.xlsx'), DAY, units=4, seed=2)
+    assert _changes(_parse(a, str(tmp_path/'s1'), index, 1, '/Date(1)/')) == {'insert': 5}
+    assert _changes(_parse(b, str(tmp_path/'s2'), index, 2, '/Date(1)/')) == {'insert': 4}
+    ## Listed again on the next run, neither file is compared with the other
+    assert _parse(a, str(tmp_path/'s3'), index, 1, '/Date(1)/') != []
+    assert _parse(b, str(tmp_path/'s4'), index, 2, '/Date(2)/') == []
+    assert index.versions().groupby('source')['revision'].max().to_dict() == {'predespacho_a': 1, 'predespacho_b': 2}
+
+def test_sources_of_older_indexes_are_keyed_by_file(tmp_path):
+    db_path=str(tmp_path/'index.sqlite')
+    index=REVISION_INDEX(db_path)
+    first=make_predispatch_workbook(str(tmp_path/'v1/predespacho.xlsx'), DAY, units=5, seed=1)
+    _parse(first, str(tmp_path/'s1'), index, 1, '/Date(1)/')
+    index.close()
+
+    ## An index written when single workbooks had the source ''
+    conn=sqlite3.connect(db_path, isolation_level=None)
+    conn.execute("UPDATE versions SET source = ''")
+    conn.execute("UPDATE row_hashes SET source = ''")
+    conn.execute('PRAGMA user_version=0')
+    conn.close()
+
+    index=REVISION_INDEX(db_path)
+    assert list(index.versions()['source']) == ['predespacho']
+    same=make_predispatch_workbook(str(tmp_path/'v2/predespacho.xlsx'), DAY, units=5, seed=1)
+    assert _parse(same, str(tmp_path/'s2'), index, 1, '/Date(2)/') == []